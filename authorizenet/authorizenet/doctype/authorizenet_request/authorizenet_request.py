@@ -4,8 +4,14 @@
 
 from __future__ import unicode_literals
 import frappe
+from frappe import _
 from frappe.model.document import Document
-from datetime import datetime
+from frappe.utils import now, cint
+from frappe.model.naming import make_autoname
+from datetime import datetime, timedelta
+import base64
+import json
+import zlib
 
 LOG_LEVELS = {
 	"None": 0,
@@ -14,16 +20,148 @@ LOG_LEVELS = {
 	"Debug": 3
 }
 
+LOG_DOCTYPE = "AuthorizeNet Request Log"
+LOG_FIELDS = ("name", "creation", "modified", "owner", "modified_by", "parent",
+	"parenttype", "parentfield", "idx", "timestamp", "log", "level")
+
+REQUEST_LOOKUP_FIELDS = ["name", "status", "transaction_id", "order_id", "amount", "currency",
+	"payer_email", "reference_doctype", "reference_docname", "creation"]
+
 class AuthorizeNetRequest(Document):
+	_max_log_level = LOG_LEVELS["None"]
+
+	def autoname(self):
+		# requests built in memory reserve their name before being inserted
+		self.name = self.flags.reserved_name or make_autoname("hash", self.doctype)
 
 	def max_log_level(self, level):
 		self._max_log_level = LOG_LEVELS[level]
 
+	def is_enabled(self, level):
+		return LOG_LEVELS[level] <= self._max_log_level
+
 	def log_action(self, data, level):
-		if LOG_LEVELS[level] <= self._max_log_level:
-			self.append("log",{
-				"doctype": "AuthorizeNet Request Log",
-				"log": data,
-				"level": level,
-				"timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-			})
+		"""Buffers a log entry, entries are written by flush_log
+
+		data can be a string, a callable returning the entry or any json
+		serializable object. Callables and objects are only evaluated when
+		the level is enabled, so expensive payloads cost nothing otherwise.
+		"""
+		if not self.is_enabled(level):
+			return
+
+		if callable(data):
+			data = data()
+
+		if not isinstance(data, basestring):
+			data = json.dumps(data, default=str)
+
+		self.get_log_entries().append(frappe._dict({
+			"log": data,
+			"level": level,
+			"timestamp": self._next_log_timestamp()
+		}))
+
+	def get_log_entries(self):
+		"""Log entries not yet written to the database"""
+		if not hasattr(self, "_log_buffer"):
+			self._log_buffer = []
+
+			# buffered rows never live in self.log, keep save() from
+			# deleting rows it doesn't know about
+			self.flags.ignore_children_type = (self.flags.ignore_children_type or []) + [LOG_DOCTYPE]
+
+		return self._log_buffer
+
+	def flush_log(self, unit_of_work=None):
+		"""Writes all buffered log entries with a single insert, done by a
+		background job queued when unit_of_work commits if one is given"""
+		entries = self.get_log_entries()
+		if not entries:
+			return
+
+		self._log_buffer = []
+		entries = [{
+			"log": entry.log,
+			"level": entry.level,
+			"timestamp": entry.timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")
+		} for entry in entries]
+
+		if unit_of_work:
+			# the job's rows point at this request, it has to be committed first
+			unit_of_work.enqueue("authorizenet.authorizenet.doctype.authorizenet_request.authorizenet_request.insert_log_entries",
+				parent=self.name, entries=entries)
+		else:
+			insert_log_entries(self.name, entries)
+
+	def get_archived_log(self):
+		"""Log entries compacted into log_archive by the retention job"""
+		return decompress_log_entries(self.log_archive)
+
+	def _next_log_timestamp(self):
+		# wall clock can stand still or step back, keep entries ordered
+		timestamp = datetime.now()
+		last = getattr(self, "_last_log_timestamp", None)
+		if last and timestamp <= last:
+			timestamp = last + timedelta(microseconds=1)
+
+		self._last_log_timestamp = timestamp
+		return timestamp
+
+def on_doctype_update():
+	# requests are looked up by the document they pay for
+	frappe.db.add_index("AuthorizeNet Request", ["reference_doctype", "reference_docname"])
+
+@frappe.whitelist()
+def get_reference_request(reference_doctype, reference_docname):
+	"""Latest request paying for a document, e.g. a Sales Order"""
+	requests = frappe.get_list("AuthorizeNet Request",
+		filters={"reference_doctype": reference_doctype, "reference_docname": reference_docname},
+		fields=REQUEST_LOOKUP_FIELDS, order_by="creation desc", limit_page_length=1)
+
+	return requests[0] if requests else None
+
+@frappe.whitelist()
+def find_requests(transaction_id=None, order_id=None, payer_email=None, status=None, limit=20):
+	"""Requests matching every filter given, only indexed fields can be
+	filtered on so lookups never scan the table"""
+	filters = {key: value for key, value in (("transaction_id", transaction_id), ("order_id", order_id),
+		("payer_email", payer_email), ("status", status)) if value}
+
+	if not filters:
+		frappe.throw(_("Filter by transaction id, order id, payer email or status"))
+
+	return frappe.get_list("AuthorizeNet Request", filters=filters, fields=REQUEST_LOOKUP_FIELDS,
+		order_by="creation desc", limit_page_length=min(cint(limit) or 20, 500))
+
+def insert_log_entries(parent, entries):
+	"""Bulk inserts log rows for an AuthorizeNet Request"""
+	if not entries:
+		return
+
+	start_idx = frappe.db.sql("""select ifnull(max(idx), 0) from `tab{0}`
+		where parent=%s and parentfield='log'""".format(LOG_DOCTYPE), parent)[0][0]
+	timestamp = now()
+	user = frappe.session.user
+
+	values = []
+	for idx, entry in enumerate(entries, start=start_idx + 1):
+		values.extend([frappe.generate_hash(length=10), timestamp, timestamp, user, user,
+			parent, "AuthorizeNet Request", "log", idx,
+			entry["timestamp"], entry["log"], entry["level"]])
+
+	row = "({0})".format(", ".join(["%s"] * len(LOG_FIELDS)))
+	frappe.db.sql("""insert into `tab{0}` ({1}) values {2}""".format(
+		LOG_DOCTYPE,
+		", ".join("`{0}`".format(f) for f in LOG_FIELDS),
+		", ".join([row] * len(entries))), values)
+
+def compress_log_entries(entries):
+	"""Packs log entries into a base64 encoded zlib compressed json blob"""
+	return base64.b64encode(zlib.compress(json.dumps(entries, default=str), 9))
+
+def decompress_log_entries(blob):
+	if not blob:
+		return []
+
+	return json.loads(zlib.decompress(base64.b64decode(blob)))
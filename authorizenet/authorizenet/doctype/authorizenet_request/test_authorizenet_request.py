@@ -6,7 +6,53 @@ from __future__ import unicode_literals
 import frappe
 import unittest
 
+from authorizenet.authorizenet.doctype.authorizenet_request.authorizenet_request import \
+	compress_log_entries, decompress_log_entries
+
 # test_records = frappe.get_test_records('AuthorizeNet Request')
 
 class TestAuthorizeNetRequest(unittest.TestCase):
-	pass
+
+	def test_log_buffering(self):
+		request = frappe.get_doc({"doctype": "AuthorizeNet Request"})
+		request.max_log_level("Info")
+
+		request.log_action("first", "Info")
+		request.log_action("dropped", "Debug")
+		request.log_action("second", "Error")
+
+		entries = request.get_log_entries()
+		self.assertEqual([e.log for e in entries], ["first", "second"])
+		self.assertEqual(len(request.get("log")), 0)
+		self.assertTrue(entries[0].timestamp < entries[1].timestamp)
+
+	def test_lazy_log_payloads(self):
+		request = frappe.get_doc({"doctype": "AuthorizeNet Request"})
+		request.max_log_level("Error")
+
+		def expensive():
+			raise AssertionError("disabled levels must not build their payload")
+
+		request.log_action(expensive, "Debug")
+		request.log_action(lambda: "built", "Error")
+		request.log_action({"amount": 1}, "Info")
+
+		self.assertFalse(request.is_enabled("Debug"))
+		self.assertEqual([e.log for e in request.get_log_entries()], ["built", '{"amount": 1}'])
+
+	def test_log_archive(self):
+		entries = [{"idx": i, "level": "Debug", "log": '{"payload": "x"}' * 20} for i in range(50)]
+		blob = compress_log_entries(entries)
+
+		self.assertEqual(decompress_log_entries(blob), entries)
+		self.assertTrue(len(blob) < len("".join(e["log"] for e in entries)) / 10)
+		self.assertEqual(decompress_log_entries(None), [])
+
+	def test_lookups_use_indexes(self):
+		for condition, values in (("transaction_id=%s", ("60000000001",)), ("order_id=%s", ("SO-00001",)),
+			("payer_email=%s", ("NuranVerkleij@example.com",)), ("status=%s", ("Authorized",)),
+			("reference_doctype=%s and reference_docname=%s", ("Sales Order", "SO-00001"))):
+
+			plan = frappe.db.sql("""explain select name from `tabAuthorizeNet Request`
+				where {0}""".format(condition), values, as_dict=True)
+			self.assertTrue(plan[0].possible_keys, "no index for " + condition)
@@ -2,7 +2,43 @@ frappe.provide("frappe.integration_service")
 
 frappe.ui.form.on('AuthorizeNet Settings', {
 	refresh: function(frm) {
+		frm.trigger("show_circuit_breaker");
+	},
+
+	show_circuit_breaker: function(frm) {
+		if (!frm.doc.circuit_breaker) {
+			return;
+		}
+
+		frappe.call({
+			method: "authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings.get_circuit_breaker_state",
+			callback: function(r) {
+				var state = r.message;
+				if (!state) {
+					return;
+				}
+
+				var message = __("Circuit breaker {0}: {1} failed of {2} calls in the last minute",
+					[state.state, state.failures, state.calls]);
+				if (state.state == "Open") {
+					message += " " + __("(retrying in {0}s)", [state.retry_in]);
+				}
 
+				frm.dashboard.set_headline_alert(message,
+					state.state == "Closed" ? "alert-success" : "alert-danger");
+
+				if (state.state != "Closed") {
+					frm.add_custom_button(__("Reset Circuit Breaker"), function() {
+						frappe.call({
+							method: "authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings.reset_circuit_breaker",
+							callback: function() {
+								frm.refresh();
+							}
+						});
+					});
+				}
+			}
+		});
 	}
 });
 
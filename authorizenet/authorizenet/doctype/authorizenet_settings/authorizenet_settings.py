@@ -29,6 +29,9 @@ Example:
 	# redirect the user to this url
 	url = controller().get_payment_url(**payment_details)
 
+The request record behind the url is committed right away. When generating
+many urls, pass commit=False and commit once at the end.
+
 
 ### 3. On Completion of Payment
 
@@ -42,7 +45,11 @@ Example:
 ##### Note:
 
 payment_status - payment gateway will put payment status on callback.
-For authorize.net status parameter is one from: [Completed, Failed]
+For authorize.net status parameter is one from: [Completed, Authorized, Failed]
+
+Payments taken with the Authorize Only transaction type get "Authorized" at
+checkout. Once authorizenet.capture captures them, the reference doctype's
+`on_payment_captured` method is called, if it has one.
 
 
 More Details:
@@ -53,22 +60,86 @@ More Details:
 from __future__ import unicode_literals
 import frappe
 from frappe import _, _dict
-from frappe.utils import get_url, call_hook_method, flt
+from frappe.utils import get_url, call_hook_method, flt, cint, get_datetime
 from frappe.model.document import Document
-from frappe.integrations.utils import create_request_log, create_payment_gateway
+from frappe.integrations.utils import create_payment_gateway
+from frappe.model.naming import make_autoname
+from frappe.utils.response import json_handler
+from frappe.utils.password import encrypt, decrypt
 import json
 from datetime import datetime
 import urllib
+import os
+import hashlib
 import authorize
+import authorizenet
+
+from authorize import AuthorizeResponseError, AuthorizeInvalidError, AuthorizeConnectionError
+from authorizenet.circuit_breaker import CircuitBreaker
+from authorizenet.gateway import get_gateway, get_environment_url, DEFAULT_CONNECT_TIMEOUT, \
+	DEFAULT_READ_TIMEOUT
+from authorizenet.idempotency import get_idempotency_key, get_client_key, IdempotencyGuard
+from authorizenet.metrics import span, get_sink, PaymentMetrics
+from authorizenet.unit_of_work import UnitOfWork
+from authorizenet.vault import enqueue_store_payment, vault_card
+from authorizenet.utils import authnet_address, get_identity, mark_stored_payment_used, \
+	get_stored_payment_summaries, validate_card_info, get_country_options, get_country_options_version
+
+EMBED_TEMPLATE = "templates/includes/integrations/authorizenet/embed.html"
+STORED_PAYMENTS_TEMPLATE = "templates/includes/integrations/authorizenet/stored_payments.html"
+STORED_PAYMENT_ITEMS_TEMPLATE = "templates/includes/integrations/authorizenet/stored_payment_items.html"
+STORED_PAYMENTS_SLOT = "<!-- authorizenet:stored-payments -->"
+EMBED_FORM_CACHE_TTL = 24 * 60 * 60
+# caller context the static part of the embed form renders
+EMBED_FORM_CONTEXT_FIELDS = ("is_backend", "use_address_same_as", "address_same_as_label",
+	"address_same_as_source")
+_templates_version = None
+
+# payment information copied onto requests created on the fly
+REQUEST_FIELDS = ('amount', 'currency', 'order_id', 'title', \
+	'description', 'payer_email', 'payer_name', \
+	'reference_docname', 'reference_doctype')
+
+# background payment status is kept this long for get_status polling
+PAYMENT_STATUS_TTL = 60 * 60
+PAYMENT_STATUS_KEY = "authorizenet:payment_status:{0}"
+# token of the job processing a request, by request name
+PAYMENT_TOKEN_KEY = "authorizenet:payment_token:{0}"
+# request statuses a new payment attempt may start from
+RETRYABLE_STATUSES = ("Issued", "Declined", "Error")
+
+# modified timestamp of the saved settings, workers reload their snapshot
+# once it changes
+SETTINGS_VERSION_KEY = "authorizenet:settings_version"
+_snapshots = {}
+
+def stored_payment_profile(customer_id, payment_id):
+	"""Transaction fields that charge a stored payment profile"""
+	return {
+		"customer_id": customer_id,
+		"payment_id": payment_id
+	}
+
+def get_embed_templates_version():
+	"""Version of the embed form templates, looked up once per worker since
+	templates only change on deploys, which restart workers"""
+	global _templates_version
 
-from authorize import AuthorizeResponseError, AuthorizeInvalidError
-from authorizenet.utils import get_authorizenet_user, get_card_accronym, authnet_address, get_contact
+	if not _templates_version:
+		template_dir = frappe.get_app_path("authorizenet", "templates", "includes",
+			"integrations", "authorizenet")
+		_templates_version = "{0}-{1}".format(authorizenet.__version__,
+			max(os.path.getmtime(os.path.join(template_dir, name)) \
+				for name in os.listdir(template_dir) if name.endswith(".html")))
+
+	return _templates_version
 
 def log(*args, **kwargs):
 	print("\n".join(args))
 
 class AuthorizeNetSettings(Document):
 	service_name = "AuthorizeNet"
+	_settings = None
 	supported_currencies = ["USD"]
 	is_embedable = True
 
@@ -79,41 +150,70 @@ class AuthorizeNetSettings(Document):
 			self.validate_authorizenet_credentails()
 
 	def on_update(self):
-		pass
+		frappe.cache().set_value(SETTINGS_VERSION_KEY, get_settings_version(self.modified))
 
 	def get_embed_context(self, context):
-		# list countries for billing address form
-		context["authorizenet_countries"] = frappe.get_list("Country", fields=["country_name", "name"], ignore_permissions=1)
-		default_country = frappe.get_value("System Settings", "System Settings", "country")
-		default_country_doc = next((x for x in context["authorizenet_countries"] if x.name == default_country), None)
+		self.get_embed_static_context(context)
+		self.get_embed_user_context(context)
 
-		country_idx = context["authorizenet_countries"].index(default_country_doc)
-		context["authorizenet_countries"].pop(country_idx)
-		context["authorizenet_countries"] = [default_country_doc] + context["authorizenet_countries"]
+	def get_embed_static_context(self, context):
+		# list countries for billing address form
+		context["authorizenet_countries"] = get_country_options()
 
 		context["year"] = datetime.today().year
 
-		# get the authorizenet user record
-		authnet_user = get_authorizenet_user()
-
-		if authnet_user:
-			context["stored_payments"] = authnet_user.get("stored_payments", [])
+	def get_embed_user_context(self, context):
+		# stored payment summaries, the authorizenet user doc isn't needed
+		identity = get_identity()
+		context["stored_payments"] = identity.stored_payments
+		context["stored_payments_more"] = identity.stored_payments_more
 
 	def get_embed_form(self, context={}):
 
 		context.update({
-			"source": "templates/includes/integrations/authorizenet/embed.html"
+			"source": EMBED_TEMPLATE
 		})
 		context = _dict(context)
 
-		self.get_embed_context(context)
+		# the form is the same for every user except for stored payments,
+		# render those on their own and splice them into the cached markup
+		form = self.get_embed_static_form(context)
+
+		self.get_embed_user_context(context)
+		stored_payments = ""
+		if context.get("stored_payments"):
+			stored_payments = frappe.render_template(STORED_PAYMENTS_TEMPLATE, context)
 
 		return {
-			"form": frappe.render_template(context.source, context),
+			"form": form.replace(STORED_PAYMENTS_SLOT, stored_payments),
 			"style_url": "/assets/css/authorizenet_embed.css",
 			"script_url": "/assets/js/authorizenet_embed.js"
 		}
 
+	def get_embed_static_form(self, context):
+		"""Renders the user independent part of the embeded form, cached
+		by template version, language, country list version and the few
+		caller context fields it renders"""
+
+		static_context = _dict({field: context.get(field) for field in EMBED_FORM_CONTEXT_FIELDS})
+		cache_key = "authorizenet:embed_form:{0}:{1}:{2}:{3}".format(
+			get_embed_templates_version(),
+			frappe.local.lang,
+			get_country_options_version(),
+			hashlib.md5(frappe.as_json(static_context).encode("utf-8")).hexdigest())
+
+		form = frappe.cache().get_value(cache_key)
+		if form:
+			return form
+
+		static_context["stored_payments_slot"] = STORED_PAYMENTS_SLOT
+		self.get_embed_static_context(static_context)
+		form = frappe.render_template(context.source, static_context)
+
+		frappe.cache().set_value(cache_key, form, expires_in_sec=EMBED_FORM_CACHE_TTL)
+
+		return form
+
 	def validate_authorizenet_credentails(self):
 		pass
 
@@ -121,82 +221,126 @@ class AuthorizeNetSettings(Document):
 		if currency not in self.supported_currencies:
 			frappe.throw(_("Please select another payment method. {0} does not support transactions in currency \"{1}\"").format(self.service_name, currency))
 
-	def build_authorizenet_request(self, **kwargs):
-		"""Creates an AuthorizeNet Request record to keep params off the url"""
+	def build_authorizenet_request(self, commit=True, **kwargs):
+		"""Creates an AuthorizeNet Request record to keep params off the url
+
+		The record is written once with all its fields set. Batch callers
+		pass commit=False and commit once after creating many requests.
+		"""
+
+		request = self.new_authorizenet_request(**kwargs)
+		request.insert()
+
+		# get_payment_url is called from GET requests, which are never
+		# committed for us
+		if commit:
+			frappe.db.commit()
+
+		return request
+
+	def new_authorizenet_request(self, **kwargs):
+		"""Builds an AuthorizeNet Request in memory, named but not yet inserted"""
 
 		data = {
 			"doctype": "AuthorizeNet Request",
 			"status": "Issued",
 		}
 		data.update(kwargs)
-		del data["reference_docname"] # have to set it after insert
 
 		request = frappe.get_doc(data)
+		# reserve the name so it can be referenced before the insert
+		request.name = request.flags.reserved_name = make_autoname("hash", request.doctype)
 		request.flags.ignore_permissions = 1
-		request.insert()
-
-		# TODO: Why must we save doctype first before setting docname?
-		request.reference_docname = kwargs["reference_docname"]
-		request.save()
-		frappe.db.commit()
 
 		return request
 
-	def get_payment_url(self, **kwargs):
-		request = self.build_authorizenet_request(**kwargs)
+	def get_payment_url(self, commit=True, **kwargs):
+		request = self.build_authorizenet_request(commit=commit, **kwargs)
 		url = "./integrations/authorizenet_checkout/{0}"
 		result = get_url(url.format(request.get("name" )))
 		return result
 
 	def get_settings(self):
+		"""Gateway settings, from the worker's snapshot for controllers
+		built by get_controller"""
+		settings = frappe._dict(self._settings or self.load_settings())
+
+		# site config wins so test and benchmark runs can't hit the real gateway
+		settings.gateway_url = frappe.conf.get("authorizenet_gateway_url") or settings.gateway_url or \
+			get_environment_url(settings.use_sandbox)
+
+		return settings
+
+	def load_settings(self):
+		value = self.get_value_or_default
 		settings = frappe._dict({
 			"api_login_id": self.api_login_id,
-			"api_transaction_key": self.get_password(fieldname="api_transaction_key", raise_exception=False)
+			"api_transaction_key": self.get_password(fieldname="api_transaction_key", raise_exception=False),
+			"gateway_url": self.gateway_url,
+			"use_sandbox": cint(value("use_sandbox")),
+			"log_level": value("log_level"),
+			"pool_size": cint(value("pool_size")),
+			"connect_timeout": flt(value("connect_timeout")),
+			"read_timeout": flt(value("read_timeout")),
+			"max_retries": cint(value("max_retries")),
+			"circuit_breaker": cint(value("circuit_breaker")),
+			"breaker_error_rate": flt(value("breaker_error_rate")),
+			"breaker_min_calls": cint(value("breaker_min_calls")),
+			"breaker_cooldown": cint(value("breaker_cooldown"))
 		})
 
 		return settings
 
 	def process_payment(self):
-		# used for feedback about which payment was used
-		authorizenet_data = {}
-		# the current logged in contact
-		contact = get_contact()
-		# get authorizenet user if available
-		authnet_user = get_authorizenet_user()
 		# the cc data available
 		data = self.process_data
 
+		# pre-flight card checks, bad cards are rejected before touching the
+		# database or the gateway
+		if self.card_info:
+			card_errors = validate_card_info(self.card_info)
+			if card_errors:
+				return self.reject_payment(card_errors)
+
+		# used for feedback about which payment was used
+		authorizenet_data = {}
+		with span("contact_lookup"):
+			# resolved once per request and shared with the checkout page
+			identity = get_identity()
+			# the current logged in contact
+			contact = identity.contact
+
 		# get auth keys
-		settings = self.get_settings()
+		with span("settings_load"):
+			settings = self.get_settings()
 		# fetch redirect info
 		redirect_to = data.get("notes", {}).get("redirect_to") or None
 		redirect_message = data.get("notes", {}).get("redirect_message") or None
 
-		# uses dummy request doc for unittests as we are only testing processing
-		if not data.get("unittest"):
-			if data.get("name"):
-				request = frappe.get_doc("AuthorizeNet Request", data.get("name"))
+		with span("request_creation"):
+			# uses dummy request doc for unittests as we are only testing processing
+			if not data.get("unittest"):
+				if data.get("name"):
+					request = self.unit_of_work.save(
+						frappe.get_doc("AuthorizeNet Request", data.get("name")))
+				else:
+					# Create request from scratch when embeding form on the fly
+					#
+					# This allows payment processing without having to pre-create
+					# a request first.
+					#
+					# This path expects all the payment request information to be
+					# available!!
+					#
+					# keys expected: ('amount', 'currency', 'order_id', 'title', \
+					#                 'description', 'payer_email', 'payer_name', \
+					#                 'reference_docname', 'reference_doctype')
+					request = self.unit_of_work.insert(self.new_authorizenet_request(**{ \
+						key: data[key] for key in REQUEST_FIELDS }))
+
+					data["name"] = request.get("name")
 			else:
-				# Create request from scratch when embeding form on the fly
-				#
-				# This allows payment processing without having to pre-create
-				# a request first.
-				#
-				# This path expects all the payment request information to be
-				# available!!
-				#
-				# keys expected: ('amount', 'currency', 'order_id', 'title', \
-				#                 'description', 'payer_email', 'payer_name', \
-				#                 'reference_docname', 'reference_doctype')
-				request = self.build_authorizenet_request(**{ \
-					key: data[key] for key in \
-						('amount', 'currency', 'order_id', 'title', \
-						 'description', 'payer_email', 'payer_name', \
-						 'reference_docname', 'reference_doctype') })
-
-				data["name"] = request.get("name")
-		else:
-			request = frappe.get_doc({"doctype": "AuthorizeNet Request"})
+				request = frappe.get_doc({"doctype": "AuthorizeNet Request"})
 
 		request.flags.ignore_permissions = 1
 
@@ -205,136 +349,117 @@ class AuthorizeNetSettings(Document):
 
 		try:
 
-			if self.card_info:
-				# ensure card fields exist
-				required_card_fields = ['name_on_card', 'card_number', 'exp_month', 'exp_year', 'card_code']
-				for f in required_card_fields:
-					if not self.card_info.get(f):
-						request.status = "Error"
-						return request,	None, "Missing field: %s" % f, {}
-
-			# prepare authorize api
-			authorize.Configuration.configure(
-				authorize.Environment.TEST if self.use_sandbox else authorize.Environment.PRODUCTION,
-				settings.api_login_id,
-				settings.api_transaction_key
-			)
-
-			# cache billing fields as per authorize api requirements
-			billing = authnet_address(self.billing_info)
-			if self.shipping_info:
-				shipping = authnet_address(self.shipping_info)
-			else:
-				shipping = None
-
-			# attempt to find valid email address
-			email = self.process_data.get("payer_email")
-
-			if email:
-				email = email.split(',')[0]
-
-			if "@" not in email and contact:
-				email = contact.get("email_id")
-
-				if "@" not in email:
-					if contact and contact.user:
-						email = frappe.get_value("User", contact.user, "email_id")
-
-						if "@" not in email:
-							log("AUTHNET FAILURE! Bad email: {0}".format(email))
-							raise ValueError("There are no valid emails associated with this customer")
-
-			# build transaction data
-			transaction_data = {
-				"order": {
-					"invoice_number": data["order_id"]
-				},
-				"amount": flt(self.process_data.get("amount")),
-				"email": email,
-				"description": self.card_info.get("name_on_card"),
-				"customer_type": "individual"
-			}
+			# pooled authorize api client for these credentials
+			with span("gateway_setup"):
+				gateway = get_gateway(settings)
+
+			with span("address_building"):
+				# cache billing fields as per authorize api requirements
+				billing = authnet_address(self.billing_info)
+				if self.shipping_info:
+					shipping = authnet_address(self.shipping_info)
+				else:
+					shipping = None
+
+				# attempt to find valid email address
+				email = self.process_data.get("payer_email")
+
+				if email:
+					email = email.split(',')[0]
+
+				if (not email or "@" not in email) and contact:
+					if not identity.email:
+						log("AUTHNET FAILURE! Bad email: {0}".format(email))
+						raise ValueError("There are no valid emails associated with this customer")
+
+					email = identity.email
+
+				# build transaction data
+				transaction_data = self.build_transaction_data(data["order_id"],
+					self.process_data.get("amount"), email,
+					self.card_info.get("name_on_card") if self.card_info else None)
+
+				# get authorizenet profile informatio for stored payments
+				authorizenet_profile = self.process_data.get("authorizenet_profile");
+
+				# use card
+				# see: https://vcatalano.github.io/py-authorize/transaction.html
+				if self.card_info != None:
+					# exp formating for sale/auth api
+					expiration_date = "{0}/{1}".format(
+						self.card_info.get("exp_month"),
+						self.card_info.get("exp_year"))
+
+					transaction_data.update({
+						"credit_card": {
+							"card_number": self.card_info.get("card_number"),
+							"expiration_date": expiration_date,
+							"card_code": self.card_info.get("card_code")
+						}
+					})
+				elif authorizenet_profile:
 
-			# track ip for tranasction records
-			if frappe.local.request_ip:
-				transaction_data.update({
-					"extra_options": {
-						"customer_ip": frappe.local.request_ip
-					}
-				})
-
-			# get authorizenet profile informatio for stored payments
-			authorizenet_profile = self.process_data.get("authorizenet_profile");
-
-			# use card
-			# see: https://vcatalano.github.io/py-authorize/transaction.html
-			if self.card_info != None:
-				# exp formating for sale/auth api
-				expiration_date = "{0}/{1}".format(
-					self.card_info.get("exp_month"),
-					self.card_info.get("exp_year"))
-
-				transaction_data.update({
-					"credit_card": {
-						"card_number": self.card_info.get("card_number"),
-						"expiration_date": expiration_date,
-						"card_code": self.card_info.get("card_code")
-					}
-				})
-			elif authorizenet_profile:
-
-				# if the customer_id isn't provided, then fetch from authnetuser
-				if not authorizenet_profile.get("customer_id"):
-					authorizenet_profile["customer_id"] = authnet_user.get("authorizenet_id")
-
-				# or stored payment
-				transaction_data.update({
-					"customer_id": authorizenet_profile.get("customer_id"),
-					"payment_id": authorizenet_profile.get("payment_id")
-				})
-
-				# track transaction payment profile ids to return later
-				authorizenet_data.update({
-					"customer_id": authorizenet_profile.get("customer_id"),
-					"payment_id": authorizenet_profile.get("payment_id")
-				})
-			else:
-				raise "Missing Credit Card Information"
+					# if the customer_id isn't provided, then fetch from authnetuser
+					if not authorizenet_profile.get("customer_id"):
+						authorizenet_profile["customer_id"] = identity.authorizenet_id
+
+					# or stored payment
+					transaction_data.update(stored_payment_profile(
+						authorizenet_profile.get("customer_id"),
+						authorizenet_profile.get("payment_id")))
+
+					# track transaction payment profile ids to return later
+					authorizenet_data.update({
+						"customer_id": authorizenet_profile.get("customer_id"),
+						"payment_id": authorizenet_profile.get("payment_id")
+					})
+				else:
+					raise "Missing Credit Card Information"
 
-			name_parts = self.card_info["name_on_card"].split(' ')
-			first_name = name_parts[0]
-			last_name = " ".join(name_parts[1:])
+				# add billing information if available
+				if len(billing.keys()):
+					transaction_data["billing"] = billing
 
-			# add billing information if available
-			if len(billing.keys()):
-				transaction_data["billing"] = billing
-				transaction_data["billing"]["first_name"] = first_name
-				transaction_data["billing"]["last_name"] = last_name
+				if shipping and len(shipping.keys()):
+					transaction_data["shipping"] = billing
 
-			if shipping and len(shipping.keys()):
-				transaction_data["shipping"] = billing
-				transaction_data["shipping"]["first_name"] = first_name
-				transaction_data["shipping"]["last_name"] = last_name
+				# stored payments already carry the card holder name
+				if self.card_info:
+					name_parts = self.card_info["name_on_card"].split(' ')
+					for address in (transaction_data.get("billing"), transaction_data.get("shipping")):
+						if address is not None:
+							address["first_name"] = name_parts[0]
+							address["last_name"] = " ".join(name_parts[1:])
 
-			# include line items if available
-			if self.process_data.get("line_items"):
-				transaction_data["line_items"] = self.process_data.get("line_items")
+				# include line items if available
+				if self.process_data.get("line_items"):
+					transaction_data["line_items"] = self.process_data.get("line_items")
 
-			request.log_action("Requesting Transaction: %s" % \
+			request.log_action(lambda: "Requesting Transaction: %s" % \
 				json.dumps(transaction_data), "Debug")
 
+			# authorize only holds the amount, it is captured at fulfillment
+			auth_only = self.transaction_type == "Authorize Only"
+
 			# performt transaction finally
-			result = authorize.Transaction.sale(transaction_data)
-			request.log_action(json.dumps(result), "Debug")
+			with span("gateway_call"):
+				if auth_only:
+					result = gateway.transaction.auth(transaction_data)
+				else:
+					result = gateway.transaction.sale(transaction_data)
+			request.log_action(result, "Debug")
 
 			# if all went well, record transaction id
 			request.transaction_id = result.transaction_response.trans_id
-			request.status = "Captured"
+			request.status = "Authorized" if auth_only else "Captured"
 			request.flags.ignore_permissions = 1
 
+			if authorizenet_data.get("payment_id"):
+				mark_stored_payment_used(authorizenet_data["customer_id"], authorizenet_data["payment_id"])
+
 		except AuthorizeInvalidError as iex:
 			# log validation errors
-			request.log_action(frappe.get_traceback(), "Error")
+			request.log_action(frappe.get_traceback, "Error")
 			request.status = "Error"
 			error_msg = ""
 			errors = []
@@ -352,7 +477,7 @@ class AuthorizeNetSettings(Document):
 		except AuthorizeResponseError as ex:
 			# log authorizenet server response errors
 			result = ex.full_response
-			request.log_action(json.dumps(result), "Debug")
+			request.log_action(result, "Debug")
 			request.log_action(str(ex), "Error")
 			request.status = "Error"
 			request.error_msg = ex.text
@@ -361,18 +486,25 @@ class AuthorizeNetSettings(Document):
 			if result and hasattr(result, 'transaction_response'):
 				# if there is extra transaction data, log it
 				errors = result.transaction_response.errors
-				request.log_action("\n".join([err.error_text for err in errors]), "Error")
-				request.log_action(frappe.get_traceback(), "Error")
+				request.log_action(lambda: "\n".join([err.error_text for err in errors]), "Error")
+				request.log_action(frappe.get_traceback, "Error")
 
 				request.transaction_id = result.transaction_response.trans_id
 				redirect_message = "Success"
 
 			pass
 
+		except AuthorizeConnectionError as ex:
+			# gateway unreachable or paused by the circuit breaker, retries
+			# already gave up
+			request.log_action(frappe.get_traceback, "Error")
+			request.status = "Error"
+			request.error_msg = "Authorize.Net is not responding right now, please try again in a few moments."
+
 		except Exception as ex:
 			log(frappe.get_traceback())
 			# any other errors
-			request.log_action(frappe.get_traceback(), "Error")
+			request.log_action(frappe.get_traceback, "Error")
 			request.status = "Error"
 			request.error_msg = "[UNEXPECTED ERROR]: {0}".format(ex)
 			pass
@@ -384,106 +516,143 @@ class AuthorizeNetSettings(Document):
 			self.card_info.get("store_payment") and \
 			contact:
 
-			try:
-
-				# create customer if authnet_user doesn't exist
-				if not authnet_user:
-					request.log_action("Creating AUTHNET customer", "Info")
+			with span("stored_payment"):
+				if data.get("unittest") or frappe.flags.authorizenet_store_payments_inline:
+					# tests charge the new profile right away and benchmarks
+					# time it, store it in line with the payment
+					authorizenet_data.update(vault_card(gateway, request.transaction_id, contact.name,
+						self.card_info, self.billing_info, request, self.unit_of_work))
+				else:
+					# the customer's redirect doesn't wait for the extra gateway calls
+					enqueue_store_payment(request, contact.name, self.card_info, self.billing_info,
+						self.unit_of_work)
+					request.log_action("Storing payment information in the background", "Info")
 
-					customer_result = authorize.Customer.from_transaction(request.transaction_id)
+		return request, redirect_to, redirect_message, authorizenet_data
 
-					request.log_action("Success", "Debug")
+	def get_value_or_default(self, fieldname):
+		"""Value of a field, or its default while it was never saved"""
+		value = self.get(fieldname)
+		if value is None:
+			value = self.meta.get_field(fieldname).default
+
+		return value
+
+	def build_transaction_data(self, order_id, amount, email, description=None):
+		"""Transaction fields shared by card and stored payment charges"""
+		transaction_data = {
+			"order": {
+				"invoice_number": order_id
+			},
+			"amount": flt(amount),
+			"email": email,
+			"customer_type": "individual"
+		}
 
-					authnet_user = frappe.get_doc({
-						"doctype": "AuthorizeNet Users",
-						"authorizenet_id": customer_result.customer_id,
-						"contact": contact.name
-					})
+		if description:
+			transaction_data["description"] = description
 
-				card_store_info = {
-					"card_number": self.card_info.get("card_number"),
-					"expiration_month": self.card_info.get("exp_month"),
-					"expiration_year": self.card_info.get("exp_year"),
-					"card_code": self.card_info.get("card_code"),
-					"billing": self.billing_info
+		# track ip for tranasction records
+		if getattr(frappe.local, "request_ip", None):
+			transaction_data.update({
+				"extra_options": {
+					"customer_ip": frappe.local.request_ip
 				}
+			})
+
+		return transaction_data
+
+	def new_integration_request(self, status):
+		"""Integration Request log for this payment, built in memory"""
+		return frappe.get_doc({
+			"doctype": "Integration Request",
+			"integration_type": "Host",
+			"integration_request_service": self.service_name,
+			"reference_doctype": self.process_data.get("reference_doctype"),
+			"reference_docname": self.process_data.get("reference_docname"),
+			"data": json.dumps(self.process_data, default=json_handler),
+			"status": status
+		})
+
+	def reject_payment(self, field_errors):
+		"""Fails a payment that did not pass pre-flight validation"""
+		data = self.process_data
 
-				request.log_action("Storing Payment Information With AUTHNET", "Info")
-				request.log_action(json.dumps(card_store_info), "Debug")
-
-				try:
-					card_result = authorize.CreditCard.create(
-						authnet_user.get("authorizenet_id"), card_store_info)
-				except AuthorizeResponseError as ex:
-					card_result = ex.full_response
-					request.log_action(json.dumps(card_result), "Debug")
-					request.log_action(str(ex), "Error")
-
-					try:
-						# duplicate payment profile
-						if card_result["messages"][0]["message"]["code"] == "E00039":
-							request.log_action("Duplicate payment profile, ignore", "Error")
-						else:
-							raise ex
-					except:
-						raise ex
-
-
-				request.log_action("Success: %s" % card_result.payment_id, "Debug")
-
-				address_short = "{0}, {1} {2}".format(
-					billing.get("city"),
-					billing.get("state"),
-					billing.get("pincode"))
-
-				card_label = "{0}{1}".format(
-					get_card_accronym(self.card_info.get("card_number")), self.card_info.get("card_number")[-4:])
-
-				authnet_user.flags.ignore_permissions = 1
-				authnet_user.append("stored_payments", {
-					"doctype": "AuthorizeNet Stored Payment",
-					"short_text": "%s %s" % (card_label,
-					address_short),
-					"long_text": "{0}\n{1}\n{2}, {3} {4}\n{5}".format(
-						card_label,
-						billing.get("address", ""),
-						billing.get("city", ""),
-						billing.get("state", ""),
-						billing.get("pincode", ""),
-						frappe.get_value("Country",  filters={"name": self.billing_info.get("country")}, fieldname="country_name")
-					),
-					"address_1": self.billing_info.get("address_1"),
-					"address_2": self.billing_info.get("address_2"),
-					"expires": "{0}-{1}-01".format(
-						self.card_info.get("exp_year"),
-						self.card_info.get("exp_month")),
-					"city": self.billing_info.get("city"),
-					"state": self.billing_info.get("state"),
-					"postal_code": self.billing_info.get("pincode"),
-					"country": frappe.get_value("Country", self.billing_info.get("country"), fieldname="code"),
-					"payment_type": "Card",
-					"authorizenet_payment_id": card_result.payment_id
-				})
-
-				authorizenet_data.update({
-					"customer_id": authnet_user.get("authorizenet_id"),
-					"payment_id": card_result.payment_id
-				})
-
-
-				if not data.get("unittest"):
-					authnet_user.save()
-
-				request.log_action("Stored in DB", "Debug")
-			except Exception as exx:
-				# any other errors
-				request.log_action(frappe.get_traceback(), "Error")
-				raise exx
+		if data.get("name") and not data.get("unittest"):
+			request = self.unit_of_work.save(
+				frappe.get_doc("AuthorizeNet Request", data.get("name")))
+		else:
+			# embeded forms have no request yet, keep it off the database
+			request = frappe.get_doc({"doctype": "AuthorizeNet Request"})
+			request.update({ key: data.get(key) for key in REQUEST_FIELDS })
+			request.flags.skip_persist = 1
 
-		return request, redirect_to, redirect_message, authorizenet_data
+		request.flags.ignore_permissions = 1
+		request.max_log_level(self.log_level)
+
+		errors = []
+		for field_error in field_errors:
+			for field_name, error in field_error.iteritems():
+				errors.append(error)
+
+		request.status = "Error"
+		request.error_msg = "\n".join(errors)
+		request.log_action("Pre-flight validation failed: %s" % request.error_msg, "Error")
+
+		return request, None, None, {}
+
+	def get_metrics_sink(self):
+		return get_sink(self.metrics_sink, self.statsd_host, cint(self.statsd_port), self.metrics_prefix)
 
 	def create_request(self, data):
+		"""Processes a payment, at most once per idempotency key.
+
+		Duplicates of a payment in flight wait for its result, duplicates of
+		a successful one get its result back without touching the gateway.
+		"""
+		key = None if data.get("unittest") else get_idempotency_key(data)
+		if not key:
+			return self.measure_payment(data)
+
+		with IdempotencyGuard(key, self.get_idempotency_lock_ttl(), get_client_key(data)) as guard:
+			if guard.result is None:
+				guard.set_result(self.get_paid_result(data.get("name")) or self.measure_payment(data))
+
+		return guard.result
+
+	def measure_payment(self, data):
+		# phase timings are reported per payment, labelled with its outcome
+		with PaymentMetrics(self.get_metrics_sink()) as metrics:
+			result = self.handle_payment(data)
+			metrics.outcome = result.get("status")
+
+		return result
+
+	def get_paid_result(self, request_name):
+		"""Result for a request that was already paid, e.g. once its
+		idempotency result expired"""
+		if not request_name:
+			return None
+
+		status = frappe.db.get_value("AuthorizeNet Request", request_name, "status")
+		if status in ("Captured", "Authorized"):
+			return {
+				"redirect_to": "/integrations/payment-success",
+				"error": None,
+				"status": "Completed" if status == "Captured" else "Authorized",
+				"authorizenet_data": {}
+			}
+
+	def get_idempotency_lock_ttl(self):
+		# a payment makes up to three gateway calls, the lock must outlive them
+		timeouts = flt(self.connect_timeout or DEFAULT_CONNECT_TIMEOUT) + \
+			flt(self.read_timeout or DEFAULT_READ_TIMEOUT)
+		return 3 * timeouts + 30
+
+	def handle_payment(self, data):
 		self.process_data = frappe._dict(data)
+		# every document touched by this payment is written once through it
+		self.unit_of_work = UnitOfWork()
 
 		# try:
 		# remove sensitive info from being entered into db
@@ -509,8 +678,9 @@ class AuthorizeNetSettings(Document):
 			self.process_data.card_info["card_code"] = "X" * \
 				 len(self.process_data.card_info["card_code"])
 
-		if not self.process_data.get("unittest"):
-			self.integration_request = create_request_log(self.process_data, "Host", self.service_name)
+		# unit tests and pre-flight rejections never reach the database
+		persist = not self.process_data.get("unittest") and \
+			not request.flags.skip_persist
 
 		if request.get('status') == "Captured":
 			status = "Completed"
@@ -522,58 +692,73 @@ class AuthorizeNetSettings(Document):
 		request.log_action(status, "Info")
 
 		# prevents unit test from inserting data on db
-		if not self.process_data.get("unittest"):
-			self.integration_request.status = status
-			self.integration_request.save()
-			request.save()
+		if persist:
+			self.integration_request = self.unit_of_work.insert(
+				self.new_integration_request(status))
+
+			# write everything before the reference doc reacts to the payment,
+			# committing here keeps the payment record even if the callback fails
+			with span("persistence"):
+				if self.commit_before_callback:
+					self.unit_of_work.commit()
+				else:
+					self.unit_of_work.flush()
 
 		custom_redirect_to = None
 		if status != "Failed":
 			try:
 				if not self.process_data.get("unittest"):
-					custom_redirect_to = frappe.get_doc(
-						self.process_data.reference_doctype,
-						self.process_data.reference_docname).run_method("on_payment_authorized",
-						status)
+					with span("callback"):
+						custom_redirect_to = frappe.get_doc(
+							self.process_data.reference_doctype,
+							self.process_data.reference_docname).run_method("on_payment_authorized",
+							status)
 					request.log_action("Custom Redirect To: %s" % custom_redirect_to, "Info")
 			except Exception as ex:
 				log(frappe.get_traceback())
-				request.log_action(frappe.get_traceback(), "Error")
+				request.log_action(frappe.get_traceback, "Error")
 				raise ex
 
 		if custom_redirect_to:
 			redirect_to = custom_redirect_to
 
-		if request.status == "Captured" or request.status == "Authorized":
-			redirect_url = "/integrations/payment-success"
-			redirect_message = "Continue Shopping"
-			success = True
-		else:
-			redirect_url = "/integrations/payment-failed"
-			if request.error_msg:
-				redirect_message = "Declined due to:\n" + request.error_msg
+		with span("redirect_building"):
+			if request.status == "Captured" or request.status == "Authorized":
+				redirect_url = "/integrations/payment-success"
+				redirect_message = "Continue Shopping"
+				success = True
 			else:
-				redirect_message = "Declined"
-			success = False
-
-		params = []
-		if redirect_to:
-			# Fixes issue where system passes a relative url for orders
-			if redirect_to == "orders":
-				redirect_to = "/orders"
-
-			params.append(urllib.urlencode({"redirect_to": redirect_to}))
-		if redirect_message:
-			params.append(urllib.urlencode({"redirect_message": redirect_message}))
-
-		if len(params) > 0:
-			redirect_url += "?" + "&".join(params)
-
-		if not self.process_data.get("unittest"):
+				redirect_url = "/integrations/payment-failed"
+				if request.error_msg:
+					redirect_message = "Declined due to:\n" + request.error_msg
+				else:
+					redirect_message = "Declined"
+				success = False
+
+			params = []
+			if redirect_to:
+				# Fixes issue where system passes a relative url for orders
+				if redirect_to == "orders":
+					redirect_to = "/orders"
+
+				params.append(urllib.urlencode({"redirect_to": redirect_to}))
+			if redirect_message:
+				params.append(urllib.urlencode({"redirect_message": redirect_message}))
+
+			if len(params) > 0:
+				redirect_url += "?" + "&".join(params)
+
+		if persist:
 			request.log_action("Redirect To: %s" % redirect_url, "Info")
-			request.save()
-		else:
-			for l in request.log:
+			# log rows are buffered for the whole payment, write them at once
+			with span("log_persistence"):
+				request.flush_log(self.unit_of_work if self.log_in_background else None)
+
+			if self.unit_of_work.jobs:
+				# background jobs read what this payment wrote, commit it first
+				self.unit_of_work.commit()
+		elif self.process_data.get("unittest"):
+			for l in request.get_log_entries():
 				print(l.get("level") + "----------------")
 				print(l.get("log"))
 				print("")
@@ -598,8 +783,45 @@ class AuthorizeNetSettings(Document):
 		#         "status": 401
 		#     }
 
-@frappe.whitelist(allow_guest=True)
-def process(options, request_name=None):
+def get_settings_version(modified):
+	return str(get_datetime(modified))
+
+def get_settings_snapshot():
+	"""Per worker copy of AuthorizeNet Settings, its transaction key already
+	decrypted. Costs a redis lookup per call, the database is only read
+	again after the settings were saved."""
+	version = frappe.cache().get_value(SETTINGS_VERSION_KEY)
+	snapshot = _snapshots.get(frappe.local.site)
+
+	# saves bump the version before they commit, it can belong to a save
+	# still in flight or rolled back, the committed timestamp decides
+	if snapshot and snapshot.version != version and snapshot.version != get_settings_version(
+		frappe.db.get_single_value("AuthorizeNet Settings", "modified")):
+		snapshot = None
+
+	if not snapshot:
+		doc = frappe.get_doc("AuthorizeNet Settings")
+		snapshot = _snapshots[frappe.local.site] = frappe._dict({
+			"version": get_settings_version(doc.modified),
+			"doc": doc.as_dict(),
+			"settings": doc.load_settings()
+		})
+
+	if not version:
+		frappe.cache().set_value(SETTINGS_VERSION_KEY, snapshot.version)
+
+	return snapshot
+
+def get_controller():
+	"""New AuthorizeNet Settings controller built from the worker's snapshot,
+	use instead of frappe.get_doc on payment paths"""
+	snapshot = get_settings_snapshot()
+	controller = frappe.get_doc(dict(snapshot.doc))
+	controller._settings = snapshot.settings
+	return controller
+
+def get_process_data(options, request_name=None):
+	"""Merges client options with the stored AuthorizeNet Request"""
 	data = {}
 
 	# handles string json as well as dict argument
@@ -621,11 +843,143 @@ def process(options, request_name=None):
 	data.update(options)
 	data.update(request)
 
-	data = frappe.get_doc("AuthorizeNet Settings").create_request(data)
+	return data
+
+@frappe.whitelist(allow_guest=True)
+def process(options, request_name=None):
+	data = get_process_data(options, request_name)
+
+	data = get_controller().create_request(data)
 
 	frappe.db.commit()
 	return data
 
+@frappe.whitelist(allow_guest=True)
+def process_async(options, request_name=None):
+	"""Queues a payment and returns a token for get_status.
+
+	Card checks and the AuthorizeNet Request are handled right away, the
+	gateway calls and the reference doc callback run in a background job so
+	the web worker is free again immediately. Falls back to processing in
+	line unless "Process Payments in Background" is set.
+
+	Resubmitting a request that was paid returns its result, resubmitting
+	one in flight returns the token of its job. Only issued, declined and
+	failed requests are queued, and processing ones whose job token expired,
+	their job died before it could record a result.
+	"""
+	data = get_process_data(options, request_name)
+	controller = get_controller()
+
+	# cards rejected locally never reach the gateway, answer right away
+	if not controller.process_in_background or data.get("unittest") or \
+		(data.get("card_info") and validate_card_info(data.get("card_info"))):
+		result = controller.create_request(data)
+		frappe.db.commit()
+		return result
+
+	if data.get("name"):
+		# row locked until the commit below, concurrent submits queue one job
+		status = frappe.db.get_value("AuthorizeNet Request", data.get("name"), "status", for_update=True)
+
+		# a stale tab or a resubmit, don't charge again
+		if status in ("Captured", "Authorized"):
+			return controller.get_paid_result(data.get("name"))
+
+		if status not in RETRYABLE_STATUSES:
+			# already queued, answer with the job in flight
+			token = frappe.cache().get_value(PAYMENT_TOKEN_KEY.format(data.get("name")))
+			if token:
+				return dict(get_status(token), token=token)
+
+			# killed or timed out long ago, it is queued again below
+			frappe.log_error("Requeueing {0}, its payment job never finished".format(data.get("name")),
+				"AuthorizeNet stale payment")
+
+		request = frappe.get_doc("AuthorizeNet Request", data.get("name"))
+	else:
+		request = controller.build_authorizenet_request(commit=False, **{ \
+			key: data[key] for key in REQUEST_FIELDS })
+		data["name"] = request.name
+
+	request.db_set("status", "Processing", update_modified=False)
+
+	token = frappe.generate_hash(length=20)
+	set_payment_status(token, {"status": "Queued", "request_name": request.name})
+	frappe.cache().set_value(PAYMENT_TOKEN_KEY.format(request.name), token,
+		expires_in_sec=PAYMENT_STATUS_TTL)
+	frappe.db.commit()
+
+	# card details sit in the job queue until the job runs, keep them encrypted
+	frappe.enqueue("authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings.process_queued_payment",
+		token=token, data=encrypt(json.dumps(data, default=json_handler)))
+
+	return {"token": token, "status": "Queued"}
+
+def process_queued_payment(token, data):
+	"""Background half of process_async"""
+	data = json.loads(decrypt(data))
+	set_payment_status(token, {"status": "Processing", "request_name": data.get("name")})
+
+	try:
+		result = get_controller().create_request(data)
+		frappe.db.commit()
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(frappe.get_traceback(), "AuthorizeNet background payment failed")
+
+		# don't leave the request looking like it is still in flight
+		if frappe.db.get_value("AuthorizeNet Request", data.get("name"), "status") == "Processing":
+			frappe.db.set_value("AuthorizeNet Request", data.get("name"), "status", "Error")
+			frappe.db.commit()
+
+		result = {
+			"status": "Failed",
+			"error": "There was an internal error processing your payment. Please try again later."
+		}
+
+	result.update({"token": token, "request_name": data.get("name")})
+	set_payment_status(token, result)
+	frappe.publish_realtime("authorizenet_payment_status", result, user=frappe.session.user)
+
+def set_payment_status(token, status):
+	frappe.cache().set_value(PAYMENT_STATUS_KEY.format(token), status,
+		expires_in_sec=PAYMENT_STATUS_TTL)
+
+@frappe.whitelist()
+def get_stored_payments(start=0):
+	"""Renders the session user's next page of stored payments"""
+	contact = get_identity().contact
+	stored_payments, has_more = get_stored_payment_summaries(contact.name if contact else None, start)
+
+	return {
+		"html": frappe.render_template(STORED_PAYMENT_ITEMS_TEMPLATE, {
+			"stored_payments": stored_payments
+		}) if stored_payments else "",
+		"has_more": has_more
+	}
+
+def get_circuit_breaker():
+	settings = get_controller().get_settings()
+	return CircuitBreaker(settings.gateway_url, error_rate=settings.breaker_error_rate,
+		min_calls=settings.breaker_min_calls, cooldown=settings.breaker_cooldown)
+
+@frappe.whitelist()
+def get_circuit_breaker_state():
+	frappe.only_for("System Manager")
+	return get_circuit_breaker().get_state()
+
+@frappe.whitelist()
+def reset_circuit_breaker():
+	frappe.only_for("System Manager")
+	get_circuit_breaker().reset()
+
+@frappe.whitelist(allow_guest=True)
+def get_status(token):
+	"""Status of a payment queued by process_async, final once status is
+	neither Queued nor Processing"""
+	return frappe.cache().get_value(PAYMENT_STATUS_KEY.format(token)) or {"status": "Unknown"}
+
 @frappe.whitelist()
 def get_service_details():
 	return """
@@ -0,0 +1,304 @@
+"""
+Concurrent charges against stored payment profiles, for billing runs.
+
+	summary = charge_stored_payments([{
+		"customer_id": "1505000001",
+		"payment_id": "1504000001",
+		"amount": 19.99,
+		"order_id": "SINV-00001"
+	}, ...], run_id="2017-09")
+
+Gateway calls run on a bounded thread pool. Every charge is checkpointed
+under the run id as Pending right before it is sent and again with its
+result as soon as that arrives. Checkpoints are AuthorizeNet Batch Charge
+rows, committed right away so they outlive the worker and redis. Running
+again with the same run id skips charges that already have a result, so
+an interrupted run can be resumed without charging anyone twice. Charges
+still Pending were in flight when the run stopped, they are looked up among the customer's transactions and
+only sent again if the gateway never got them.
+"""
+
+from __future__ import unicode_literals, absolute_import
+import frappe
+from frappe.utils import now
+from multiprocessing.pool import ThreadPool
+import hashlib
+import Queue
+import json
+import socket
+import sys
+import time
+
+import xml.etree.cElementTree as E
+
+from authorize import AuthorizeResponseError, AuthorizeInvalidError, AuthorizeConnectionError
+from authorizenet.gateway import get_gateway
+from authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings import \
+	stored_payment_profile, get_controller
+
+DEFAULT_MAX_WORKERS = 8
+CHECKPOINT_DOCTYPE = "AuthorizeNet Batch Charge"
+
+# results that are never charged again when a run is resumed, "Unknown"
+# means the gateway may have charged the card before the connection failed
+FINAL_STATUSES = ("Captured", "Unknown")
+# checkpoint of a charge that was sent but has no result yet
+PENDING = "Pending"
+
+# gateway statuses of charges that went through, or that were refused
+CHARGED_STATUSES = ("settledSuccessfully", "capturedPendingSettlement")
+REFUSED_STATUSES = ("generalError", "voided", "expired", "failedReview", "communicationError")
+
+def charge_stored_payments(charges, run_id=None, max_workers=DEFAULT_MAX_WORKERS, retry_failed=False):
+	"""Charges stored payment profiles concurrently.
+
+	Each charge needs customer_id, payment_id, amount and a unique order_id
+	and may set email and description. Returns a throughput and latency
+	summary, per charge results are available from get_batch_charge_results.
+	Declined and errored charges are retried on resume when retry_failed is
+	set, captured and unknown ones never are. Pending charges are looked up
+	on the gateway first, ones that can't be looked up are left Pending for
+	the next resume.
+	"""
+	run_id = run_id or frappe.generate_hash(length=10)
+	controller = get_controller()
+	settings = controller.get_settings()
+
+	# one warm connection per worker thread
+	settings.pool_size = max(settings.pool_size, max_workers)
+	gateway = get_gateway(settings)
+
+	done = get_batch_charge_results(run_id)
+	skipped = 0
+	reconciled = 0
+	unresolved = 0
+	pending = []
+	queued = set()
+	for charge in charges:
+		charge = frappe._dict(charge)
+		previous = done.get(charge.order_id)
+		if previous and previous.get("status") == PENDING and charge.order_id not in queued:
+			# in flight when the run stopped, the card may have been charged
+			try:
+				previous = find_charge(gateway, charge)
+			except (AuthorizeResponseError, AuthorizeConnectionError, socket.error):
+				unresolved += 1
+				skipped += 1
+				continue
+
+			if previous:
+				reconciled += 1
+				set_checkpoint(run_id, previous)
+
+		if charge.order_id in queued or \
+			(previous and (previous.get("status") in FINAL_STATUSES or not retry_failed)):
+			skipped += 1
+			continue
+
+		queued.add(charge.order_id)
+
+		transaction_data = controller.build_transaction_data(charge.order_id, charge.amount,
+			charge.email, charge.description)
+		transaction_data.update(stored_payment_profile(charge.customer_id, charge.payment_id))
+		pending.append((charge.order_id, transaction_data))
+
+	stats = frappe._dict({"Captured": 0, "Declined": 0, "Error": 0, "Unknown": 0})
+	latencies = []
+	start = time.time()
+
+	def before_charge(item):
+		set_checkpoint(run_id, {"order_id": item[0], "status": PENDING})
+
+	for result in run_concurrently(lambda item: run_charge(gateway, *item), pending, max_workers,
+		before=before_charge):
+		# results come back on this thread, the only one using the database
+		set_checkpoint(run_id, result)
+		stats[result["status"]] += 1
+		latencies.append(result["latency"])
+
+	elapsed = time.time() - start
+
+	return {
+		"run_id": run_id,
+		"total": len(pending) + skipped,
+		"processed": len(pending),
+		"skipped": skipped,
+		"reconciled": reconciled,
+		"unresolved": unresolved,
+		"captured": stats.Captured,
+		"declined": stats.Declined,
+		"errors": stats.Error,
+		"unknown": stats.Unknown,
+		"elapsed": elapsed,
+		"throughput": len(pending) / elapsed if elapsed else 0,
+		"latency": summarize_latencies(latencies)
+	}
+
+def run_concurrently(func, items, max_workers=DEFAULT_MAX_WORKERS, before=None):
+	"""Maps func over items on a bounded thread pool, yields results in the
+	order they finish. At most max_workers items are in flight, before is
+	called with each one on the caller's thread right before it is handed
+	to the pool. func must not touch the database or the cache, results
+	are meant to be persisted by the caller's thread."""
+	pool = ThreadPool(max_workers)
+	results = Queue.Queue()
+	items = iter(items)
+	in_flight = 0
+
+	def run(item):
+		try:
+			results.put((func(item), None))
+		except Exception:
+			results.put((None, sys.exc_info()))
+
+	try:
+		while True:
+			for item in items:
+				if before:
+					before(item)
+
+				pool.apply_async(run, (item,))
+				in_flight += 1
+				if in_flight == max_workers:
+					break
+
+			if not in_flight:
+				break
+
+			result, exc_info = results.get()
+			in_flight -= 1
+			if exc_info:
+				raise exc_info[0], exc_info[1], exc_info[2]
+
+			yield result
+	finally:
+		pool.close()
+		pool.join()
+
+def run_charge(gateway, order_id, transaction_data):
+	"""Runs a single sale, never raises so one bad charge can't stop a run"""
+	return run_transaction(order_id, gateway.transaction.sale, transaction_data)
+
+def run_transaction(order_id, call, *args):
+	"""Runs a single gateway transaction call, never raises. The result's
+	status is Captured, Declined, Error or Unknown when the gateway may
+	have acted on the call before the connection failed."""
+	start = time.time()
+	result = {"order_id": order_id}
+
+	try:
+		response = call(*args)
+		result.update({
+			"status": "Captured",
+			"transaction_id": response.transaction_response.trans_id
+		})
+	except AuthorizeResponseError as ex:
+		result.update({"status": "Declined", "error": str(ex), "code": ex.code})
+		try:
+			result["transaction_id"] = ex.full_response.transaction_response.trans_id
+		except (KeyError, AttributeError):
+			pass
+	except (AuthorizeConnectionError, socket.error) as ex:
+		result.update({"status": "Unknown", "error": str(ex)})
+	except AuthorizeInvalidError as ex:
+		result.update({"status": "Error", "error": str(ex.asdict())})
+	except Exception as ex:
+		result.update({"status": "Error", "error": "[UNEXPECTED ERROR]: {0}".format(ex)})
+
+	result["latency"] = time.time() - start
+	return result
+
+def find_charge(gateway, charge):
+	"""Result of a charge the gateway got, found by order_id among the
+	customer's latest transactions, or None if it never got it"""
+	request = gateway._base_request("getTransactionListForCustomerRequest")
+	E.SubElement(request, "customerProfileId").text = charge.customer_id
+	E.SubElement(request, "customerPaymentProfileId").text = charge.payment_id
+	sorting = E.SubElement(request, "sorting")
+	E.SubElement(sorting, "orderBy").text = "submitTimeUTC"
+	E.SubElement(sorting, "orderDescending").text = "true"
+	paging = E.SubElement(request, "paging")
+	E.SubElement(paging, "limit").text = "1000"
+	E.SubElement(paging, "offset").text = "1"
+
+	for transaction in gateway._make_call(request).get("transactions") or []:
+		if transaction.get("invoice_number") != charge.order_id:
+			continue
+
+		status = transaction.transaction_status
+		if status in CHARGED_STATUSES:
+			status = "Captured"
+		elif status == "declined":
+			status = "Declined"
+		elif status in REFUSED_STATUSES:
+			status = "Error"
+		else:
+			# held for review and the like, leave it to a person
+			status = "Unknown"
+
+		return {
+			"order_id": charge.order_id,
+			"status": status,
+			"transaction_id": transaction.trans_id,
+			"gateway_status": transaction.transaction_status,
+			"latency": 0
+		}
+
+def set_checkpoint(run_id, result):
+	"""Records the latest result of a charge and commits it, a Pending one
+	has to be stored before its charge is sent"""
+	timestamp = now()
+	user = frappe.session.user
+
+	frappe.db.sql("""insert into `tab{0}` (name, creation, modified, owner, modified_by,
+			docstatus, idx, run_id, order_id, status, transaction_id, result)
+		values (%s, %s, %s, %s, %s, 0, 0, %s, %s, %s, %s, %s)
+		on duplicate key update modified=values(modified), modified_by=values(modified_by),
+			status=values(status), transaction_id=values(transaction_id), result=values(result)""".format(
+		CHECKPOINT_DOCTYPE), (get_checkpoint_name(run_id, result["order_id"]), timestamp, timestamp,
+		user, user, run_id, result["order_id"], result["status"], result.get("transaction_id"),
+		json.dumps(result)))
+	frappe.db.commit()
+
+def get_checkpoint_name(run_id, order_id):
+	# one row per charge of a run, order ids can be as long as a name
+	return hashlib.md5("{0}\n{1}".format(run_id, order_id).encode("utf-8")).hexdigest()
+
+def percentile(values, pct):
+	"""Nearest rank percentile of an already sorted list"""
+	if not values:
+		return 0
+
+	rank = int(round(pct / 100.0 * (len(values) - 1)))
+	return values[rank]
+
+def summarize_latencies(latencies):
+	latencies = sorted(latencies)
+	return {
+		"p50": percentile(latencies, 50),
+		"p90": percentile(latencies, 90),
+		"p99": percentile(latencies, 99),
+		"max": latencies[-1] if latencies else 0
+	}
+
+def get_batch_charge_results(run_id):
+	"""Checkpointed results of a run keyed by order_id"""
+	rows = frappe.db.sql("""select order_id, result from `tab{0}`
+		where run_id=%s""".format(CHECKPOINT_DOCTYPE), run_id)
+
+	return {order_id: json.loads(result) for order_id, result in rows}
+
+@frappe.whitelist()
+def enqueue_batch_charge(charges, run_id=None, max_workers=DEFAULT_MAX_WORKERS, retry_failed=0):
+	"""Starts a batch charge in the long queue, returns the run id to
+	resume it or fetch its results with"""
+	frappe.only_for("System Manager")
+
+	if isinstance(charges, basestring):
+		charges = json.loads(charges)
+
+	run_id = run_id or frappe.generate_hash(length=10)
+	frappe.enqueue("authorizenet.batch_charge.charge_stored_payments", queue="long", timeout=6 * 60 * 60,
+		charges=charges, run_id=run_id, max_workers=int(max_workers), retry_failed=int(retry_failed))
+
+	return run_id
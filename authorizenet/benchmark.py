@@ -0,0 +1,303 @@
+"""
+Benchmarks for the process() payment pipeline, driven against the mock gateway.
+
+	bench --site test_site execute authorizenet.benchmark.run \\
+		--kwargs "{'payments': 200, 'save': 'benchmark.json'}"
+
+	# later, on another commit
+	bench --site test_site execute authorizenet.benchmark.run \\
+		--kwargs "{'payments': 200, 'baseline': 'benchmark.json'}"
+
+Reports, in milliseconds, the time spent in every phase of a payment
+(contact lookup, request creation, address building, gateway call, stored
+payment creation, persistence, callback, redirect building and log
+persistence), throughput at increasing concurrency and allocations per
+payment. With a baseline, phases and throughput that got worse by more
+than tolerance are listed as regressions.
+
+Payments are made by a user created for the run, with a contact of its
+own, so stored payments never touch a real customer. Every payment is
+committed like a real one and deleted again with that user when the run
+ends, use a test site.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+import frappe
+import gc
+import json
+import time
+from multiprocessing import Pool
+
+from authorizenet.metrics import SpanCollector
+from authorizenet.gateway import clear_gateways
+from authorizenet.mock_gateway import start_mock_gateway
+from authorizenet.batch_charge import percentile
+from authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings import process
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+DEFAULT_CONCURRENCY = (1, 2, 4, 8)
+DEFAULT_LATENCY = "lognormal:0.05,0.3"
+BENCHMARK_USER = "authorizenet-benchmark-{0}@example.com"
+
+def run(payments=100, concurrency=DEFAULT_CONCURRENCY, latency=DEFAULT_LATENCY,
+	store_payments=True, save=None, baseline=None, tolerance=0.1):
+	"""Runs the benchmark and returns its report.
+
+	save writes the report as json, baseline compares it with a report
+	saved earlier.
+	"""
+	run_id = frappe.generate_hash(length=6)
+	server = start_mock_gateway(latency=latency)
+	fixtures = setup_fixtures(run_id, store_payments)
+
+	# every worker, forked ones included, sends its calls to the mock
+	frappe.local.conf.authorizenet_gateway_url = server.url
+	# background jobs would skip the mock and outlive cleanup, store
+	# payments in line so the stored_payment phase times the whole step
+	frappe.flags.authorizenet_store_payments_inline = True
+
+	try:
+		report = {
+			"timestamp": time.time(),
+			"payments": payments,
+			"latency": latency,
+			"phases": run_phases(payment_options(run_id, "phases", payments, fixtures)),
+			"allocations": run_allocations(payment_options(run_id, "alloc", min(payments, 20), fixtures)),
+			# concurrent workers would race to create the same customer, skip storing
+			"concurrency": [run_concurrent(payment_options(run_id, "c{0}".format(level), payments, fixtures,
+				store_payments=False), level) for level in concurrency]
+		}
+	finally:
+		frappe.local.conf.pop("authorizenet_gateway_url", None)
+		frappe.flags.authorizenet_store_payments_inline = False
+		server.stop()
+		cleanup(fixtures)
+
+	if baseline:
+		with open(baseline) as f:
+			report["regressions"] = compare(report, json.load(f), tolerance)
+
+	if save:
+		with open(save, "w") as f:
+			json.dump(report, f, indent=1, sort_keys=True)
+
+	print_report(report)
+	return report
+
+def setup_fixtures(run_id, store_payments):
+	"""Reference doc for the payments and a user with a contact to make
+	them as, the session switches to that user until cleanup"""
+	user = frappe.get_doc({
+		"doctype": "User",
+		"email": BENCHMARK_USER.format(run_id),
+		"first_name": "AuthorizeNet Benchmark",
+		"send_welcome_email": 0
+	}).insert(ignore_permissions=True)
+
+	fixtures = frappe._dict({
+		"reference": frappe.get_doc({
+			"doctype": "ToDo",
+			"description": "AuthorizeNet benchmark"
+		}).insert(ignore_permissions=True),
+		"store_payments": store_payments,
+		"session_user": frappe.session.user,
+		"user": user,
+		"contact": frappe.get_doc({
+			"doctype": "Contact",
+			"first_name": "AuthorizeNet Benchmark",
+			"email_id": user.email,
+			"user": user.name
+		}).insert(ignore_permissions=True)
+	})
+
+	frappe.db.commit()
+	frappe.set_user(user.name)
+	return fixtures
+
+def payment_options(run_id, batch, count, fixtures, store_payments=True):
+	store_payment = 1 if store_payments and fixtures.store_payments else 0
+	return [{
+		"amount": 10 + i % 100 / 100.0,
+		"currency": "USD",
+		"order_id": "BENCH-{0}-{1}-{2}".format(run_id, batch, i),
+		"title": "AuthorizeNet benchmark",
+		"description": "AuthorizeNet benchmark",
+		"payer_email": "benchmark@example.com",
+		"payer_name": "Benchmark Payer",
+		"reference_doctype": "ToDo",
+		"reference_docname": fixtures.reference.name,
+		"card_info": {
+			"name_on_card": "Benchmark Payer",
+			"card_number": "4111111111111111",
+			"exp_month": "01",
+			"exp_year": str(time.localtime().tm_year + 2),
+			"card_code": "123",
+			"store_payment": store_payment
+		},
+		"billing_info": {
+			"address_1": "5555 5th Road",
+			"address_2": "",
+			"city": "Orlando",
+			"state": "FL",
+			"pincode": "32801",
+			"country": "United States"
+		}
+	} for i in range(count)]
+
+def run_phases(options):
+	"""Per phase timings of payments processed one at a time"""
+	with SpanCollector() as timings:
+		for payment in options:
+			process(payment)
+
+	return {phase: summarize(durations) for phase, durations in timings.durations.items()}
+
+def run_allocations(options):
+	"""Objects left behind and, where tracemalloc exists, peak memory per payment"""
+	process(options[0])
+
+	retained = []
+	peaks = []
+	for payment in options[1:]:
+		gc.collect()
+		gc.disable()
+		try:
+			# with collection off the generation 0 count only ever grows
+			before = gc.get_count()[0]
+			if tracemalloc:
+				tracemalloc.start()
+
+			process(payment)
+
+			if tracemalloc:
+				peaks.append(tracemalloc.get_traced_memory()[1])
+				tracemalloc.stop()
+
+			retained.append(gc.get_count()[0] - before)
+		finally:
+			gc.enable()
+
+	return {
+		"objects_per_payment": sum(retained) / float(len(retained)) if retained else 0,
+		"peak_kb_per_payment": sum(peaks) / 1024.0 / len(peaks) if peaks else None
+	}
+
+def run_concurrent(options, workers):
+	"""Throughput of payments processed by workers separate processes"""
+	user = frappe.session.user
+
+	# forked workers must not share the database connection
+	frappe.db.commit()
+	frappe.db.close()
+	pool = Pool(workers, initializer=init_worker,
+		initargs=(frappe.local.site, frappe.local.sites_path, user,
+			frappe.local.conf.authorizenet_gateway_url))
+	frappe.connect()
+	frappe.set_user(user)
+
+	try:
+		start = time.time()
+		latencies = sorted(pool.map(timed_process, options))
+		elapsed = time.time() - start
+	finally:
+		pool.close()
+		pool.join()
+
+	return {
+		"workers": workers,
+		"payments_per_second": len(options) / elapsed,
+		"latency": summarize(latencies)
+	}
+
+def init_worker(site, sites_path, user, gateway_url):
+	# inherited connections belong to the parent
+	frappe.local.db = None
+	clear_gateways()
+
+	frappe.init(site=site, sites_path=sites_path, force=True)
+	frappe.connect()
+	frappe.set_user(user)
+	frappe.local.conf.authorizenet_gateway_url = gateway_url
+
+def timed_process(payment):
+	start = time.time()
+	process(payment)
+	return time.time() - start
+
+def summarize(durations):
+	durations = sorted(durations)
+	return {
+		"count": len(durations),
+		"mean": sum(durations) * 1000 / len(durations) if durations else 0,
+		"p50": percentile(durations, 50) * 1000,
+		"p90": percentile(durations, 90) * 1000,
+		"p99": percentile(durations, 99) * 1000
+	}
+
+def compare(report, baseline, tolerance=0.1):
+	"""Phases whose p50 and concurrency levels whose throughput got worse
+	than baseline by more than tolerance"""
+	regressions = []
+
+	for phase, stats in report["phases"].items():
+		before = baseline.get("phases", {}).get(phase)
+		if before and before["p50"] and stats["p50"] > before["p50"] * (1 + tolerance):
+			regressions.append({"phase": phase, "p50": stats["p50"], "baseline": before["p50"]})
+
+	before = {level["workers"]: level for level in baseline.get("concurrency", [])}
+	for level in report["concurrency"]:
+		base = before.get(level["workers"])
+		if base and level["payments_per_second"] < base["payments_per_second"] * (1 - tolerance):
+			regressions.append({"workers": level["workers"],
+				"payments_per_second": level["payments_per_second"],
+				"baseline": base["payments_per_second"]})
+
+	return regressions
+
+def cleanup(fixtures):
+	"""Deletes everything the benchmark payments wrote"""
+	frappe.set_user(fixtures.session_user)
+	reference = fixtures.reference.name
+	requests = frappe.db.sql_list("""select name from `tabAuthorizeNet Request`
+		where reference_doctype='ToDo' and reference_docname=%s""", reference)
+
+	if requests:
+		frappe.db.sql("""delete from `tabAuthorizeNet Request Log` where parent in ({0})""".format(
+			", ".join(["%s"] * len(requests))), requests)
+		frappe.db.sql("""delete from `tabAuthorizeNet Request` where name in ({0})""".format(
+			", ".join(["%s"] * len(requests))), requests)
+
+	frappe.db.sql("""delete from `tabIntegration Request`
+		where reference_doctype='ToDo' and reference_docname=%s""", reference)
+
+	for name in frappe.get_all("AuthorizeNet Users", filters={"contact": fixtures.contact.name}):
+		frappe.delete_doc("AuthorizeNet Users", name.name, ignore_permissions=True)
+
+	frappe.delete_doc("Contact", fixtures.contact.name, ignore_permissions=True)
+	frappe.delete_doc("User", fixtures.user.name, ignore_permissions=True, force=True)
+	frappe.delete_doc("ToDo", reference, ignore_permissions=True)
+	frappe.db.commit()
+
+def print_report(report):
+	print("{0:<20}{1:>8}{2:>10}{3:>10}{4:>10}".format("phase (ms)", "count", "mean", "p50", "p99"))
+	for phase, stats in sorted(report["phases"].items()):
+		print("{0:<20}{1:>8}{2:>10.2f}{3:>10.2f}{4:>10.2f}".format(phase, stats["count"],
+			stats["mean"], stats["p50"], stats["p99"]))
+
+	print("")
+	for level in report["concurrency"]:
+		print("{0:>3} workers: {1:8.2f} payments/s, p50 {2:.1f} ms, p99 {3:.1f} ms".format(
+			level["workers"], level["payments_per_second"], level["latency"]["p50"], level["latency"]["p99"]))
+
+	allocations = report["allocations"]
+	print("")
+	print("objects retained per payment: {0:.0f}".format(allocations["objects_per_payment"]))
+	if allocations["peak_kb_per_payment"] is not None:
+		print("peak memory per payment: {0:.1f} KB".format(allocations["peak_kb_per_payment"]))
+
+	for regression in report.get("regressions", []):
+		print("REGRESSION: {0}".format(json.dumps(regression, sort_keys=True)))
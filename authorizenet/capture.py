@@ -0,0 +1,168 @@
+"""
+Bulk capture of payments authorized at checkout, see the Authorize Only
+transaction type of AuthorizeNet Settings.
+
+	summary = capture_authorized_payments()
+
+	# or only some, e.g. the orders that shipped today
+	summary = capture_authorized_payments(["0f3c9a1b2d", ...])
+
+AuthorizeNet Requests in Authorized status are captured in batches of
+batch_size, each batch concurrently on the batch charge thread pool. Every
+request is updated as soon as its capture returns: captured ones move to
+Captured, their Integration Request to Completed and their reference doc
+gets on_payment_captured(). Captures the gateway declines move to Error.
+Ones that failed on the way, or here before they were sent, stay
+Authorized for the next run and are counted as unknown or errors.
+
+The reference doc already got on_payment_authorized("Authorized") at
+checkout, it is not called again. on_payment_captured() runs once per
+request, only for the run that moves it out of Authorized.
+"""
+
+from __future__ import unicode_literals, absolute_import
+import frappe
+import json
+import time
+
+from authorizenet.gateway import get_gateway
+from authorizenet.batch_charge import run_concurrently, run_transaction, summarize_latencies, \
+	DEFAULT_MAX_WORKERS
+from authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings import get_controller
+
+DEFAULT_BATCH_SIZE = 200
+
+# reason code of a capture repeated after its response got lost
+ALREADY_CAPTURED = "311"
+
+def capture_authorized_payments(request_names=None, max_workers=DEFAULT_MAX_WORKERS,
+	batch_size=DEFAULT_BATCH_SIZE):
+	"""Captures authorized requests, all of them or only request_names,
+	and returns a summary of the run"""
+	controller = get_controller()
+	settings = controller.get_settings()
+
+	# one warm connection per worker thread
+	settings.pool_size = max(settings.pool_size, max_workers)
+	gateway = get_gateway(settings)
+
+	stats = frappe._dict({"Captured": 0, "Declined": 0, "Error": 0, "Unknown": 0})
+	hook_errors = 0
+	latencies = []
+	start = time.time()
+	last_name = ""
+
+	while True:
+		requests = get_authorized_requests(last_name, batch_size, request_names)
+		if not requests:
+			break
+
+		last_name = requests[-1].name
+		by_name = {request.name: request for request in requests}
+
+		for result in run_concurrently(lambda request: run_capture(gateway, request), requests, max_workers):
+			# results come back on this thread, the only one using the database
+			if not update_request(by_name[result["request"]], result, controller.log_level):
+				hook_errors += 1
+
+			stats[result["status"]] += 1
+			latencies.append(result["latency"])
+
+		if len(requests) < batch_size:
+			break
+
+	elapsed = time.time() - start
+	processed = sum(stats.values())
+
+	return {
+		"processed": processed,
+		"captured": stats.Captured,
+		"declined": stats.Declined,
+		"errors": stats.Error,
+		"unknown": stats.Unknown,
+		"hook_errors": hook_errors,
+		"elapsed": elapsed,
+		"throughput": processed / elapsed if elapsed else 0,
+		"latency": summarize_latencies(latencies)
+	}
+
+def get_authorized_requests(after, limit, request_names=None):
+	"""Next page of authorized requests, paged by name so requests that
+	stay Authorized are not fetched again"""
+	conditions = ""
+	values = [after]
+	if request_names:
+		conditions = " and name in ({0})".format(", ".join(["%s"] * len(request_names)))
+		values.extend(request_names)
+
+	return frappe.db.sql("""select name, transaction_id, amount, order_id,
+			reference_doctype, reference_docname
+		from `tabAuthorizeNet Request`
+		where status='Authorized' and name > %s{0}
+		order by name limit {1}""".format(conditions, int(limit)), values, as_dict=True)
+
+def run_capture(gateway, request):
+	result = run_transaction(request.order_id, gateway.transaction.settle,
+		request.transaction_id, request.amount)
+	result["request"] = request.name
+
+	if result["status"] == "Declined" and result.get("code") == ALREADY_CAPTURED:
+		result["status"] = "Captured"
+
+	return result
+
+def update_request(row, result, log_level):
+	"""Records a capture result, returns False if the reference doc's
+	capture hook failed"""
+	# locked until committed, concurrent runs see the result of this one
+	if frappe.db.get_value("AuthorizeNet Request", row.name, "status", for_update=True) != "Authorized":
+		frappe.db.commit()
+		return True
+
+	request = frappe.get_doc("AuthorizeNet Request", row.name)
+	request.max_log_level(log_level)
+	request.log_action(result, "Debug")
+
+	if result["status"] == "Captured":
+		request.log_action("Captured", "Info")
+		request.db_set("status", "Captured", update_modified=False)
+		frappe.db.sql("""update `tabIntegration Request` set status='Completed'
+			where integration_request_service='AuthorizeNet' and status='Authorized'
+				and reference_doctype=%s and reference_docname=%s""",
+			(row.reference_doctype, row.reference_docname))
+	elif result["status"] != "Declined":
+		# left Authorized, the authorization still stands at the gateway and
+		# capturing twice is refused by it
+		request.log_action("Capture failed, will be retried: {0}".format(result["error"]), "Error")
+	else:
+		request.log_action("Capture declined: {0}".format(result["error"]), "Error")
+		request.db_set("error_msg", result["error"], update_modified=False)
+		request.db_set("status", "Error", update_modified=False)
+
+	request.flush_log()
+	# the payment is captured whatever the hook does next
+	frappe.db.commit()
+
+	if result["status"] != "Captured" or not row.reference_doctype:
+		return True
+
+	try:
+		frappe.get_doc(row.reference_doctype, row.reference_docname).run_method("on_payment_captured")
+		frappe.db.commit()
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(frappe.get_traceback(), "AuthorizeNet capture hook failed")
+		return False
+
+	return True
+
+@frappe.whitelist()
+def enqueue_capture(request_names=None, max_workers=DEFAULT_MAX_WORKERS):
+	"""Starts capturing authorized payments in the long queue"""
+	frappe.only_for("System Manager")
+
+	if isinstance(request_names, basestring):
+		request_names = json.loads(request_names)
+
+	frappe.enqueue("authorizenet.capture.capture_authorized_payments", queue="long",
+		timeout=6 * 60 * 60, request_names=request_names, max_workers=int(max_workers))
@@ -0,0 +1,134 @@
+"""
+Circuit breaker for gateway calls, shared by every worker through redis.
+
+Calls and failures are counted in 10 second buckets. Once at least
+min_calls were made in the last minute and error_rate percent of them
+failed, the breaker opens and calls fail right away for cooldown seconds.
+After that a single trial call is let through, its outcome closes the
+breaker or opens it again.
+
+Only transport failures count: connection errors, timeouts and HTTP 5xx.
+Declines and validation errors mean the gateway is up.
+
+Keys are made when the breaker is built, on a thread with a site. After
+that it only talks to redis, so the batch charge and capture thread pools
+can use it.
+"""
+
+from __future__ import unicode_literals
+import frappe
+import time
+
+from authorize.exceptions import AuthorizeConnectionError
+
+KEY = "authorizenet:breaker:{0}:{1}"
+KEY_PARTS = ("open", "half_open", "trial", "window")
+BUCKET_SECONDS = 10
+WINDOW_BUCKETS = 6
+
+DEFAULT_ERROR_RATE = 50
+DEFAULT_MIN_CALLS = 20
+DEFAULT_COOLDOWN = 30
+
+class CircuitOpenError(AuthorizeConnectionError):
+	pass
+
+class CircuitBreaker(object):
+
+	def __init__(self, name, error_rate=DEFAULT_ERROR_RATE, min_calls=DEFAULT_MIN_CALLS,
+		cooldown=DEFAULT_COOLDOWN, trial_timeout=60):
+
+		self.name = name
+		self.error_rate = error_rate or DEFAULT_ERROR_RATE
+		self.min_calls = min_calls or DEFAULT_MIN_CALLS
+		self.cooldown = int(cooldown or DEFAULT_COOLDOWN)
+		self.trial_timeout = int(trial_timeout)
+
+		# make_key needs the site, pool threads don't have one
+		self.cache = frappe.cache()
+		self.keys = {part: self.cache.make_key(KEY.format(name, part)) for part in KEY_PARTS}
+
+	def key(self, part):
+		return self.keys[part]
+
+	def check(self):
+		"""Raises CircuitOpenError unless a call may go out now"""
+		cache = self.cache
+		is_open, half_open = cache.mget([self.key("open"), self.key("half_open")])
+
+		if is_open:
+			raise CircuitOpenError("Authorize.Net is failing, calls are paused for up to {0} seconds".format(
+				self.cooldown))
+
+		# one trial call at a time decides whether the gateway is back
+		if half_open and not cache.set(self.key("trial"), 1, nx=True, ex=self.trial_timeout):
+			raise CircuitOpenError("Authorize.Net is failing, waiting for a trial call to finish")
+
+	def record(self, success):
+		cache = self.cache
+
+		if cache.get(self.key("half_open")):
+			if success:
+				self.reset()
+			else:
+				self.trip()
+			return
+
+		bucket = int(time.time() // BUCKET_SECONDS)
+		pipe = cache.pipeline(transaction=False)
+		pipe.hincrby(self.key("window"), "{0}:{1}".format(bucket, "ok" if success else "fail"), 1)
+		pipe.expire(self.key("window"), BUCKET_SECONDS * WINDOW_BUCKETS * 2)
+		pipe.execute()
+
+		if not success:
+			calls, failures = self.get_window()
+			if calls >= self.min_calls and failures * 100.0 / calls >= self.error_rate:
+				self.trip()
+
+	def get_window(self):
+		"""(calls, failures) over the last minute"""
+		oldest = int(time.time() // BUCKET_SECONDS) - WINDOW_BUCKETS + 1
+		calls = failures = 0
+
+		# plain counters, skip the wrapper's unpickling hgetall
+		window = self.cache.execute_command("HGETALL", self.key("window")) or {}
+		for field, count in window.items():
+			bucket, outcome = field.split(":")
+			if int(bucket) >= oldest:
+				calls += int(count)
+				if outcome == "fail":
+					failures += int(count)
+
+		return calls, failures
+
+	def trip(self):
+		cache = self.cache
+		pipe = cache.pipeline(transaction=False)
+		pipe.set(self.key("open"), int(time.time()), ex=self.cooldown)
+		# stays half open after the cooldown until a trial call succeeds
+		pipe.set(self.key("half_open"), 1, ex=self.cooldown * 20)
+		pipe.delete(self.key("trial"), self.key("window"))
+		pipe.execute()
+
+	def reset(self):
+		self.cache.delete(self.key("open"), self.key("half_open"), self.key("trial"), self.key("window"))
+
+	def get_state(self):
+		cache = self.cache
+		opened, half_open = cache.mget([self.key("open"), self.key("half_open")])
+		calls, failures = self.get_window()
+
+		if opened:
+			state = "Open"
+		elif half_open:
+			state = "Half Open"
+		else:
+			state = "Closed"
+
+		return {
+			"state": state,
+			"calls": calls,
+			"failures": failures,
+			"error_rate": round(failures * 100.0 / calls, 1) if calls else 0,
+			"retry_in": cache.ttl(self.key("open")) if opened else 0
+		}
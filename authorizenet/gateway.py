@@ -0,0 +1,290 @@
+"""
+Pooled keep-alive transport for Authorize.Net API calls.
+
+py-authorize opens a new HTTPS connection, and so pays a full TLS handshake,
+for every call. GatewayAPI is a drop in py-authorize client that sends its
+XML through a per worker pool of keep-alive connections instead:
+
+	gateway = get_gateway(settings)
+	result = gateway.transaction.sale(transaction_data)
+
+Clients are cached per endpoint and credentials, so every payment handled
+by a worker reuses the same warm connections. Calls that are safe to repeat
+are retried with backoff and, see circuit_breaker, a gateway that keeps
+failing is left alone for a while.
+"""
+
+from __future__ import absolute_import
+import httplib
+import random
+import socket
+import ssl
+import threading
+import time
+import urlparse
+from Queue import LifoQueue, Empty, Full
+
+import xml.etree.cElementTree as E
+
+import authorize
+from authorize.apis.authorize_api import AuthorizeAPI
+from authorize.configuration import Configuration
+from authorize.exceptions import AuthorizeConnectionError, AuthorizeResponseError
+from authorize.response_parser import parse_response
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 2
+
+# retry delays grow from BACKOFF_BASE up to BACKOFF_CAP seconds
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 2
+
+# pooled connections idle for longer than this are assumed closed by the
+# server and dropped instead of reused
+IDLE_TIMEOUT = 15
+
+# TLS session tickets can only be handed to new sockets on python 3.6+
+SUPPORTS_TLS_SESSIONS = hasattr(ssl.SSLSocket, "session")
+
+class RequestNotSent(Exception):
+	"""Connecting failed, the gateway never saw the request"""
+
+def backoff(attempt):
+	"""Full jitter, spreads retries of many workers apart"""
+	return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+class PooledHTTPSConnection(httplib.HTTPSConnection):
+	"""HTTPS connection that resumes the pool's last TLS session"""
+
+	def __init__(self, host, port, pool, **kwargs):
+		httplib.HTTPSConnection.__init__(self, host, port, context=pool.ssl_context, **kwargs)
+		self.pool = pool
+
+	def connect(self):
+		if not SUPPORTS_TLS_SESSIONS:
+			return httplib.HTTPSConnection.connect(self)
+
+		sock = socket.create_connection((self.host, self.port), self.timeout, self.source_address)
+		self.sock = self.pool.ssl_context.wrap_socket(sock,
+			server_hostname=self.host, session=self.pool.tls_session)
+		self.pool.tls_session = self.sock.session
+
+class ConnectionPool(object):
+	"""Keep-alive connections to a single gateway endpoint.
+
+	Connections are handed out last in first out so the warmest one is
+	reused, at most pool_size idle connections are kept around.
+	"""
+
+	def __init__(self, url, pool_size=DEFAULT_POOL_SIZE,
+		connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+
+		# httplib mixes these into the raw request, keep them byte strings
+		parsed = urlparse.urlparse(str(url))
+		self.url = url
+		self.scheme = parsed.scheme
+		self.host = parsed.hostname
+		self.port = parsed.port
+		self.path = parsed.path or "/"
+		self.connect_timeout = connect_timeout
+		self.read_timeout = read_timeout
+		self.idle = LifoQueue(maxsize=pool_size)
+		self.ssl_context = ssl.create_default_context() if self.scheme == "https" else None
+		self.tls_session = None
+
+	def new_connection(self):
+		if self.scheme == "https":
+			return PooledHTTPSConnection(self.host, self.port, self, timeout=self.connect_timeout)
+
+		return httplib.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+
+	def get_connection(self):
+		while True:
+			try:
+				conn, last_used = self.idle.get_nowait()
+			except Empty:
+				return self.new_connection(), False
+
+			if time.time() - last_used < IDLE_TIMEOUT:
+				return conn, True
+
+			conn.close()
+
+	def release(self, conn):
+		try:
+			self.idle.put_nowait((conn, time.time()))
+		except Full:
+			conn.close()
+
+	def connect(self, conn):
+		"""Opens conn unless it already is, failures mean nothing was sent"""
+		if conn.sock is None:
+			try:
+				conn.connect()
+			except (socket.error, httplib.HTTPException) as ex:
+				conn.close()
+				raise RequestNotSent(ex)
+
+	def post(self, body, headers):
+		"""Sends a POST to the endpoint, returns (status, body)"""
+		conn, reused = self.get_connection()
+		self.connect(conn)
+
+		try:
+			conn.request("POST", self.path, body, headers)
+		except (socket.error, httplib.HTTPException):
+			conn.close()
+			if not reused:
+				raise
+
+			# the server dropped an idle connection before the request
+			# went out, nothing was sent so it is safe to try once more
+			conn = self.new_connection()
+			self.connect(conn)
+			conn.request("POST", self.path, body, headers)
+
+		try:
+			conn.sock.settimeout(self.read_timeout)
+			response = conn.getresponse()
+			data = response.read()
+		except:
+			conn.close()
+			raise
+
+		if response.will_close:
+			conn.close()
+		else:
+			self.release(conn)
+
+		return response.status, data
+
+	def close(self):
+		while True:
+			try:
+				conn, last_used = self.idle.get_nowait()
+			except Empty:
+				return
+
+			conn.close()
+
+class GatewayAPI(AuthorizeAPI):
+	"""py-authorize client that sends its calls through a ConnectionPool.
+
+	Failed calls are retried up to max_retries times with jittered
+	exponential backoff, but only when repeating them can't charge twice:
+	reads, and anything that failed before it was sent. A circuit breaker,
+	when given, fails calls fast while the gateway is down.
+	"""
+
+	def __init__(self, config, pool, max_retries=DEFAULT_MAX_RETRIES, breaker=None):
+		super(GatewayAPI, self).__init__(config)
+		self.pool = pool
+		self.max_retries = max_retries
+		self.breaker = breaker
+
+	def _make_call(self, call):
+		"""Make a call to the Authorize.net server with the XML."""
+		body = E.tostring(call)
+		# get* requests only read, everything else may move money
+		safe = call.tag.startswith("get")
+
+		for attempt in range(self.max_retries + 1):
+			if self.breaker:
+				self.breaker.check()
+
+			try:
+				status, data = self.pool.post(body, {"Content-Type": "text/xml"})
+			except RequestNotSent as ex:
+				error, retry = "Error connecting to {0}: {1}".format(self.pool.url, ex), True
+			except (socket.error, httplib.HTTPException) as ex:
+				error, retry = "Error connecting to {0}: {1}".format(self.pool.url, ex), safe
+			else:
+				if status < 500:
+					break
+
+				error, retry = "Error processing XML request. HTTP {0}".format(status), safe
+
+			if self.breaker:
+				self.breaker.record(False)
+
+			if not retry or attempt == self.max_retries:
+				raise AuthorizeConnectionError(error)
+
+			time.sleep(backoff(attempt))
+
+		if self.breaker:
+			self.breaker.record(True)
+
+		if status != 200:
+			raise AuthorizeConnectionError("Error processing XML request. HTTP {0}".format(status))
+
+		response_json = parse_response(E.fromstring(data))
+
+		# Exception handling for transaction response errors.
+		try:
+			error = response_json.transaction_response.errors[0]
+			raise AuthorizeResponseError(error.error_code, error.error_text, response_json)
+		except KeyError:
+			pass
+
+		# Throw an exception for invalid calls. This makes error handling easier.
+		if response_json.messages[0].result_code != 'Ok':
+			error = response_json.messages[0].message
+			raise AuthorizeResponseError(error.code, error.text, response_json)
+
+		return response_json
+
+_gateways = {}
+_gateways_lock = threading.Lock()
+
+def get_gateway(settings):
+	"""Per worker GatewayAPI for the given settings.
+
+	settings needs api_login_id, api_transaction_key and gateway_url and
+	may set pool_size, connect_timeout, read_timeout, max_retries and, to
+	guard calls with a CircuitBreaker, circuit_breaker, breaker_error_rate,
+	breaker_min_calls and breaker_cooldown.
+	"""
+	key = (settings.gateway_url, settings.api_login_id, settings.api_transaction_key,
+		settings.pool_size, settings.connect_timeout, settings.read_timeout, settings.max_retries,
+		settings.circuit_breaker, settings.breaker_error_rate, settings.breaker_min_calls,
+		settings.breaker_cooldown)
+
+	gateway = _gateways.get(key)
+	if gateway:
+		return gateway
+
+	with _gateways_lock:
+		if key not in _gateways:
+			pool = ConnectionPool(settings.gateway_url,
+				pool_size=settings.pool_size or DEFAULT_POOL_SIZE,
+				connect_timeout=settings.connect_timeout or DEFAULT_CONNECT_TIMEOUT,
+				read_timeout=settings.read_timeout or DEFAULT_READ_TIMEOUT)
+
+			config = Configuration(settings.gateway_url, settings.api_login_id,
+				settings.api_transaction_key)
+
+			breaker = None
+			if settings.circuit_breaker:
+				# imported here, the transport itself does not need frappe
+				from authorizenet.circuit_breaker import CircuitBreaker
+				breaker = CircuitBreaker(settings.gateway_url, error_rate=settings.breaker_error_rate,
+					min_calls=settings.breaker_min_calls, cooldown=settings.breaker_cooldown)
+
+			max_retries = DEFAULT_MAX_RETRIES if settings.max_retries is None else settings.max_retries
+			_gateways[key] = GatewayAPI(config, pool, max_retries=max_retries, breaker=breaker)
+
+	return _gateways[key]
+
+def clear_gateways():
+	"""Closes every pooled connection, the next call reconnects"""
+	with _gateways_lock:
+		for gateway in _gateways.values():
+			gateway.pool.close()
+
+		_gateways.clear()
+
+def get_environment_url(use_sandbox):
+	return authorize.Environment.TEST if use_sandbox else authorize.Environment.PRODUCTION
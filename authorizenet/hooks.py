@@ -78,34 +78,25 @@ website_route_rules = [
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"*": {
-# 		"on_update": "method",
-# 		"on_cancel": "method",
-# 		"on_trash": "method"
-#	}
-# }
+doc_events = {
+	"Country": {
+		"on_update": "authorizenet.utils.clear_country_options",
+		"on_trash": "authorizenet.utils.clear_country_options",
+		"after_rename": "authorizenet.utils.clear_country_options"
+	},
+	"System Settings": {
+		"on_update": "authorizenet.utils.clear_country_options"
+	}
+}
 
 # Scheduled Tasks
 # ---------------
 
-# scheduler_events = {
-# 	"all": [
-# 		"authorizenet.tasks.all"
-# 	],
-# 	"daily": [
-# 		"authorizenet.tasks.daily"
-# 	],
-# 	"hourly": [
-# 		"authorizenet.tasks.hourly"
-# 	],
-# 	"weekly": [
-# 		"authorizenet.tasks.weekly"
-# 	]
-# 	"monthly": [
-# 		"authorizenet.tasks.monthly"
-# 	]
-# }
+scheduler_events = {
+	"daily": [
+		"authorizenet.tasks.daily"
+	]
+}
 
 # Testing
 # -------
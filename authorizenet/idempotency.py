@@ -0,0 +1,131 @@
+"""
+Collapses duplicate payment submissions into a single gateway call.
+
+Submissions are locked on a key derived from the request name, order id,
+currency and amount, so double clicks, reloads and other tabs paying the
+same request all contend for the same lock. The first submission takes a
+short lived lock in redis and processes the payment, duplicates wait for
+its result instead of charging again:
+
+	with IdempotencyGuard(key, lock_ttl, client_key) as guard:
+		if guard.result is None:
+			guard.set_result(process_payment())
+
+	return guard.result
+
+A key sent by the client never replaces the derived one, results are also
+cached under it, its currency and amount so a retry of the same submission
+finds its result but a changed amount is charged.
+
+Only successful results are kept, a declined card can be retried with the
+same key right away.
+"""
+
+from __future__ import unicode_literals
+import frappe
+from frappe.utils import flt
+import hashlib
+import time
+
+RESULT_KEY = "authorizenet:idempotency:{0}"
+LOCK_KEY = "authorizenet:idempotency:{0}:lock"
+
+# how long successful results answer duplicates
+RESULT_TTL = 15 * 60
+# how long a duplicate waits for the first submission before giving up
+WAIT_TIMEOUT = 30
+POLL_INTERVAL = 0.2
+
+SUCCESS_STATUSES = ("Completed", "Authorized")
+
+# deletes the lock only if it still belongs to the caller
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+	return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+def get_idempotency_key(data):
+	"""Lock key derived from the request, order, currency and amount"""
+	if not (data.get("order_id") and data.get("amount")):
+		return None
+
+	return hash_key("derived|{0}|{1}|{2}|{3:.2f}".format(data.get("name") or "", data.get("order_id"),
+		data.get("currency") or "", float(data.get("amount"))))
+
+def get_client_key(data):
+	"""Extra result key for the idempotency key sent by the client, if any"""
+	if not data.get("idempotency_key"):
+		return None
+
+	# scoped so nobody can read another user's result by guessing keys
+	return hash_key("client|{0}|{1}|{2}|{3:.2f}|{4}".format(frappe.session.user,
+		data.get("order_id") or "", data.get("currency") or "", flt(data.get("amount")),
+		data.get("idempotency_key")))
+
+def hash_key(key):
+	return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+class IdempotencyGuard(object):
+	"""Holds the lock for key while the block runs, see the module docstring.
+
+	guard.result is set on entry when another submission already finished
+	or failed to finish in time, the block must not process the payment then.
+	Results are looked up and stored under client_key too when given.
+	"""
+
+	def __init__(self, key, lock_ttl, client_key=None, wait_timeout=WAIT_TIMEOUT):
+		self.key = key
+		self.result_keys = [RESULT_KEY.format(k) for k in (key, client_key) if k]
+		self.lock_ttl = int(lock_ttl)
+		self.wait_timeout = wait_timeout
+		self.token = frappe.generate_hash(length=16)
+		self.result = None
+		self.locked = False
+
+	def __enter__(self):
+		cache = frappe.cache()
+		deadline = time.time() + self.wait_timeout
+
+		while True:
+			self.result = self.get_result()
+			if self.result is not None:
+				return self
+
+			if cache.set(cache.make_key(LOCK_KEY.format(self.key)), self.token,
+				nx=True, ex=self.lock_ttl):
+				self.locked = True
+
+				# the first submission may have finished just before we locked
+				self.result = self.get_result()
+				return self
+
+			if time.time() > deadline:
+				self.result = {
+					"status": "Failed",
+					"error": "This payment is still being processed, please wait a moment before trying again.",
+					"recoverable": 1,
+					"redirect_to": None,
+					"authorizenet_data": {}
+				}
+				return self
+
+			time.sleep(POLL_INTERVAL)
+
+	def get_result(self):
+		for key in self.result_keys:
+			result = frappe.cache().get_value(key)
+			if result is not None:
+				return result
+
+	def set_result(self, result):
+		self.result = result
+		if result and result.get("status") in SUCCESS_STATUSES:
+			for key in self.result_keys:
+				frappe.cache().set_value(key, result, expires_in_sec=RESULT_TTL)
+
+	def __exit__(self, *exc_info):
+		if self.locked:
+			cache = frappe.cache()
+			cache.eval(RELEASE_SCRIPT, 1, cache.make_key(LOCK_KEY.format(self.key)), self.token)
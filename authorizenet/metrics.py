@@ -0,0 +1,232 @@
+"""
+Timing spans for the payment pipeline.
+
+	with span("gateway_call"):
+		result = gateway.transaction.sale(transaction_data)
+
+Spans cost next to nothing unless a collector listens on the current thread:
+
+	with SpanCollector() as timings:
+		process(options)
+
+	timings.durations	# {"gateway_call": [0.21], ...}
+
+PaymentMetrics collects the spans of a single payment and hands them,
+labelled with the payment's outcome, to a sink. StatsDSink sends them as
+UDP timers and counters, PrometheusSink keeps histograms in redis, shared
+by every worker, and serves them from the prometheus endpoint.
+"""
+
+from __future__ import unicode_literals
+import frappe
+import socket
+import threading
+import time
+
+_local = threading.local()
+
+class Span(object):
+	__slots__ = ("name", "start")
+
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, *exc_info):
+		for collector in _local.collectors:
+			collector.record(self.name, time.time() - self.start)
+
+class NullSpan(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		pass
+
+NULL_SPAN = NullSpan()
+
+def span(name):
+	"""Times the enclosed block as phase name"""
+	if not getattr(_local, "collectors", None):
+		return NULL_SPAN
+
+	return Span(name)
+
+class SpanCollector(object):
+	"""Collects span durations, in seconds, recorded on this thread while active"""
+
+	def __init__(self):
+		self.durations = {}
+
+	def record(self, name, duration):
+		self.durations.setdefault(name, []).append(duration)
+
+	def __enter__(self):
+		if not hasattr(_local, "collectors"):
+			_local.collectors = []
+
+		_local.collectors.append(self)
+		return self
+
+	def __exit__(self, *exc_info):
+		_local.collectors.remove(self)
+
+# histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROMETHEUS_KEY = "authorizenet:metrics"
+DEFAULT_PREFIX = "authorizenet"
+
+class PaymentMetrics(SpanCollector):
+	"""Collects the spans of one payment and emits them once it is done.
+
+	Set outcome before leaving the block, payments that raise are reported
+	with the "Exception" outcome.
+	"""
+
+	def __init__(self, sink):
+		super(PaymentMetrics, self).__init__()
+		self.sink = sink
+		self.outcome = None
+
+	def __enter__(self):
+		self.start = time.time()
+		return super(PaymentMetrics, self).__enter__()
+
+	def __exit__(self, exc_type, *exc_info):
+		super(PaymentMetrics, self).__exit__(exc_type, *exc_info)
+		self.record("total", time.time() - self.start)
+
+		outcome = "Exception" if exc_type else (self.outcome or "Unknown")
+		try:
+			self.sink.emit(self.durations, outcome)
+		except Exception:
+			# metrics must never break a payment
+			frappe.log_error(frappe.get_traceback(), "AuthorizeNet metrics")
+
+class StatsDSink(object):
+	"""Sends timers and counters to a StatsD daemon over UDP.
+
+	Plain StatsD has no labels, the outcome becomes part of the name:
+	authorizenet.phase.gateway_call.completed
+	"""
+
+	def __init__(self, host, port=8125, prefix=DEFAULT_PREFIX):
+		self.address = (host, port)
+		self.prefix = prefix
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+	def emit(self, durations, outcome):
+		outcome = outcome.lower()
+		lines = ["{0}.payments.{1}:1|c".format(self.prefix, outcome)]
+		for phase, values in durations.items():
+			for value in values:
+				lines.append("{0}.phase.{1}.{2}:{3:.3f}|ms".format(self.prefix, phase, outcome, value * 1000))
+
+		# one datagram per payment, small enough to never fragment
+		self.sock.sendto("\n".join(lines).encode("utf-8"), self.address)
+
+class PrometheusSink(object):
+	"""Keeps counters and histograms in redis so every worker adds to the
+	same series, rendered by render_prometheus. Buckets are stored
+	cumulative, as Prometheus expects them."""
+
+	def emit(self, durations, outcome):
+		cache = frappe.cache()
+		key = cache.make_key(PROMETHEUS_KEY)
+		pipe = cache.pipeline(transaction=False)
+
+		pipe.hincrby(key, "payments|{0}".format(outcome), 1)
+		for phase, values in durations.items():
+			for value in values:
+				series = "{0}|{1}".format(phase, outcome)
+				pipe.hincrby(key, "count|" + series, 1)
+				pipe.hincrbyfloat(key, "sum|" + series, value)
+				for bucket in BUCKETS:
+					if value <= bucket:
+						pipe.hincrby(key, "bucket|{0}|{1}".format(series, bucket), 1)
+
+		pipe.execute()
+
+class NullSink(object):
+	def emit(self, durations, outcome):
+		pass
+
+NULL_SINK = NullSink()
+_sinks = {}
+
+def get_sink(kind, host=None, port=None, prefix=None):
+	"""Per worker sink for the given configuration, kind is "StatsD",
+	"Prometheus" or empty for none"""
+	if not kind:
+		return NULL_SINK
+
+	key = (kind, host, port, prefix)
+	if key not in _sinks:
+		if kind == "StatsD":
+			_sinks[key] = StatsDSink(host or "127.0.0.1", port or 8125, prefix or DEFAULT_PREFIX)
+		elif kind == "Prometheus":
+			_sinks[key] = PrometheusSink()
+		else:
+			raise ValueError("Unknown metrics sink: {0}".format(kind))
+
+	return _sinks[key]
+
+def render_prometheus(prefix=DEFAULT_PREFIX):
+	"""Prometheus text exposition of the series kept by PrometheusSink"""
+	cache = frappe.cache()
+	# values are plain numbers, skip the wrapper's unpickling hgetall
+	values = cache.execute_command("HGETALL", cache.make_key(PROMETHEUS_KEY)) or {}
+
+	payments = {}
+	series = {}
+	for field, value in values.items():
+		parts = field.split("|")
+		if parts[0] == "payments":
+			payments[parts[1]] = int(value)
+			continue
+
+		stats = series.setdefault((parts[1], parts[2]), {"count": 0, "sum": 0.0, "buckets": {}})
+		if parts[0] == "count":
+			stats["count"] = int(value)
+		elif parts[0] == "sum":
+			stats["sum"] = float(value)
+		else:
+			stats["buckets"][float(parts[3])] = int(value)
+
+	lines = [
+		"# HELP {0}_payments_total Payments processed by outcome.".format(prefix),
+		"# TYPE {0}_payments_total counter".format(prefix)
+	]
+	for outcome, count in sorted(payments.items()):
+		lines.append('{0}_payments_total{{outcome="{1}"}} {2}'.format(prefix, outcome, count))
+
+	lines.extend([
+		"# HELP {0}_phase_seconds Time spent in each phase of a payment.".format(prefix),
+		"# TYPE {0}_phase_seconds histogram".format(prefix)
+	])
+	for (phase, outcome), stats in sorted(series.items()):
+		labels = 'phase="{0}",outcome="{1}"'.format(phase, outcome)
+		for bucket in BUCKETS:
+			lines.append('{0}_phase_seconds_bucket{{{1},le="{2}"}} {3}'.format(prefix, labels,
+				bucket, stats["buckets"].get(bucket, 0)))
+
+		lines.append('{0}_phase_seconds_bucket{{{1},le="+Inf"}} {2}'.format(prefix, labels, stats["count"]))
+		lines.append('{0}_phase_seconds_sum{{{1}}} {2}'.format(prefix, labels, stats["sum"]))
+		lines.append('{0}_phase_seconds_count{{{1}}} {2}'.format(prefix, labels, stats["count"]))
+
+	return "\n".join(lines) + "\n"
+
+@frappe.whitelist()
+def prometheus():
+	"""Scrape endpoint for the Prometheus sink"""
+	frappe.only_for("System Manager")
+
+	prefix = frappe.db.get_single_value("AuthorizeNet Settings", "metrics_prefix") or DEFAULT_PREFIX
+	frappe.response.update({
+		"type": "txt",
+		"doctype": "metrics",
+		"result": render_prometheus(prefix)
+	})
@@ -0,0 +1,511 @@
+"""
+Local stand-in for the Authorize.Net XML API, for offline tests and load runs.
+
+Speaks the subset of the API this app uses: createTransaction (sales, auth
+only and prior auth captures), createCustomerProfileFromTransaction,
+createCustomerPaymentProfile, getSettledBatchList, getTransactionList and
+getTransactionListForCustomer.
+Transactions are settled into a batch by MockGateway.settle_batch(). Start it from the command line:
+
+	python -m authorizenet.mock_gateway --port 8099 --latency lognormal:0.25,0.5
+
+or from a test:
+
+	server = start_mock_gateway(latency="fixed:0.05", decline_rate=0.1)
+	settings.gateway_url = server.url
+	...
+	server.stop()
+
+and point the integration at it with the Gateway URL field of AuthorizeNet
+Settings.
+
+Like the sandbox, billing zip codes decide the outcome of a sale: 46282
+is declined and 46203 is held as an error. Charging the same card the same
+amount for the same invoice within duplicate_window seconds fails with
+error 11, storing the same card twice on a customer fails with E00039.
+
+Latency specs are one of "fixed:seconds", "uniform:low,high",
+"normal:mean,stddev" or "lognormal:median,sigma". Failures can be injected
+at random with error_rate (HTTP 500), drop_rate (connection closed without
+a response) and hang_rate (no response for hang_seconds), or forced for
+the next calls with MockGateway.inject().
+"""
+
+import argparse
+import math
+import random
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import xml.etree.cElementTree as E
+
+XMLNS = "AnetApi/xml/v1/schema/AnetApiSchema.xsd"
+
+DECLINED_ZIP = "46282"
+ERROR_ZIP = "46203"
+DEFAULT_DUPLICATE_WINDOW = 120
+DEFAULT_HANG_SECONDS = 60
+
+FAILURE_MODES = ("error", "drop", "hang")
+
+APPROVED = ("1", "1", "This transaction has been approved.")
+DECLINED = ("2", "2", "This transaction has been declined.")
+ERRORED = ("3", "6", "The credit card number is invalid.")
+DUPLICATE = ("3", "11", "A duplicate transaction has been submitted.")
+NOT_FOUND = ("3", "16", "The transaction cannot be found.")
+OVER_AUTHORIZED = ("3", "47", "The amount requested for settlement cannot be greater than the original amount authorized.")
+ALREADY_CAPTURED = ("3", "311", "This transaction has already been captured.")
+
+def parse_latency(spec):
+	"""Returns a function drawing delays, in seconds, from a latency spec"""
+	if not spec:
+		return lambda rng: 0
+
+	if callable(spec):
+		return spec
+
+	kind, _, args = spec.partition(":")
+	args = [float(a) for a in args.split(",") if a]
+
+	if kind == "fixed":
+		return lambda rng: args[0]
+	elif kind == "uniform":
+		return lambda rng: rng.uniform(args[0], args[1])
+	elif kind == "normal":
+		return lambda rng: max(0, rng.normalvariate(args[0], args[1]))
+	elif kind == "lognormal":
+		mu = math.log(args[0])
+		return lambda rng: rng.lognormvariate(mu, args[1])
+
+	raise ValueError("Unknown latency distribution: {0}".format(spec))
+
+def strip_namespaces(element):
+	for child in element.iter():
+		child.tag = child.tag.rpartition("}")[2]
+
+	return element
+
+class MockGateway(object):
+	"""In memory gateway state and API handlers, shared by all connections"""
+
+	def __init__(self, latency=None, decline_rate=0, error_rate=0, drop_rate=0, hang_rate=0,
+		hang_seconds=DEFAULT_HANG_SECONDS, duplicate_window=DEFAULT_DUPLICATE_WINDOW,
+		api_login_id=None, api_transaction_key=None, seed=None):
+
+		self.latency = parse_latency(latency)
+		self.decline_rate = decline_rate
+		self.error_rate = error_rate
+		self.drop_rate = drop_rate
+		self.hang_rate = hang_rate
+		self.hang_seconds = hang_seconds
+		self.duplicate_window = duplicate_window
+		self.api_login_id = api_login_id
+		self.api_transaction_key = api_transaction_key
+
+		self.lock = threading.Lock()
+		self.rng = random.Random(seed)
+		self.injected = []
+		self.calls = {}
+
+		self.next_id = 60000000000
+		self.transactions = {}
+		self.batches = []
+		self.customers = {}
+		self.recent_charges = {}
+
+	def inject(self, mode, count=1):
+		"""Forces the next count calls to fail with mode, one of FAILURE_MODES"""
+		if mode not in FAILURE_MODES:
+			raise ValueError("Unknown failure mode: {0}".format(mode))
+
+		with self.lock:
+			self.injected.extend([mode] * count)
+
+	def next_failure(self):
+		"""Failure mode for the next call, if any, and its latency"""
+		with self.lock:
+			delay = self.latency(self.rng)
+
+			if self.injected:
+				return self.injected.pop(0), delay
+
+			for mode, rate in (("error", self.error_rate), ("drop", self.drop_rate),
+				("hang", self.hang_rate)):
+				if rate and self.rng.random() < rate:
+					return mode, delay
+
+		return None, delay
+
+	def settle_batch(self):
+		"""Settles charged and declined transactions into a new batch,
+		returns its id"""
+		with self.lock:
+			batch_id = self.new_id()
+			for trans_id, transaction in self.transactions.items():
+				if not transaction.get("batch_id") and (not transaction["approved"] or
+					transaction["type"] == "authCaptureTransaction" or transaction.get("captured")):
+					transaction["batch_id"] = batch_id
+
+			self.batches.append({"batch_id": batch_id, "settled": time.time()})
+
+		return batch_id
+
+	def new_id(self):
+		self.next_id += 1
+		return str(self.next_id)
+
+	def handle(self, request):
+		"""Returns the response element for a parsed request element"""
+		action = request.tag
+		with self.lock:
+			self.calls[action] = self.calls.get(action, 0) + 1
+
+		if self.api_login_id is not None and (
+			request.findtext("merchantAuthentication/name") != self.api_login_id or
+			request.findtext("merchantAuthentication/transactionKey") != self.api_transaction_key):
+			return self.error_response(action, "E00007",
+				"User authentication failed due to invalid authentication values.")
+
+		handler = getattr(self, action, None)
+		if not handler or action.startswith("_") or not action.endswith("Request"):
+			return self.error_response(action, "E00003",
+				"The element '{0}' is not supported by the mock gateway.".format(action))
+
+		with self.lock:
+			return handler(request)
+
+	def createTransactionRequest(self, request):
+		xact = request.find("transactionRequest")
+		xact_type = xact.findtext("transactionType")
+		if xact_type == "priorAuthCaptureTransaction":
+			return self.capture_transaction(request, xact)
+
+		if xact_type not in ("authCaptureTransaction", "authOnlyTransaction"):
+			return self.error_response(request.tag, "E00003",
+				"Transaction type {0} is not supported by the mock gateway.".format(xact_type))
+
+		amount = xact.findtext("amount")
+		invoice = xact.findtext("order/invoiceNumber")
+		card_number = xact.findtext("payment/creditCard/cardNumber")
+		zip_code = xact.findtext("billTo/zip")
+
+		customer_id = payment_id = xact.findtext("profile/customerProfileId")
+		if customer_id:
+			payment_id = xact.findtext("profile/paymentProfile/paymentProfileId")
+			payment = self.customers.get(customer_id, {}).get(payment_id)
+			if not payment:
+				return self.error_response(request.tag, "E00040", "The record cannot be found.")
+
+			card_number = payment["card_number"]
+			zip_code = payment["zip"]
+
+		now = time.time()
+		charge_key = (card_number, amount, invoice)
+
+		if now - self.recent_charges.get(charge_key, 0) < self.duplicate_window:
+			outcome = DUPLICATE
+		elif zip_code == DECLINED_ZIP or (self.decline_rate and self.rng.random() < self.decline_rate):
+			outcome = DECLINED
+		elif zip_code == ERROR_ZIP:
+			outcome = ERRORED
+		else:
+			outcome = APPROVED
+
+		trans_id = "0" if outcome is DUPLICATE else self.new_id()
+		if outcome is not DUPLICATE:
+			self.recent_charges[charge_key] = now
+			self.transactions[trans_id] = {
+				"type": xact_type,
+				"amount": amount,
+				"card_number": card_number,
+				"expiration_date": xact.findtext("payment/creditCard/expirationDate"),
+				"zip": zip_code,
+				"invoice": invoice,
+				"profile": (customer_id, payment_id) if customer_id else None,
+				"submitted": now,
+				"approved": outcome is APPROVED
+			}
+
+		return self.transaction_response(request.tag, outcome, trans_id, card_number)
+
+	def capture_transaction(self, request, xact):
+		"""Captures an approved auth only transaction"""
+		trans_id = xact.findtext("refTransId")
+		transaction = self.transactions.get(trans_id)
+		amount = xact.findtext("amount")
+
+		if not transaction or not transaction["approved"] or transaction["type"] != "authOnlyTransaction":
+			outcome = NOT_FOUND
+		elif transaction.get("captured"):
+			outcome = ALREADY_CAPTURED
+		elif amount and float(amount) > float(transaction["amount"]):
+			outcome = OVER_AUTHORIZED
+		else:
+			outcome = APPROVED
+			transaction["captured"] = amount or transaction["amount"]
+
+		return self.transaction_response(request.tag, outcome, trans_id,
+			transaction["card_number"] if transaction else None)
+
+	def transaction_response(self, action, outcome, trans_id, card_number):
+		response_code, reason_code, reason_text = outcome
+		if outcome is APPROVED:
+			response = self.new_response(action)
+		else:
+			response = self.new_response(action, "Error", "E00027", "The transaction was unsuccessful.")
+
+		result = E.SubElement(response, "transactionResponse")
+		E.SubElement(result, "responseCode").text = response_code
+		E.SubElement(result, "authCode").text = "MOCK01" if outcome is APPROVED else ""
+		E.SubElement(result, "avsResultCode").text = "Y"
+		E.SubElement(result, "cvvResultCode").text = "P"
+		E.SubElement(result, "transId").text = trans_id
+		E.SubElement(result, "accountNumber").text = "XXXX" + (card_number or "")[-4:]
+
+		if outcome is APPROVED:
+			message = E.SubElement(E.SubElement(result, "messages"), "message")
+			E.SubElement(message, "code").text = reason_code
+			E.SubElement(message, "description").text = reason_text
+		else:
+			error = E.SubElement(E.SubElement(result, "errors"), "error")
+			E.SubElement(error, "errorCode").text = reason_code
+			E.SubElement(error, "errorText").text = reason_text
+
+		return response
+
+	def createCustomerProfileFromTransactionRequest(self, request):
+		transaction = self.transactions.get(request.findtext("transId"))
+		if not transaction or not transaction["approved"]:
+			return self.error_response(request.tag, "E00040", "The record cannot be found.")
+
+		if transaction.get("customer_id"):
+			return self.error_response(request.tag, "E00039",
+				"A duplicate record with ID {0} already exists.".format(transaction["customer_id"]))
+
+		customer_id = self.new_id()
+		payment_id = self.new_id()
+		transaction["customer_id"] = customer_id
+		self.customers[customer_id] = {
+			payment_id: {
+				"card_number": transaction["card_number"],
+				"zip": transaction["zip"]
+			}
+		}
+
+		response = self.new_response(request.tag)
+		E.SubElement(response, "customerProfileId").text = customer_id
+		E.SubElement(E.SubElement(response, "customerPaymentProfileIdList"), "numericString").text = payment_id
+		E.SubElement(response, "customerShippingAddressIdList")
+		return response
+
+	def createCustomerPaymentProfileRequest(self, request):
+		customer_id = request.findtext("customerProfileId")
+		payments = self.customers.get(customer_id)
+		if payments is None:
+			return self.error_response(request.tag, "E00040", "The record cannot be found.")
+
+		card_number = request.findtext("paymentProfile/payment/creditCard/cardNumber")
+		for payment_id, payment in payments.items():
+			if payment["card_number"] == card_number:
+				response = self.new_response(request.tag, "Error", "E00039",
+					"A duplicate customer payment profile already exists.")
+				E.SubElement(response, "customerProfileId").text = customer_id
+				E.SubElement(response, "customerPaymentProfileId").text = payment_id
+				return response
+
+		payment_id = self.new_id()
+		payments[payment_id] = {
+			"card_number": card_number,
+			"zip": request.findtext("paymentProfile/billTo/zip")
+		}
+
+		response = self.new_response(request.tag)
+		E.SubElement(response, "customerProfileId").text = customer_id
+		E.SubElement(response, "customerPaymentProfileId").text = payment_id
+		return response
+
+	def getSettledBatchListRequest(self, request):
+		response = self.new_response(request.tag)
+		batch_list = E.SubElement(response, "batchList")
+		for batch in self.batches:
+			element = E.SubElement(batch_list, "batch")
+			E.SubElement(element, "batchId").text = batch["batch_id"]
+			E.SubElement(element, "settlementTimeUTC").text = time.strftime("%Y-%m-%dT%H:%M:%SZ",
+				time.gmtime(batch["settled"]))
+			E.SubElement(element, "settlementState").text = "settledSuccessfully"
+
+		return response
+
+	def getTransactionListRequest(self, request):
+		batch_id = request.findtext("batchId")
+		transactions = sorted((trans_id, transaction) for trans_id, transaction in self.transactions.items()
+			if transaction.get("batch_id") == batch_id)
+
+		return self.transaction_list(request.tag, transactions, request)
+
+	def getTransactionListForCustomerRequest(self, request):
+		customer_id = request.findtext("customerProfileId")
+		payment_id = request.findtext("customerPaymentProfileId")
+		if customer_id not in self.customers:
+			return self.error_response(request.tag, "E00040", "The record cannot be found.")
+
+		transactions = sorted(((trans_id, transaction) for trans_id, transaction in self.transactions.items()
+			if transaction["profile"] and transaction["profile"][0] == customer_id and
+				payment_id in (None, transaction["profile"][1])),
+			reverse=request.findtext("sorting/orderDescending") == "true")
+
+		# answered like a getTransactionList call
+		return self.transaction_list("getTransactionListRequest", transactions, request)
+
+	def transaction_list(self, action, transactions, request):
+		"""One page of transaction summaries, paged like the real API"""
+		limit = int(request.findtext("paging/limit") or 1000)
+		offset = int(request.findtext("paging/offset") or 1)
+		page = transactions[(offset - 1) * limit:offset * limit]
+
+		response = self.new_response(action)
+		if page:
+			elements = E.SubElement(response, "transactions")
+			for trans_id, transaction in page:
+				element = E.SubElement(elements, "transaction")
+				E.SubElement(element, "transId").text = trans_id
+				E.SubElement(element, "submitTimeUTC").text = time.strftime("%Y-%m-%dT%H:%M:%SZ",
+					time.gmtime(transaction["submitted"]))
+				E.SubElement(element, "transactionStatus").text = self.transaction_status(transaction)
+				if transaction["invoice"]:
+					E.SubElement(element, "invoiceNumber").text = transaction["invoice"]
+				E.SubElement(element, "settleAmount").text = (transaction.get("captured") or transaction["amount"]) \
+					if transaction["approved"] else "0.00"
+
+		E.SubElement(response, "totalNumInResultSet").text = str(len(transactions))
+		return response
+
+	def transaction_status(self, transaction):
+		if not transaction["approved"]:
+			return "declined"
+
+		if transaction.get("batch_id"):
+			return "settledSuccessfully"
+
+		if transaction["type"] == "authOnlyTransaction" and not transaction.get("captured"):
+			return "authorizedPendingCapture"
+
+		return "capturedPendingSettlement"
+
+	def new_response(self, action, result_code="Ok", code="I00001", text="Successful."):
+		response = E.Element(action[:-len("Request")] + "Response" if action.endswith("Request")
+			else "ErrorResponse")
+		response.set("xmlns", XMLNS)
+
+		messages = E.SubElement(response, "messages")
+		E.SubElement(messages, "resultCode").text = result_code
+		message = E.SubElement(messages, "message")
+		E.SubElement(message, "code").text = code
+		E.SubElement(message, "text").text = text
+		return response
+
+	def error_response(self, action, code, text):
+		return self.new_response(action, "Error", code, text)
+
+class MockGatewayHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.getheader("content-length") or 0))
+		gateway = self.server.gateway
+
+		failure, delay = gateway.next_failure()
+		if failure == "drop":
+			self.close_connection = 1
+			return
+		elif failure == "hang":
+			time.sleep(gateway.hang_seconds)
+			self.close_connection = 1
+			return
+
+		if delay:
+			time.sleep(delay)
+
+		if failure == "error":
+			return self.reply(500, "Internal Server Error")
+
+		try:
+			request = strip_namespaces(E.fromstring(body))
+		except SyntaxError:
+			return self.reply(200, E.tostring(gateway.error_response("ErrorRequest", "E00003",
+				"The request could not be parsed.")))
+
+		self.reply(200, E.tostring(gateway.handle(request)))
+
+	def reply(self, status, body):
+		self.send_response(status)
+		self.send_header("Content-Type", "text/xml; charset=utf-8")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		if self.server.verbose:
+			BaseHTTPRequestHandler.log_message(self, *args)
+
+class MockGatewayServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, gateway, verbose=False):
+		HTTPServer.__init__(self, address, MockGatewayHandler)
+		self.gateway = gateway
+		self.verbose = verbose
+		self.url = "http://{0}:{1}/xml/v1/request.api".format(*self.server_address)
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+def start_mock_gateway(host="127.0.0.1", port=0, verbose=False, **options):
+	"""Serves a MockGateway from a background thread, port 0 picks a free one.
+
+	options are passed on to MockGateway, the returned server has the
+	gateway as server.gateway and its endpoint as server.url.
+	"""
+	server = MockGatewayServer((host, port), MockGateway(**options), verbose=verbose)
+
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+
+	return server
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description="Mock Authorize.Net gateway")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8099)
+	parser.add_argument("--latency", help="e.g. fixed:0.1, uniform:0.05,0.3, lognormal:0.25,0.5")
+	parser.add_argument("--decline-rate", type=float, default=0)
+	parser.add_argument("--error-rate", type=float, default=0)
+	parser.add_argument("--drop-rate", type=float, default=0)
+	parser.add_argument("--hang-rate", type=float, default=0)
+	parser.add_argument("--hang-seconds", type=float, default=DEFAULT_HANG_SECONDS)
+	parser.add_argument("--duplicate-window", type=float, default=DEFAULT_DUPLICATE_WINDOW)
+	parser.add_argument("--seed", type=int)
+	parser.add_argument("--verbose", action="store_true")
+	args = parser.parse_args(args)
+
+	gateway = MockGateway(latency=args.latency, decline_rate=args.decline_rate,
+		error_rate=args.error_rate, drop_rate=args.drop_rate, hang_rate=args.hang_rate,
+		hang_seconds=args.hang_seconds, duplicate_window=args.duplicate_window, seed=args.seed)
+
+	server = MockGatewayServer((args.host, args.port), gateway, verbose=args.verbose)
+	print("Mock Authorize.Net gateway listening on {0}".format(server.url))
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+if __name__ == "__main__":
+	main()
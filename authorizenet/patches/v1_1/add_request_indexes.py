@@ -0,0 +1,10 @@
+from __future__ import unicode_literals
+import frappe
+
+def execute():
+	# search_index fields get their index when the doctype is synced
+	frappe.reload_doc("authorizenet", "doctype", "authorizenet_request")
+	frappe.reload_doc("authorizenet", "doctype", "authorizenet_request_log")
+
+	from authorizenet.authorizenet.doctype.authorizenet_request.authorizenet_request import on_doctype_update
+	on_doctype_update()
@@ -0,0 +1,12 @@
+from __future__ import unicode_literals
+import frappe
+
+def execute():
+	# fields added since the settings were last saved have no value yet,
+	# they read as 0 and would turn retries and the circuit breaker off
+	frappe.reload_doc("authorizenet", "doctype", "authorizenet_settings")
+
+	saved = frappe.db.get_singles_dict("AuthorizeNet Settings")
+	for df in frappe.get_meta("AuthorizeNet Settings").fields:
+		if df.default is not None and df.fieldname not in saved:
+			frappe.db.set_value("AuthorizeNet Settings", None, df.fieldname, df.default)
@@ -0,0 +1,241 @@
+"""
+Reconciles settled Authorize.Net transactions with AuthorizeNet Requests.
+
+	summary = reconcile_gateway("2017-09-01", "2017-09-30", report="september.csv")
+
+	# or from a transaction export of the Merchant Interface
+	summary = reconcile_file("transactions.csv", report="september.csv")
+
+Transactions are streamed, from the gateway one settled batch and page at a
+time or from the export one row at a time, and looked up by transaction id
+CHUNK_SIZE at a time, so memory use stays flat however many transactions
+there are. Every mismatch is written to the report as it is found:
+
+	missing		no AuthorizeNet Request has the transaction id
+	amount		the settled amount differs from the request amount
+	status		the gateway status disagrees with the request status
+
+Refunds, chargebacks and other transactions this app doesn't create are
+skipped.
+"""
+
+from __future__ import unicode_literals, absolute_import
+import frappe
+import csv
+import itertools
+from datetime import timedelta
+
+import xml.etree.cElementTree as E
+from frappe.utils import flt, getdate
+
+from authorizenet.gateway import get_gateway
+from authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings import get_controller
+
+# largest page getTransactionList serves
+PAGE_SIZE = 1000
+CHUNK_SIZE = 500
+# longest range getSettledBatchList accepts
+MAX_DAYS = 31
+# mismatches returned with the summary, the report has all of them
+MAX_SAMPLES = 100
+
+# request statuses consistent with each gateway status, keyed by
+# normalize_status so export labels ("Settled Successfully") match too
+EXPECTED_STATUSES = {
+	"settledsuccessfully": ("Captured",),
+	"capturedpendingsettlement": ("Captured",),
+	"authorizedpendingcapture": ("Authorized",),
+	"declined": ("Error", "Declined"),
+	"voided": ("Error", "Declined"),
+	"expired": ("Error", "Declined"),
+	"failedreview": ("Error", "Declined"),
+	"generalerror": ("Error",)
+}
+
+SKIPPED_STATUSES = ("refundsettledsuccessfully", "refundpendingsettlement", "returneditem",
+	"chargeback", "chargebackreversal")
+
+# transaction export columns by transaction field
+FILE_COLUMNS = {
+	"transaction_id": "Transaction ID",
+	"status": "Transaction Status",
+	"amount": "Settlement Amount",
+	"invoice_number": "Invoice Number"
+}
+
+REPORT_FIELDS = ("issue", "transaction_id", "request", "gateway_status", "request_status",
+	"gateway_amount", "request_amount", "invoice_number", "batch_id")
+
+def reconcile_gateway(from_date, to_date, report=None):
+	"""Reconciles the batches settled between from_date and to_date"""
+	gateway = get_gateway(get_controller().get_settings())
+	return reconcile(gateway_transactions(gateway, from_date, to_date), report)
+
+def reconcile_file(path, report=None, delimiter=","):
+	"""Reconciles a transaction export, comma separated unless delimiter says otherwise"""
+	return reconcile(file_transactions(path, delimiter=delimiter), report)
+
+def reconcile(transactions, report=None):
+	"""Matches an iterable of transactions with requests, writes mismatches
+	to the report csv and returns a summary"""
+	summary = frappe._dict({"transactions": 0, "matched": 0, "skipped": 0,
+		"missing": 0, "amount": 0, "status": 0, "mismatches": []})
+
+	report_file = open(report, "wb") if report else None
+	try:
+		writer = None
+		if report_file:
+			writer = csv.DictWriter(report_file, REPORT_FIELDS)
+			writer.writeheader()
+
+		for chunk in chunks(transactions, CHUNK_SIZE):
+			summary.transactions += len(chunk)
+			relevant = [t for t in chunk if normalize_status(t.status) not in SKIPPED_STATUSES]
+			summary.skipped += len(chunk) - len(relevant)
+			chunk = relevant
+			requests = get_requests([t.transaction_id for t in chunk])
+
+			for transaction in chunk:
+				mismatches = compare(transaction, requests.get(transaction.transaction_id))
+				if not mismatches:
+					summary.matched += 1
+
+				for mismatch in mismatches:
+					summary[mismatch["issue"]] += 1
+					if len(summary.mismatches) < MAX_SAMPLES:
+						summary.mismatches.append(mismatch)
+
+					if writer:
+						writer.writerow({key: unicode(value if value is not None else "").encode("utf-8")
+							for key, value in mismatch.items()})
+	finally:
+		if report_file:
+			report_file.close()
+
+	return summary
+
+def compare(transaction, request):
+	"""Mismatches between a gateway transaction and its request"""
+	mismatch = {
+		"transaction_id": transaction.transaction_id,
+		"gateway_status": transaction.status,
+		"gateway_amount": transaction.amount,
+		"invoice_number": transaction.invoice_number,
+		"batch_id": transaction.batch_id
+	}
+
+	if not request:
+		return [dict(mismatch, issue="missing")]
+
+	mismatch.update({
+		"request": request.name,
+		"request_status": request.status,
+		"request_amount": request.amount
+	})
+
+	mismatches = []
+	expected = EXPECTED_STATUSES.get(normalize_status(transaction.status))
+	if expected and request.status not in expected:
+		mismatches.append(dict(mismatch, issue="status"))
+
+	# only charged transactions settle an amount
+	if expected == ("Captured",) and abs(flt(transaction.amount) - flt(request.amount)) >= 0.005:
+		mismatches.append(dict(mismatch, issue="amount"))
+
+	return mismatches
+
+def get_requests(transaction_ids):
+	"""Requests by transaction id, a single query on the indexed column"""
+	if not transaction_ids:
+		return {}
+
+	return {request.transaction_id: request for request in frappe.db.sql("""
+		select name, transaction_id, amount, status from `tabAuthorizeNet Request`
+		where transaction_id in ({0})""".format(", ".join(["%s"] * len(transaction_ids))),
+		transaction_ids, as_dict=True)}
+
+def gateway_transactions(gateway, from_date, to_date, page_size=PAGE_SIZE):
+	"""Yields the transactions of every batch settled from from_date to
+	to_date, inclusive"""
+	start = getdate(from_date)
+	end = getdate(to_date)
+	seen = set()
+
+	while start <= end:
+		window_end = min(start + timedelta(days=MAX_DAYS - 1), end)
+		response = gateway.batch.list({
+			"start": start.isoformat(),
+			"end": (window_end + timedelta(days=1)).isoformat()
+		})
+
+		for batch in response.get("batch_list") or []:
+			# batches settled right at midnight show up in both windows
+			if batch.batch_id in seen:
+				continue
+
+			seen.add(batch.batch_id)
+			for transaction in batch_transactions(gateway, batch.batch_id, page_size):
+				yield transaction
+
+		start = window_end + timedelta(days=1)
+
+def batch_transactions(gateway, batch_id, page_size=PAGE_SIZE):
+	"""Yields the transactions of a settled batch, a page at a time"""
+	page = 1
+	while True:
+		request = gateway._base_request("getTransactionListRequest")
+		E.SubElement(request, "batchId").text = batch_id
+		sorting = E.SubElement(request, "sorting")
+		E.SubElement(sorting, "orderBy").text = "submitTimeUTC"
+		E.SubElement(sorting, "orderDescending").text = "false"
+		paging = E.SubElement(request, "paging")
+		E.SubElement(paging, "limit").text = str(page_size)
+		E.SubElement(paging, "offset").text = str(page)
+
+		transactions = gateway._make_call(request).get("transactions") or []
+		for transaction in transactions:
+			yield frappe._dict({
+				"transaction_id": transaction.trans_id,
+				"status": transaction.transaction_status,
+				"amount": transaction.get("settle_amount"),
+				"invoice_number": transaction.get("invoice_number"),
+				"batch_id": batch_id
+			})
+
+		if len(transactions) < page_size:
+			break
+
+		page += 1
+
+def file_transactions(path, columns=FILE_COLUMNS, delimiter=","):
+	"""Yields the transactions of an exported csv file, one row at a time"""
+	with open(path, "rb") as f:
+		for row in csv.DictReader(f, delimiter=str(delimiter)):
+			transaction = frappe._dict({field: (row.get(column) or b"").decode("utf-8").strip()
+				for field, column in columns.items()})
+			transaction.batch_id = None
+			yield transaction
+
+def normalize_status(status):
+	return (status or "").replace(" ", "").lower()
+
+def chunks(iterable, size):
+	iterator = iter(iterable)
+	while True:
+		chunk = list(itertools.islice(iterator, size))
+		if not chunk:
+			return
+
+		yield chunk
+
+@frappe.whitelist()
+def enqueue_reconciliation(from_date, to_date):
+	"""Reconciles the batches settled in a date range in the long queue,
+	returns the private file the report is written to"""
+	frappe.only_for("System Manager")
+
+	filename = "authorizenet-reconciliation-{0}-{1}.csv".format(getdate(from_date), getdate(to_date))
+	frappe.enqueue("authorizenet.reconcile.reconcile_gateway", queue="long", timeout=6 * 60 * 60,
+		from_date=from_date, to_date=to_date, report=frappe.get_site_path("private", "files", filename))
+
+	return filename
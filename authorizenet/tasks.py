@@ -0,0 +1,104 @@
+"""
+Scheduled jobs, see scheduler_events in hooks.py.
+
+The daily job enforces the log retention set in AuthorizeNet Settings.
+Request log rows older than Keep Logs For (days) are either compacted into
+a single compressed blob on their AuthorizeNet Request (log_archive, read
+it back with request.get_archived_log()) or appended to a gzipped json
+lines file per day, and then deleted. Rows are handled in batches, each
+committed on its own, so the log table is never locked for long.
+"""
+
+from __future__ import unicode_literals, absolute_import
+import frappe
+import gzip
+import json
+import os
+import time
+from frappe.utils import cint, add_days, now_datetime, nowdate
+
+from authorizenet.authorizenet.doctype.authorizenet_request.authorizenet_request import \
+	LOG_DOCTYPE, compress_log_entries, decompress_log_entries
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_ARCHIVE_PATH = "private/authorizenet_logs"
+ARCHIVE_FILE = "authorizenet-request-log-{0}.jsonl.gz"
+# a long backlog is worked off over several days instead of one long job
+MAX_RUNTIME = 20 * 60
+
+def daily():
+	archive_request_logs()
+
+def archive_request_logs(max_runtime=MAX_RUNTIME):
+	"""Archives and deletes request log rows past the retention period,
+	returns the number of rows removed"""
+	settings = frappe.get_doc("AuthorizeNet Settings")
+	days = cint(settings.log_retention_days)
+	if days <= 0:
+		return 0
+
+	cutoff = add_days(now_datetime(), -days)
+	batch_size = cint(settings.log_retention_batch_size) or DEFAULT_BATCH_SIZE
+	deadline = time.time() + max_runtime
+	archived = 0
+
+	while time.time() < deadline:
+		rows = frappe.db.sql("""select name, parent, idx, timestamp, level, log from `tab{0}`
+			where parenttype='AuthorizeNet Request' and timestamp < %s
+			limit %s""".format(LOG_DOCTYPE), (cutoff, batch_size), as_dict=True)
+
+		if not rows:
+			break
+
+		if settings.log_archive_to == "File":
+			export_log_rows(rows, settings.log_archive_path)
+		else:
+			compact_log_rows(rows)
+
+		names = [row.name for row in rows]
+		frappe.db.sql("""delete from `tab{0}` where name in ({1})""".format(LOG_DOCTYPE,
+			", ".join(["%s"] * len(names))), names)
+		frappe.db.commit()
+
+		archived += len(rows)
+		if len(rows) < batch_size:
+			break
+
+	return archived
+
+def compact_log_rows(rows):
+	"""Merges rows into the log_archive of their requests"""
+	entries = {}
+	for row in rows:
+		entries.setdefault(row.parent, []).append({
+			"idx": row.idx,
+			"timestamp": str(row.timestamp),
+			"level": row.level,
+			"log": row.log
+		})
+
+	parents = list(entries)
+	# a request's rows can be split over batches, add to what is there
+	archives = dict(frappe.db.sql("""select name, log_archive from `tabAuthorizeNet Request`
+		where name in ({0})""".format(", ".join(["%s"] * len(parents))), parents))
+
+	for parent, new_entries in entries.items():
+		if parent not in archives:
+			# orphaned rows, nothing to keep them on
+			continue
+
+		merged = decompress_log_entries(archives[parent]) + new_entries
+		merged.sort(key=lambda entry: entry["idx"])
+		frappe.db.set_value("AuthorizeNet Request", parent, "log_archive",
+			compress_log_entries(merged), update_modified=False)
+
+def export_log_rows(rows, path=None):
+	"""Appends rows to today's archive file, one json object per line"""
+	folder = frappe.get_site_path(path or DEFAULT_ARCHIVE_PATH)
+	if not os.path.exists(folder):
+		os.makedirs(folder)
+
+	# gzip streams can be concatenated, every batch adds its own member
+	with gzip.open(os.path.join(folder, ARCHIVE_FILE.format(nowdate())), "ab") as f:
+		for row in rows:
+			f.write((json.dumps(row, default=str) + "\n").encode("utf-8"))
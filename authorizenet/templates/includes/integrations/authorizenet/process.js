@@ -75,8 +75,11 @@ frappe.integration_service.authorizenet_gateway = Class.extend({
 	form: function() {
 		var base = this;
 
+		// stored payments can be loaded later, bind through their container
+		var $stored_payments = $('#authorizenet-stored-payments-form');
+
 		// Handle removal of stored payments
-		$('.btn-stored-payment-remove').click(function() {
+		$stored_payments.on('click', '.btn-stored-payment-remove', function() {
 			var stored_payment = $(this).attr('data-id');
 			var $input = $(this).closest('.field').find('input[name="authorizednet-stored-payment"]');
 			// sanity check, only allow removing on active selection
@@ -101,7 +104,7 @@ frappe.integration_service.authorizenet_gateway = Class.extend({
 		});
 
 		// handle displaying manual payment information forms
-		$('input[name="authorizednet-stored-payment"]').change(function() {
+		$stored_payments.on('change', 'input[name="authorizednet-stored-payment"]', function() {
 			if ( $(this).val() != 'none' ) {
 				$('#authorizenet-manual-info').slideUp('slow');
 			} else {
@@ -110,6 +113,30 @@ frappe.integration_service.authorizenet_gateway = Class.extend({
 			}
 		});
 
+		// only the most recently used stored payments are rendered, fetch the rest on demand
+		$stored_payments.on('click', '.btn-stored-payments-more', function() {
+			var $btn = $(this);
+			$btn.prop('disabled', true);
+
+			frappe.call({
+				method: "authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings.get_stored_payments",
+				args: {
+					start: $btn.attr('data-start')
+				},
+				callback: function(r) {
+					var $more = $btn.closest('.authorizenet-stored-payments-more');
+					$more.before(r.message.html);
+
+					if ( r.message.has_more ) {
+						$btn.attr('data-start', $stored_payments.find('.btn-stored-payment-remove').length);
+						$btn.prop('disabled', false);
+					} else {
+						$more.remove();
+					}
+				}
+			});
+		});
+
 		// initially copy all field values on checkbox change
 		$('#authorizenet_address_same_as').change(function() {
 			var addr_src = $(this).attr('data-source');
@@ -244,8 +271,17 @@ frappe.integration_service.authorizenet_gateway = Class.extend({
 	},
 
 	_process: function(data, request_name, callback) {
+		var base = this;
+
+		// lets a retry of this submission find its result, payments are locked
+		// on the request and amount server side, see authorizenet.idempotency
+		if ( !this.idempotency_key ) {
+			this.idempotency_key = Math.random().toString(36).slice(2) + Date.now().toString(36);
+		}
+		data.idempotency_key = this.idempotency_key;
+
 		frappe.call({
-			method: "authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings.process",
+			method: "authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings.process_async",
 			freeze: 1,
 			freeze_message: "Processing Order. Please Wait...",
 			args: {
@@ -257,25 +293,17 @@ frappe.integration_service.authorizenet_gateway = Class.extend({
 			if(typeof data === "string") data = JSON.parse(data);
 			var status = xhr.statusCode().status;
 
-			var result = data;
-			if ( result.message.status == "Completed" ) {
-				callback(null, result.message);
-			} else {
-				var errors = [];
-				if ( result.message.error.constructor != Array ) {
-					errors.push(result.message.error);
-				} else {
-					errors = result.message.error;
-				}
-
-				callback({
-					errors: errors,
-					status: status,
-					recoverable: result.recoverable || false,
-					xhr: xhr,
-					textStatus: textStatus
-				}, null);
+			// payment was queued, wait for the background job
+			if ( data.message.token && base._is_pending(data.message.status) ) {
+				frappe.freeze("Processing Order. Please Wait...");
+				base._wait_for_result(data.message.token, function(result) {
+					frappe.unfreeze();
+					base._handle_result(result, status, xhr, textStatus, callback);
+				});
+				return;
 			}
+
+			base._handle_result(data.message, status, xhr, textStatus, callback);
 		})
 		.fail(function(xhr, textStatus) {
 			if(typeof data === "string") data = JSON.parse(data);
@@ -325,6 +353,89 @@ frappe.integration_service.authorizenet_gateway = Class.extend({
 
 	},
 
+	_is_pending: function(status) {
+		return status == "Queued" || status == "Processing";
+	},
+
+	_handle_result: function(result, status, xhr, textStatus, callback) {
+		// the submission is settled, the next one is a new payment. Keep the
+		// key while its outcome is unknown so a retry finds the result
+		if ( result.status != "Unknown" && !result.recoverable ) {
+			this.idempotency_key = null;
+		}
+
+		if ( result.status == "Completed" || result.status == "Authorized" ) {
+			callback(null, result);
+		} else {
+			var errors = [];
+			if ( result.error && result.error.constructor == Array ) {
+				errors = result.error;
+			} else {
+				errors.push(result.error || "Unable to process payment");
+			}
+
+			callback({
+				errors: errors,
+				status: status,
+				recoverable: result.recoverable || false,
+				xhr: xhr,
+				textStatus: textStatus
+			}, null);
+		}
+	},
+
+	/**
+	 * Polls get_status until a queued payment is done, realtime updates
+	 * short circuit the polling when available
+	 */
+	_wait_for_result: function(token, callback) {
+		var base = this;
+		var done = false;
+		var finish = function(result) {
+			if ( done ) {
+				return;
+			}
+			done = true;
+			if ( frappe.realtime && frappe.realtime.off ) {
+				frappe.realtime.off("authorizenet_payment_status", on_status);
+			}
+			callback(result);
+		};
+
+		var on_status = function(result) {
+			if ( result.token == token && !base._is_pending(result.status) ) {
+				finish(result);
+			}
+		};
+
+		if ( frappe.realtime && frappe.realtime.on ) {
+			frappe.realtime.on("authorizenet_payment_status", on_status);
+		}
+
+		var poll = function() {
+			if ( done ) {
+				return;
+			}
+
+			frappe.call({
+				method: "authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings.get_status",
+				args: { token: token },
+				callback: function(r) {
+					if ( r.message && !base._is_pending(r.message.status) ) {
+						finish(r.message);
+					} else {
+						setTimeout(poll, 1000);
+					}
+				},
+				error: function() {
+					setTimeout(poll, 2000);
+				}
+			});
+		};
+
+		setTimeout(poll, 1000);
+	},
+
 	/**
 	 * Collects all authnet fields necessary to process payment
 	 */
@@ -8,7 +8,7 @@ from frappe.utils.formatters import format_value
 import json
 from datetime import datetime
 
-from authorizenet.utils import get_authorizenet_user
+from authorizenet.utils import get_identity, get_country_options
 
 no_cache = 1
 no_sitemap = 1
@@ -38,7 +38,7 @@ def get_context(context):
         raise frappe.Redirect
 
     # list countries for billing address form
-    context["authorizenet_countries"] = frappe.get_list("Country", fields=["country_name", "name"])
+    context["authorizenet_countries"] = get_country_options()
 
     if request_name and request:
         for key in expected_keys:
@@ -50,12 +50,10 @@ def get_context(context):
         context["request_name"] = request_name
         context["year"] = datetime.today().year
 
-        # get the authorizenet user record
-        authnet_user = get_authorizenet_user()
-        print(authnet_user)
-
-        if authnet_user:
-            context["stored_payments"] = authnet_user.get("stored_payments", [])
+        # stored payment summaries, the authorizenet user doc isn't needed
+        identity = get_identity()
+        context["stored_payments"] = identity.stored_payments
+        context["stored_payments_more"] = identity.stored_payments_more
 
 
     else:
@@ -0,0 +1,53 @@
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
+# MIT License. See license.txt
+from __future__ import unicode_literals
+
+import frappe
+from contextlib import contextmanager
+from frappe.utils import now
+from authorizenet.gateway import get_gateway, clear_gateways
+from authorizenet.mock_gateway import start_mock_gateway
+
+class MockGatewayMixin(object):
+	"""Starts a mock gateway for every test and points self.gateway at it,
+	mix into a unittest.TestCase"""
+
+	gateway_settings = {}
+
+	def setUp(self):
+		super(MockGatewayMixin, self).setUp()
+		self.server = start_mock_gateway(seed=1)
+		self.gateway = self.get_gateway(**self.gateway_settings)
+
+	def tearDown(self):
+		clear_gateways()
+		self.server.stop()
+		super(MockGatewayMixin, self).tearDown()
+
+	def get_gateway(self, **settings):
+		"""Client for the mock gateway, settings override the defaults"""
+		return get_gateway(frappe._dict(dict({
+			"api_login_id": "login",
+			"api_transaction_key": "key",
+			"gateway_url": self.server.url
+		}, **settings)))
+
+	@contextmanager
+	def override_settings(self, **values):
+		"""Saves values to AuthorizeNet Settings for the duration, payment
+		paths pick them up through the settings snapshot"""
+		settings = frappe.get_doc("AuthorizeNet Settings")
+		previous = {field: settings.get(field) for field in values}
+
+		try:
+			update_settings(settings, values)
+			yield
+		finally:
+			update_settings(settings, previous)
+
+def update_settings(settings, values):
+	settings.update(values)
+	settings.modified = now()
+	settings.db_update()
+	settings.on_update()
+	frappe.db.commit()
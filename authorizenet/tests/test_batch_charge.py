@@ -0,0 +1,101 @@
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
+# MIT License. See license.txt
+from __future__ import unicode_literals
+
+import unittest
+import time
+
+import frappe
+from authorizenet.batch_charge import charge_stored_payments, get_batch_charge_results, \
+	run_concurrently, set_checkpoint, CHECKPOINT_DOCTYPE, PENDING
+from authorizenet.tests.mock_gateway_case import MockGatewayMixin
+
+class TestBatchCharge(MockGatewayMixin, unittest.TestCase):
+
+	def setUp(self):
+		super(TestBatchCharge, self).setUp()
+		self.gateway_url = frappe.local.conf.get("authorizenet_gateway_url")
+		frappe.local.conf.authorizenet_gateway_url = self.server.url
+		self.run_id = frappe.generate_hash(length=10)
+
+		result = self.gateway.transaction.sale({
+			"order": {"invoice_number": "111"},
+			"amount": 5.25,
+			"credit_card": {
+				"card_number": "4111111111111111",
+				"expiration_date": "01/{0}".format(time.localtime().tm_year + 2),
+				"card_code": "123"
+			}
+		})
+		customer = self.gateway.customer.from_transaction(result.transaction_response.trans_id)
+		self.charges = [{
+			"customer_id": customer.customer_id,
+			"payment_id": customer.payment_ids[0],
+			"amount": 5.25,
+			"email": "NuranVerkleij@example.com",
+			"order_id": "BC-{0}".format(i)
+		} for i in range(3)]
+
+	def tearDown(self):
+		frappe.db.sql("""delete from `tab{0}` where run_id=%s""".format(CHECKPOINT_DOCTYPE), self.run_id)
+		frappe.db.commit()
+		frappe.local.conf.authorizenet_gateway_url = self.gateway_url
+		super(TestBatchCharge, self).tearDown()
+
+	def get_charge_calls(self):
+		return self.server.gateway.calls.get("createTransactionRequest", 0)
+
+	def test_checkpoint_before_sending(self):
+		checkpointed = []
+		def charge(item):
+			self.assertTrue(item in checkpointed)
+			return item
+
+		self.assertEqual(sorted(run_concurrently(charge, range(10), max_workers=3,
+			before=checkpointed.append)), range(10))
+
+		summary = charge_stored_payments(self.charges, run_id=self.run_id, max_workers=2)
+		self.assertEqual(summary["captured"], 3)
+
+		results = get_batch_charge_results(self.run_id)
+		self.assertEqual(sorted(results), ["BC-0", "BC-1", "BC-2"])
+		self.assertEqual(set(r["status"] for r in results.values()), set(["Captured"]))
+
+	def test_resume_skips_results(self):
+		charge_stored_payments(self.charges[:2], run_id=self.run_id)
+		calls = self.get_charge_calls()
+
+		summary = charge_stored_payments(self.charges, run_id=self.run_id)
+		self.assertEqual(summary["skipped"], 2)
+		self.assertEqual(summary["processed"], 1)
+		self.assertEqual(self.get_charge_calls(), calls + 1)
+
+	def test_resume_reconciles_pending(self):
+		# BC-0 reached the gateway before the run stopped, BC-1 never did
+		sent = self.gateway.transaction.sale({
+			"order": {"invoice_number": "BC-0"},
+			"amount": 5.25,
+			"customer_id": self.charges[0]["customer_id"],
+			"payment_id": self.charges[0]["payment_id"]
+		})
+		for order_id in ("BC-0", "BC-1"):
+			set_checkpoint(self.run_id, {"order_id": order_id, "status": PENDING})
+		calls = self.get_charge_calls()
+
+		summary = charge_stored_payments(self.charges[:2], run_id=self.run_id)
+		self.assertEqual(summary["reconciled"], 1)
+		self.assertEqual(summary["processed"], 1)
+		self.assertEqual(self.get_charge_calls(), calls + 1)
+
+		results = get_batch_charge_results(self.run_id)
+		self.assertEqual(results["BC-0"]["status"], "Captured")
+		self.assertEqual(results["BC-0"]["transaction_id"], sent.transaction_response.trans_id)
+		self.assertEqual(results["BC-1"]["status"], "Captured")
+
+	def test_circuit_breaker(self):
+		# gateway calls run on pool threads, which have no site
+		with self.override_settings(circuit_breaker=1):
+			summary = charge_stored_payments(self.charges, run_id=self.run_id, max_workers=2)
+
+		self.assertEqual(summary["captured"], 3)
+		self.assertEqual(summary["errors"], 0)
@@ -0,0 +1,118 @@
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
+# MIT License. See license.txt
+from __future__ import unicode_literals
+
+import unittest
+import time
+
+import frappe
+from authorizenet.capture import capture_authorized_payments, update_request
+from authorizenet.tests.mock_gateway_case import MockGatewayMixin
+
+class TestCapture(MockGatewayMixin, unittest.TestCase):
+
+	def setUp(self):
+		super(TestCapture, self).setUp()
+		self.gateway_url = frappe.local.conf.get("authorizenet_gateway_url")
+		frappe.local.conf.authorizenet_gateway_url = self.server.url
+		self.requests = []
+
+	def tearDown(self):
+		for name in self.requests:
+			frappe.delete_doc("AuthorizeNet Request", name, ignore_permissions=True)
+		frappe.db.commit()
+
+		frappe.local.conf.authorizenet_gateway_url = self.gateway_url
+		super(TestCapture, self).tearDown()
+
+	def authorize(self, amount=5.25):
+		"""Authorized request for a new auth only transaction"""
+		order_id = frappe.generate_hash(length=10)
+		result = self.gateway.transaction.auth({
+			"order": {"invoice_number": order_id},
+			"amount": 5.25,
+			"credit_card": {
+				"card_number": "4111111111111111",
+				"expiration_date": "01/{0}".format(time.localtime().tm_year + 2),
+				"card_code": "123"
+			}
+		})
+
+		request = frappe.get_doc({
+			"doctype": "AuthorizeNet Request",
+			"status": "Authorized",
+			"transaction_id": result.transaction_response.trans_id,
+			"amount": amount,
+			"currency": "USD",
+			"order_id": order_id,
+			"reference_doctype": "User",
+			"reference_docname": "Administrator"
+		}).insert(ignore_permissions=True)
+		frappe.db.commit()
+
+		self.requests.append(request.name)
+		return request
+
+	def capture(self, *requests):
+		return capture_authorized_payments([r.name for r in requests], max_workers=2)
+
+	def get_status(self, request):
+		return frappe.db.get_value("AuthorizeNet Request", request.name, "status")
+
+	def test_capture(self):
+		request = self.authorize()
+		summary = self.capture(request)
+
+		self.assertEqual(summary["captured"], 1)
+		self.assertEqual(summary["hook_errors"], 0)
+		self.assertEqual(self.get_status(request), "Captured")
+
+		# captured requests are not picked up again
+		self.assertEqual(self.capture(request)["processed"], 0)
+		self.assertEqual(self.server.gateway.calls["createTransactionRequest"], 2)
+
+	def test_already_captured(self):
+		# captured before, its response got lost
+		request = self.authorize()
+		self.gateway.transaction.settle(request.transaction_id, request.amount)
+
+		summary = self.capture(request)
+		self.assertEqual(summary["captured"], 1)
+		self.assertEqual(self.get_status(request), "Captured")
+
+	def test_declined_capture(self):
+		# more than was authorized
+		request = self.authorize(amount=6)
+		summary = self.capture(request)
+
+		self.assertEqual(summary["declined"], 1)
+		self.assertEqual(self.get_status(request), "Error")
+		self.assertTrue(frappe.db.get_value("AuthorizeNet Request", request.name, "error_msg"))
+
+	def test_failed_capture_stays_authorized(self):
+		# failed here, the gateway never saw the capture
+		request = self.authorize()
+		update_request(frappe._dict(request.as_dict()), {"status": "Error", "error": "[UNEXPECTED ERROR]: test"},
+			"Info")
+		self.assertEqual(self.get_status(request), "Authorized")
+
+		summary = self.capture(request)
+		self.assertEqual(summary["captured"], 1)
+		self.assertEqual(self.get_status(request), "Captured")
+
+	def test_results_recorded_once(self):
+		request = self.authorize()
+		self.capture(request)
+
+		# a second run that also got a result must not overwrite the first
+		update_request(frappe._dict(request.as_dict()), {"status": "Declined", "error": "duplicate"}, "Info")
+		self.assertEqual(self.get_status(request), "Captured")
+
+	def test_circuit_breaker(self):
+		# gateway calls run on pool threads, which have no site
+		requests = [self.authorize(), self.authorize()]
+		with self.override_settings(circuit_breaker=1):
+			summary = self.capture(*requests)
+
+		self.assertEqual(summary["captured"], 2)
+		self.assertEqual(summary["errors"], 0)
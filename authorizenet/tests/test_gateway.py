@@ -0,0 +1,64 @@
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
+# MIT License. See license.txt
+from __future__ import unicode_literals
+
+import unittest
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import frappe
+from authorizenet.gateway import get_gateway, clear_gateways
+
+OK_RESPONSE = b"""<?xml version="1.0" encoding="utf-8"?>
+<getTransactionDetailsResponse xmlns="AnetApi/xml/v1/schema/AnetApiSchema.xsd">
+<messages><resultCode>Ok</resultCode><message><code>I00001</code><text>Successful.</text></message></messages>
+</getTransactionDetailsResponse>"""
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+	protocol_version = b"HTTP/1.1"
+
+	def setup(self):
+		BaseHTTPRequestHandler.setup(self)
+		self.server.connections += 1
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers.getheader("content-length")))
+		self.send_response(200)
+		self.send_header(b"Content-Type", b"text/xml")
+		self.send_header(b"Content-Length", str(len(OK_RESPONSE)))
+		self.end_headers()
+		self.wfile.write(OK_RESPONSE)
+
+	def log_message(self, *args):
+		pass
+
+class TestGateway(unittest.TestCase):
+
+	def setUp(self):
+		self.server = HTTPServer((b"127.0.0.1", 0), KeepAliveHandler)
+		self.server.connections = 0
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+		self.settings = frappe._dict({
+			"api_login_id": "login",
+			"api_transaction_key": "key",
+			"gateway_url": "http://127.0.0.1:{0}/xml/v1/request.api".format(self.server.server_port)
+		})
+
+	def tearDown(self):
+		clear_gateways()
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_connections_are_reused(self):
+		gateway = get_gateway(self.settings)
+		for i in range(5):
+			result = gateway.transaction.details("1234")
+			self.assertEqual(result.messages[0].result_code, "Ok")
+
+		self.assertEqual(self.server.connections, 1)
+
+	def test_gateway_is_cached_per_worker(self):
+		self.assertTrue(get_gateway(self.settings) is get_gateway(frappe._dict(self.settings)))
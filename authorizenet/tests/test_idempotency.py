@@ -0,0 +1,70 @@
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
+# MIT License. See license.txt
+from __future__ import unicode_literals
+
+import unittest
+
+import frappe
+from authorizenet.idempotency import get_idempotency_key, get_client_key, IdempotencyGuard, \
+	RESULT_KEY
+
+class TestIdempotencyKeys(unittest.TestCase):
+
+	def setUp(self):
+		self.data = {
+			"name": "a1b2c3d4e5",
+			"order_id": "SO-00001",
+			"amount": 10.5,
+			"currency": "USD"
+		}
+
+	def test_derived_keys(self):
+		key = get_idempotency_key(self.data)
+		self.assertEqual(key, get_idempotency_key(dict(self.data, amount="10.50")))
+		self.assertNotEqual(key, get_idempotency_key(dict(self.data, amount=10.51)))
+		self.assertNotEqual(key, get_idempotency_key(dict(self.data, order_id="SO-00002")))
+		self.assertEqual(get_idempotency_key({"amount": 10.5}), None)
+
+	def test_client_keys(self):
+		# client keys never change the lock key, two tabs share one lock
+		self.assertEqual(get_idempotency_key(dict(self.data, idempotency_key="k1")),
+			get_idempotency_key(dict(self.data, idempotency_key="k2")))
+
+		key = get_client_key(dict(self.data, idempotency_key="k1"))
+		self.assertEqual(key, get_client_key(dict(self.data, idempotency_key="k1", amount="10.50")))
+		self.assertNotEqual(key, get_client_key(dict(self.data, idempotency_key="k1", amount=11)))
+		self.assertNotEqual(key, get_client_key(dict(self.data, idempotency_key="k1", currency="EUR")))
+		self.assertNotEqual(key, get_client_key(dict(self.data, idempotency_key="k2")))
+		self.assertEqual(get_client_key(self.data), None)
+
+class TestIdempotencyGuard(unittest.TestCase):
+
+	def setUp(self):
+		self.key = frappe.generate_hash(length=20)
+		self.client_keys = [frappe.generate_hash(length=20) for i in range(3)]
+
+	def tearDown(self):
+		for key in [self.key] + self.client_keys:
+			frappe.cache().delete_value(RESULT_KEY.format(key))
+
+	def test_lock_contention(self):
+		with IdempotencyGuard(self.key, 60, self.client_keys[0]) as first:
+			self.assertTrue(first.locked)
+			self.assertEqual(first.result, None)
+
+			# another tab paying the same request waits for the first one
+			with IdempotencyGuard(self.key, 60, self.client_keys[1], wait_timeout=0.5) as second:
+				self.assertFalse(second.locked)
+				self.assertEqual(second.result["status"], "Failed")
+				self.assertTrue(second.result["recoverable"])
+
+			first.set_result({"status": "Completed"})
+
+		for client_key in self.client_keys:
+			with IdempotencyGuard(self.key, 60, client_key) as duplicate:
+				self.assertFalse(duplicate.locked)
+				self.assertEqual(duplicate.result["status"], "Completed")
+
+		# a retry of the first submission also finds its result by client key
+		with IdempotencyGuard(frappe.generate_hash(length=20), 60, self.client_keys[0]) as retry:
+			self.assertEqual(retry.result["status"], "Completed")
@@ -0,0 +1,63 @@
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
+# MIT License. See license.txt
+from __future__ import unicode_literals
+
+import unittest
+import socket
+
+from authorizenet.metrics import span, SpanCollector, NULL_SPAN, PaymentMetrics, StatsDSink
+
+class RecordingSink(object):
+	def emit(self, durations, outcome):
+		self.durations = durations
+		self.outcome = outcome
+
+class TestSpans(unittest.TestCase):
+
+	def test_spans_are_free_without_collector(self):
+		self.assertTrue(span("gateway_call") is NULL_SPAN)
+
+	def test_collector_records_spans(self):
+		with SpanCollector() as timings:
+			with span("gateway_call"):
+				pass
+
+			try:
+				with span("stored_payment"):
+					raise ValueError()
+			except ValueError:
+				pass
+
+		self.assertEqual(sorted(timings.durations), ["gateway_call", "stored_payment"])
+		self.assertEqual(len(timings.durations["gateway_call"]), 1)
+		self.assertTrue(span("gateway_call") is NULL_SPAN)
+
+class TestPaymentMetrics(unittest.TestCase):
+
+	def test_outcome_labels(self):
+		sink = RecordingSink()
+		with PaymentMetrics(sink) as metrics:
+			with span("gateway_call"):
+				pass
+			metrics.outcome = "Completed"
+
+		self.assertEqual(sink.outcome, "Completed")
+		self.assertEqual(sorted(sink.durations), ["gateway_call", "total"])
+
+		with self.assertRaises(ValueError):
+			with PaymentMetrics(sink):
+				raise ValueError()
+
+		self.assertEqual(sink.outcome, "Exception")
+
+	def test_statsd_datagram(self):
+		server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		server.bind(("127.0.0.1", 0))
+		server.settimeout(2)
+
+		StatsDSink("127.0.0.1", server.getsockname()[1]).emit({"gateway_call": [0.25]}, "Completed")
+		lines = server.recv(4096).decode("utf-8").split("\n")
+		server.close()
+
+		self.assertEqual(lines, ["authorizenet.payments.completed:1|c",
+			"authorizenet.phase.gateway_call.completed:250.000|ms"])
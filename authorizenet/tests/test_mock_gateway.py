@@ -0,0 +1,138 @@
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
+# MIT License. See license.txt
+from __future__ import unicode_literals
+
+import unittest
+import time
+
+from authorize import AuthorizeResponseError, AuthorizeConnectionError
+from authorizenet.mock_gateway import DECLINED_ZIP
+from authorizenet.circuit_breaker import CircuitOpenError
+from authorizenet.tests.mock_gateway_case import MockGatewayMixin
+
+class TestMockGateway(MockGatewayMixin, unittest.TestCase):
+
+	gateway_settings = {"read_timeout": 2}
+
+	def setUp(self):
+		super(TestMockGateway, self).setUp()
+		self.transaction_data = {
+			"order": {"invoice_number": "111"},
+			"amount": 5.25,
+			"email": "NuranVerkleij@example.com",
+			"credit_card": {
+				"card_number": "4111111111111111",
+				"expiration_date": "01/{0}".format(time.localtime().tm_year + 2),
+				"card_code": "123"
+			},
+			"billing": {"first_name": "Nuran", "last_name": "Verkleij", "zip": "32801"}
+		}
+
+	def test_sale_and_stored_payments(self):
+		result = self.gateway.transaction.sale(self.transaction_data)
+		self.assertEqual(result.transaction_response.response_code, "1")
+
+		customer = self.gateway.customer.from_transaction(result.transaction_response.trans_id)
+		self.assertTrue(customer.customer_id)
+		payment_id = customer.payment_ids[0]
+
+		with self.assertRaises(AuthorizeResponseError) as cm:
+			self.gateway.credit_card.create(customer.customer_id, {
+				"card_number": "4111111111111111",
+				"expiration_month": "01",
+				"expiration_year": str(time.localtime().tm_year + 2)
+			})
+
+		self.assertEqual(cm.exception.code, "E00039")
+		self.assertEqual(cm.exception.full_response.payment_id, payment_id)
+
+		result = self.gateway.transaction.sale({
+			"order": {"invoice_number": "112"},
+			"amount": 5.25,
+			"customer_id": customer.customer_id,
+			"payment_id": payment_id
+		})
+		self.assertEqual(result.transaction_response.response_code, "1")
+
+	def test_declines_and_duplicates(self):
+		self.transaction_data["billing"]["zip"] = DECLINED_ZIP
+		with self.assertRaises(AuthorizeResponseError) as cm:
+			self.gateway.transaction.sale(self.transaction_data)
+
+		self.assertEqual(cm.exception.code, "2")
+		self.assertTrue(cm.exception.full_response.transaction_response.trans_id)
+
+		# declined charges count towards duplicates too
+		self.transaction_data["billing"]["zip"] = "32801"
+		self.transaction_data["order"]["invoice_number"] = "112"
+		self.gateway.transaction.sale(self.transaction_data)
+		with self.assertRaises(AuthorizeResponseError) as cm:
+			self.gateway.transaction.sale(self.transaction_data)
+
+		self.assertEqual(cm.exception.code, "11")
+
+	def test_auth_and_capture(self):
+		result = self.gateway.transaction.auth(self.transaction_data)
+		trans_id = result.transaction_response.trans_id
+
+		result = self.gateway.transaction.settle(trans_id, 5.25)
+		self.assertEqual(result.transaction_response.response_code, "1")
+
+		# repeated captures are refused, the card is only charged once
+		with self.assertRaises(AuthorizeResponseError) as cm:
+			self.gateway.transaction.settle(trans_id, 5.25)
+
+		self.assertEqual(cm.exception.code, "311")
+
+		# sales can't be captured
+		self.transaction_data["order"]["invoice_number"] = "112"
+		result = self.gateway.transaction.sale(self.transaction_data)
+		with self.assertRaises(AuthorizeResponseError) as cm:
+			self.gateway.transaction.settle(result.transaction_response.trans_id)
+
+		self.assertEqual(cm.exception.code, "16")
+
+	def test_failure_injection(self):
+		self.server.gateway.inject("error")
+		self.assertRaises(AuthorizeConnectionError, self.gateway.transaction.sale, self.transaction_data)
+
+		self.server.gateway.inject("drop")
+		self.assertRaises(AuthorizeConnectionError, self.gateway.transaction.sale, self.transaction_data)
+
+		result = self.gateway.transaction.sale(self.transaction_data)
+		self.assertEqual(result.transaction_response.response_code, "1")
+
+	def test_retries(self):
+		# reads are retried, two failures fit in the default retries
+		self.server.gateway.inject("error", 2)
+		with self.assertRaises(AuthorizeResponseError) as cm:
+			self.gateway.transaction.details("1234")
+
+		# the mock answers, it just does not know transaction details
+		self.assertEqual(cm.exception.code, "E00003")
+
+		# a charge that may have gone through is never sent twice
+		self.server.gateway.inject("error")
+		self.assertRaises(AuthorizeConnectionError, self.gateway.transaction.sale, self.transaction_data)
+		self.assertEqual(self.server.gateway.calls.get("createTransactionRequest"), None)
+
+	def test_circuit_breaker(self):
+		gateway = self.get_gateway(max_retries=0, circuit_breaker=1, breaker_min_calls=2,
+			breaker_cooldown=1)
+		gateway.breaker.reset()
+
+		try:
+			self.server.gateway.inject("error", 2)
+			for i in range(2):
+				self.assertRaises(AuthorizeConnectionError, gateway.transaction.sale, self.transaction_data)
+
+			self.assertEqual(gateway.breaker.get_state()["state"], "Open")
+			self.assertRaises(CircuitOpenError, gateway.transaction.sale, self.transaction_data)
+			self.assertEqual(self.server.gateway.calls.get("createTransactionRequest"), None)
+
+			# after the cooldown a successful trial call closes it again
+			time.sleep(1.1)
+			gateway.transaction.sale(self.transaction_data)
+			self.assertEqual(gateway.breaker.get_state()["state"], "Closed")
+		finally:
+			gateway.breaker.reset()
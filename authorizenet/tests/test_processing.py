@@ -4,9 +4,12 @@ from __future__ import unicode_literals
 
 import unittest
 import random
+from datetime import datetime
 
-from frappe.utils import evaluate_filters
-from authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings import process
+import frappe
+from frappe.utils import evaluate_filters, now
+from authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings import process, \
+	get_controller, get_settings_snapshot, SETTINGS_VERSION_KEY
 
 
 class TestProcessing(unittest.TestCase):
@@ -25,9 +28,10 @@ class TestProcessing(unittest.TestCase):
 			"reference_doctype": None,
 			"reference_docname": None,
 			"card_info": {
+				"name_on_card": "Nuran Verkleij",
 				"card_number": "4111111111111111",
 				"exp_month": "01",
-				"exp_year": "2018",
+				"exp_year": str(datetime.today().year + 2),
 				"card_code": "123"
 			},
 			"billing_info": {
@@ -77,3 +81,30 @@ class TestProcessing(unittest.TestCase):
 		self.transaction_info["card_info"]["card_number"] = "411111111111111"
 		result = process(self.transaction_info, None)
 		self.assertTrue(result.get("status") == "Failed", "%s should be Failed" % (result.get("status")))
+
+	def test_settings_snapshot(self):
+		self.assertTrue(get_settings_snapshot() is get_settings_snapshot())
+		self.assertTrue(get_controller().get_settings().api_transaction_key)
+
+		settings = frappe.get_doc("AuthorizeNet Settings")
+		log_level = settings.log_level
+		try:
+			settings.log_level = "Debug" if log_level != "Debug" else "Info"
+			settings.modified = now()
+			settings.db_update()
+			settings.on_update()
+
+			self.assertEqual(get_controller().log_level, settings.log_level)
+			self.assertEqual(get_controller().get_settings().log_level, settings.log_level)
+		finally:
+			frappe.db.rollback()
+			frappe.cache().delete_value(SETTINGS_VERSION_KEY)
+
+	def test_settings_snapshot_after_rollback(self):
+		snapshot = get_settings_snapshot()
+		try:
+			# version bumped by a save that was rolled back afterwards
+			frappe.cache().set_value(SETTINGS_VERSION_KEY, "2099-01-01 00:00:00")
+			self.assertTrue(get_settings_snapshot() is snapshot)
+		finally:
+			frappe.cache().delete_value(SETTINGS_VERSION_KEY)
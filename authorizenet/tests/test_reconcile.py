@@ -0,0 +1,69 @@
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
+# MIT License. See license.txt
+from __future__ import unicode_literals
+
+import unittest
+import os
+import tempfile
+import time
+
+import frappe
+from authorizenet.mock_gateway import DECLINED_ZIP
+from authorizenet.reconcile import gateway_transactions, file_transactions, compare
+from authorizenet.tests.mock_gateway_case import MockGatewayMixin
+
+class TestReconcile(MockGatewayMixin, unittest.TestCase):
+
+	def charge(self, invoice, zip_code="32801"):
+		try:
+			self.gateway.transaction.sale({
+				"order": {"invoice_number": invoice},
+				"amount": 5.25,
+				"credit_card": {
+					"card_number": "4111111111111111",
+					"expiration_date": "01/{0}".format(time.localtime().tm_year + 2),
+					"card_code": "123"
+				},
+				"billing": {"zip": zip_code}
+			})
+		except Exception:
+			pass
+
+	def test_gateway_pages(self):
+		for i in range(4):
+			self.charge("INV-{0}".format(i))
+		self.charge("INV-4", DECLINED_ZIP)
+		self.server.gateway.settle_batch()
+
+		today = time.strftime("%Y-%m-%d")
+		transactions = list(gateway_transactions(self.gateway, today, today, page_size=2))
+
+		self.assertEqual(len(transactions), 5)
+		self.assertEqual(len(set(t.transaction_id for t in transactions)), 5)
+		self.assertEqual(self.server.gateway.calls["getTransactionListRequest"], 3)
+		self.assertEqual(sorted(t.status for t in transactions).count("declined"), 1)
+
+	def test_file_transactions(self):
+		fd, path = tempfile.mkstemp(suffix=".csv")
+		with os.fdopen(fd, "w") as f:
+			f.write("Transaction ID,Transaction Status,Settlement Amount,Invoice Number\n")
+			f.write("60000000001,Settled Successfully,5.25,INV-0\n")
+			f.write("60000000002,Refund Settled Successfully,5.25,INV-1\n")
+
+		try:
+			transactions = list(file_transactions(path))
+		finally:
+			os.remove(path)
+
+		self.assertEqual([t.transaction_id for t in transactions], ["60000000001", "60000000002"])
+		self.assertEqual(transactions[0].amount, "5.25")
+
+	def test_compare(self):
+		transaction = frappe._dict({"transaction_id": "1", "status": "Settled Successfully", "amount": "5.25"})
+		request = frappe._dict({"name": "r1", "status": "Captured", "amount": 5.25})
+
+		self.assertEqual(compare(transaction, request), [])
+		self.assertEqual([m["issue"] for m in compare(transaction, None)], ["missing"])
+		self.assertEqual([m["issue"] for m in compare(transaction, frappe._dict(request, amount=5.2))], ["amount"])
+		self.assertEqual([m["issue"] for m in compare(frappe._dict(transaction, status="declined", amount="0.00"),
+			request)], ["status"])
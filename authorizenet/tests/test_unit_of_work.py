@@ -0,0 +1,78 @@
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
+# MIT License. See license.txt
+from __future__ import unicode_literals
+
+import unittest
+
+import frappe
+from authorizenet.unit_of_work import UnitOfWork
+
+class RecordingDoc(object):
+	"""Stands in for a document, records its writes in calls"""
+
+	def __init__(self, name, calls):
+		self.name = name
+		self.calls = calls
+		self.flags = frappe._dict()
+
+	def insert(self):
+		self.calls.append(("insert", self.name))
+
+	def save(self):
+		self.calls.append(("save", self.name))
+
+class TestUnitOfWork(unittest.TestCase):
+
+	def setUp(self):
+		self.calls = []
+		self.enqueue = frappe.enqueue
+
+		# record commits and queued jobs in the order they happen
+		frappe.db.commit = lambda: self.calls.append(("commit",))
+		frappe.enqueue = lambda method, **kwargs: self.calls.append(("enqueue", method, kwargs))
+
+	def tearDown(self):
+		del frappe.db.commit
+		frappe.enqueue = self.enqueue
+
+	def doc(self, name):
+		return RecordingDoc(name, self.calls)
+
+	def test_documents_written_once_in_order(self):
+		unit_of_work = UnitOfWork()
+		request, user = self.doc("request"), self.doc("user")
+
+		self.assertTrue(unit_of_work.insert(request) is request)
+		unit_of_work.save(user)
+		unit_of_work.save(request)
+		unit_of_work.flush()
+
+		self.assertEqual(self.calls, [("insert", "request"), ("save", "user")])
+		self.assertTrue(request.flags.ignore_permissions)
+
+	def test_flush_leaves_later_registrations(self):
+		unit_of_work = UnitOfWork()
+		request = self.doc("request")
+
+		unit_of_work.insert(request)
+		unit_of_work.flush()
+		unit_of_work.save(request)
+		unit_of_work.flush()
+		unit_of_work.flush()
+
+		self.assertEqual(self.calls, [("insert", "request"), ("save", "request")])
+
+	def test_jobs_queued_after_commit(self):
+		unit_of_work = UnitOfWork()
+		unit_of_work.insert(self.doc("request"))
+		unit_of_work.enqueue("authorizenet.vault.store_payment", request_name="request")
+
+		self.assertEqual(self.calls, [])
+
+		unit_of_work.commit()
+		self.assertEqual(self.calls, [("insert", "request"), ("commit",),
+			("enqueue", "authorizenet.vault.store_payment", {"request_name": "request"})])
+
+		# queued once
+		unit_of_work.commit()
+		self.assertEqual(self.calls[-1], ("commit",))
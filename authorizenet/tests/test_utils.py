@@ -0,0 +1,114 @@
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
+# MIT License. See license.txt
+from __future__ import unicode_literals
+
+import unittest
+from datetime import datetime
+
+import frappe
+from authorizenet.utils import CardBrandIndex, get_card_accronym, get_card_accronyms, \
+	validate_card_info, get_identity, get_stored_payment_summaries
+
+
+class TestCardBrandIndex(unittest.TestCase):
+
+	def test_common_brands(self):
+		self.assertEqual(get_card_accronym("4111111111111111"), "VISA")
+		self.assertEqual(get_card_accronym("378282246310005"), "AMEX")
+		self.assertEqual(get_card_accronym("6011111111111117"), "DISCOVER")
+		self.assertEqual(get_card_accronym("5105105105105100"), "MASTERCARD")
+		self.assertEqual(get_card_accronym("9999999999999999"), "")
+		self.assertEqual(get_card_accronym(""), "")
+
+	def test_longest_prefix_wins(self):
+		# 4026 is a VISAELECTRON prefix inside the VISA 4 prefix
+		self.assertEqual(get_card_accronym("4026000000000002"), "VISAELECTRON")
+		self.assertEqual(get_card_accronym("4175000000000001"), "VISAELECTRON")
+
+	def test_range_bounds(self):
+		# ranges follow range() semantics, end is exclusive
+		self.assertEqual(get_card_accronym("6221260000000000"), "DISCOVER")
+		self.assertEqual(get_card_accronym("6229240000000000"), "DISCOVER")
+		self.assertEqual(get_card_accronym("6229250000000000"), "CHINAUP")
+
+	def test_leading_zero_prefix(self):
+		self.assertEqual(get_card_accronym("0604000000000000"), "MAESTRO")
+
+	def test_overlapping_prefixes(self):
+		index = CardBrandIndex({
+			"B": [(10, 20)],
+			"A": [15]
+		})
+		self.assertEqual(index.lookup("15"), "A")
+		self.assertEqual(index.lookup("14"), "B")
+		self.assertEqual(index.lookup("16"), "B")
+
+	def test_batch_lookup(self):
+		self.assertEqual(get_card_accronyms(["4111111111111111", "378282246310005", "1"]),
+			["VISA", "AMEX", ""])
+
+
+class TestCardValidation(unittest.TestCase):
+
+	def setUp(self):
+		self.today = datetime(2017, 6, 15)
+		self.card_info = {
+			"name_on_card": "Nuran Verkleij",
+			"card_number": "4111111111111111",
+			"exp_month": "06",
+			"exp_year": "2017",
+			"card_code": "123"
+		}
+
+	def assertFieldError(self, errors, field):
+		self.assertTrue(any(field in e for e in errors), "%s not in %s" % (field, errors))
+
+	def test_valid_card(self):
+		self.assertEqual(validate_card_info(self.card_info, self.today), [])
+
+	def test_missing_field(self):
+		del self.card_info["name_on_card"]
+		errors = validate_card_info(self.card_info, self.today)
+		self.assertEqual(errors, [{"name_on_card": "Missing field: name_on_card"}])
+
+	def test_bad_length(self):
+		self.card_info["card_number"] = "411111111111111"
+		self.assertFieldError(validate_card_info(self.card_info, self.today), "card_number")
+
+	def test_bad_checksum(self):
+		self.card_info["card_number"] = "4111111111111112"
+		self.assertFieldError(validate_card_info(self.card_info, self.today), "card_number")
+
+	def test_expired(self):
+		self.card_info["exp_month"] = "05"
+		self.assertFieldError(validate_card_info(self.card_info, self.today), "exp_year")
+
+		self.card_info["exp_month"] = "13"
+		self.assertFieldError(validate_card_info(self.card_info, self.today), "exp_month")
+
+	def test_card_code_length(self):
+		self.card_info["card_code"] = "1234"
+		self.assertFieldError(validate_card_info(self.card_info, self.today), "card_code")
+
+		# amex codes are 4 digits
+		self.card_info["card_number"] = "378282246310005"
+		self.assertEqual(validate_card_info(self.card_info, self.today), [])
+
+class TestIdentity(unittest.TestCase):
+
+	def tearDown(self):
+		frappe.set_user("Administrator")
+
+	def test_identity_is_memoized_per_user(self):
+		identity = get_identity()
+		self.assertTrue(get_identity() is identity)
+
+		frappe.set_user("Guest")
+		guest = get_identity()
+		self.assertFalse(guest is identity)
+		self.assertEqual(guest.contact, None)
+		self.assertEqual(guest.authnet_user, None)
+		self.assertEqual(guest.authorizenet_id, None)
+		self.assertEqual(guest.stored_payments, [])
+		self.assertEqual(guest.stored_payments_more, False)
+		self.assertEqual(get_stored_payment_summaries(None), ([], False))
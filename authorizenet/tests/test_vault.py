@@ -0,0 +1,39 @@
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
+# MIT License. See license.txt
+from __future__ import unicode_literals
+
+import unittest
+import time
+
+import frappe
+from authorizenet.vault import create_customer, create_payment_profile
+from authorizenet.tests.mock_gateway_case import MockGatewayMixin
+
+class TestVault(MockGatewayMixin, unittest.TestCase):
+
+	def setUp(self):
+		super(TestVault, self).setUp()
+		self.request = frappe.get_doc({"doctype": "AuthorizeNet Request"})
+
+	def test_retried_steps_return_existing_ids(self):
+		result = self.gateway.transaction.sale({
+			"order": {"invoice_number": "111"},
+			"amount": 5.25,
+			"credit_card": {
+				"card_number": "4111111111111111",
+				"expiration_date": "01/{0}".format(time.localtime().tm_year + 2),
+				"card_code": "123"
+			}
+		})
+		transaction_id = result.transaction_response.trans_id
+
+		customer_id = create_customer(self.gateway, transaction_id)
+		self.assertEqual(create_customer(self.gateway, transaction_id), customer_id)
+
+		card = {
+			"card_number": "4111111111111111",
+			"expiration_month": "01",
+			"expiration_year": str(time.localtime().tm_year + 2)
+		}
+		payment_id = create_payment_profile(self.gateway, customer_id, card, self.request)
+		self.assertEqual(create_payment_profile(self.gateway, customer_id, card, self.request), payment_id)
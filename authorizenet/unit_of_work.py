@@ -0,0 +1,55 @@
+from __future__ import unicode_literals
+import frappe
+
+class UnitOfWork(object):
+	"""Tracks documents touched while processing a payment and writes each
+	one exactly once.
+
+	Documents are registered with insert() or save() as they are created or
+	changed and written in registration order by flush(). Registering the
+	same document again is a no-op, so code paths can mark a document dirty
+	without knowing whether someone else already did.
+
+	Background jobs that read those documents are registered with enqueue()
+	and only queued once commit() has made the documents visible to them.
+	"""
+
+	def __init__(self):
+		self.pending = []
+		self.jobs = []
+
+	def insert(self, doc):
+		return self._register(doc, "insert")
+
+	def save(self, doc):
+		return self._register(doc, "save")
+
+	def enqueue(self, method, **kwargs):
+		"""Queues a frappe.enqueue job after the next commit"""
+		self.jobs.append((method, kwargs))
+
+	def _register(self, doc, method):
+		if not any(d is doc for d, m in self.pending):
+			self.pending.append((doc, method))
+
+		return doc
+
+	def flush(self):
+		"""Writes every pending document, documents registered afterwards
+		are written by the next flush"""
+		pending, self.pending = self.pending, []
+
+		for doc, method in pending:
+			doc.flags.ignore_permissions = 1
+			if method == "insert":
+				doc.insert()
+			else:
+				doc.save()
+
+	def commit(self):
+		self.flush()
+		frappe.db.commit()
+
+		jobs, self.jobs = self.jobs, []
+		for method, kwargs in jobs:
+			frappe.enqueue(method, **kwargs)
@@ -1,81 +1,397 @@
 from __future__ import unicode_literals
 import frappe
 from frappe import _, session
+from frappe.utils import cint, now_datetime
+from bisect import bisect_right
+from datetime import datetime
+import re
 
 import authorize
 
 def _range(a,b):
-	return [x for x in range(a,b)]
+	# half-open interval of prefixes, same bounds as range(a, b)
+	return (a, b)
 
 CARDS = {
 	'AMEX':         [34, 37],
 	'CHINAUP':      [62, 88],
-	'DinersClub':   _range(300, 305)+[309, 36, 54, 55]+_range(38, 39),
-	'DISCOVER':     [6011, 65] + _range(622126, 622925) + _range(644, 649),
-	'JCB':          _range(3528, 3589),
+	'DinersClub':   [_range(300, 305), 309, 36, 54, 55, _range(38, 39)],
+	'DISCOVER':     [6011, 65, _range(622126, 622925), _range(644, 649)],
+	'JCB':          [_range(3528, 3589)],
 	'LASER':        [6304, 6706, 6771, 6709],
-	'MAESTRO':      [5018, 5020, 5038, 5612, 5893, 6304, 6759, 6761, 6762, 6763, 0604, 6390],
+	'MAESTRO':      [5018, 5020, 5038, 5612, 5893, 6304, 6759, 6761, 6762, 6763, '0604', 6390],
 	'DANKORT':      [5019],
-	'MASTERCARD':   _range(50, 55),
+	'MASTERCARD':   [_range(50, 55)],
 	'VISA':         [4],
 	'VISAELECTRON': [4026, 417500, 4405, 4508, 4844, 4913, 4917]
 }
 
-def get_contact(contact_name = None):
+class CardBrandIndex(object):
+	"""Longest prefix lookup over a CARDS style table.
+
+	Prefixes are grouped by digit count and each group is kept as a sorted
+	table of non overlapping [start, end) intervals, so resolving a number
+	costs one bisect per distinct prefix length instead of a scan over every
+	expanded prefix. When two brands claim the same prefix the brand whose
+	name sorts first wins, which keeps lookups deterministic.
+	"""
+
+	def __init__(self, cards):
+		groups = {}
+		for name, prefixes in sorted(cards.items()):
+			for prefix in prefixes:
+				size, start, end = self._interval(prefix)
+				accepted = groups.setdefault(size, [])
+				for piece in self._carve(accepted, start, end):
+					accepted.append(piece + (name,))
+
+		# longest prefixes first so the first hit is the longest match
+		self._tables = []
+		for size in sorted(groups.keys(), reverse=True):
+			intervals = sorted(groups[size])
+			self._tables.append((
+				size,
+				[x[0] for x in intervals],
+				[x[1] for x in intervals],
+				[x[2] for x in intervals]))
+
+	@staticmethod
+	def _interval(prefix):
+		if isinstance(prefix, tuple):
+			start, end = prefix
+			return len(str(start)), start, end
+
+		# string prefixes keep leading zeros significant
+		size = len(str(prefix))
+		start = int(prefix)
+		return size, start, start + 1
+
+	@staticmethod
+	def _carve(accepted, start, end):
+		pieces = [(start, end)]
+		for lo, hi, name in accepted:
+			remaining = []
+			for s, e in pieces:
+				if e <= lo or s >= hi:
+					remaining.append((s, e))
+					continue
+				if s < lo:
+					remaining.append((s, lo))
+				if e > hi:
+					remaining.append((hi, e))
+			pieces = remaining
+
+		return pieces
+
+	def lookup(self, number):
+		if not number:
+			return ''
+
+		number = str(number) if not isinstance(number, basestring) else number
+		for size, starts, ends, names in self._tables:
+			prefix = number[:size]
+			if len(prefix) < size or not prefix.isdigit():
+				continue
+
+			value = int(prefix)
+			idx = bisect_right(starts, value) - 1
+			if idx >= 0 and value < ends[idx]:
+				return names[idx]
+
+		return ''
+
+	def lookup_many(self, numbers):
+		return [self.lookup(number) for number in numbers]
+
+CARD_INDEX = CardBrandIndex(CARDS)
+
+# valid card number lengths per CARDS brand
+CARD_LENGTHS = {
+	'AMEX':         [15],
+	'CHINAUP':      range(16, 20),
+	'DinersClub':   range(14, 20),
+	'DISCOVER':     range(16, 20),
+	'JCB':          range(16, 20),
+	'LASER':        range(16, 20),
+	'MAESTRO':      range(12, 20),
+	'DANKORT':      [16],
+	'MASTERCARD':   [16],
+	'VISA':         [13, 16, 19],
+	'VISAELECTRON': [16]
+}
+DEFAULT_CARD_LENGTHS = range(12, 20)
+
+# valid security code lengths per CARDS brand
+CARD_CODE_LENGTHS = {
+	'AMEX': [4]
+}
+DEFAULT_CARD_CODE_LENGTHS = [3]
+
+REQUIRED_CARD_FIELDS = ('name_on_card', 'card_number', 'exp_month', 'exp_year', 'card_code')
+
+COUNTRY_OPTIONS_CACHE_KEY = "authorizenet:country_options"
+COUNTRY_OPTIONS_VERSION_KEY = "authorizenet:country_options_version"
+
+def get_country_options():
+	"""Countries for billing address forms, system default country first.
+
+	The ordered list is cached and cleared whenever a Country or the
+	System Settings change, see clear_country_options.
+	"""
+	countries = frappe.cache().get_value(COUNTRY_OPTIONS_CACHE_KEY)
+
+	if countries is None:
+		countries = frappe.get_all("Country", fields=["country_name", "name"])
+		default_country = frappe.db.get_value("System Settings", "System Settings", "country")
+
+		# stable sort, only moves the default country to the front
+		countries.sort(key=lambda x: x.name != default_country)
+		frappe.cache().set_value(COUNTRY_OPTIONS_CACHE_KEY, countries)
+
+	return list(countries)
+
+def get_country_options_version():
+	"""Changes every time the cached country list is cleared"""
+	version = frappe.cache().get_value(COUNTRY_OPTIONS_VERSION_KEY)
+
+	if not version:
+		version = frappe.generate_hash(length=10)
+		frappe.cache().set_value(COUNTRY_OPTIONS_VERSION_KEY, version)
+
+	return version
+
+def clear_country_options(doc=None, method=None):
+	frappe.cache().delete_value(COUNTRY_OPTIONS_CACHE_KEY)
+	frappe.cache().delete_value(COUNTRY_OPTIONS_VERSION_KEY)
+
+STORED_PAYMENT_SUMMARY_FIELDS = ("name", "short_text", "long_text", "expires", "address_name",
+	"payment_type", "authorizenet_payment_id", "last_used")
+
+# stored payments rendered with the checkout form, the rest load on demand
+STORED_PAYMENTS_PAGE_LENGTH = 5
+
+class Identity(object):
+	"""Contact, email and AuthorizeNet user of a site user, each resolved
+	at most once. Use get_identity to share one across a request."""
+
+	def __init__(self, user):
+		self.user = user
+
+	@property
+	def contact(self):
+		if not hasattr(self, "_contact"):
+			self._contact = find_contact(self.user)
+
+		return self._contact
+
+	@property
+	def email(self):
+		"""First valid email of the contact or its user, None without one"""
+		if not hasattr(self, "_email"):
+			self._email = None
+			if self.contact:
+				email = self.contact.get("email_id")
+				if (not email or "@" not in email) and self.contact.user:
+					email = frappe.db.get_value("User", self.contact.user, "email")
+
+				if email and "@" in email:
+					self._email = email
+
+		return self._email
+
+	@property
+	def authorizenet_id(self):
+		"""Customer profile id, read without loading the AuthorizeNet Users doc"""
+		if hasattr(self, "_authnet_user"):
+			return self._authnet_user.authorizenet_id if self._authnet_user else None
+
+		if not hasattr(self, "_authorizenet_id"):
+			self._authorizenet_id = get_authorizenet_id(self.contact.name if self.contact else None)
+
+		return self._authorizenet_id
+
+	@property
+	def stored_payments(self):
+		"""Summaries of the most recently used, unexpired stored payments"""
+		if not hasattr(self, "_stored_payments"):
+			self._stored_payments, self._stored_payments_more = get_stored_payment_summaries(
+				self.contact.name if self.contact else None)
+
+		return self._stored_payments
+
+	@property
+	def stored_payments_more(self):
+		"""Whether there are stored payments past the first page"""
+		# loaded together with the first page
+		self.stored_payments
+		return self._stored_payments_more
+
+	@property
+	def authnet_user(self):
+		"""Full AuthorizeNet Users doc, only load it to write to it"""
+		if not hasattr(self, "_authnet_user"):
+			self._authnet_user = find_authorizenet_user(self.contact)
+
+		return self._authnet_user
+
+	@authnet_user.setter
+	def authnet_user(self, authnet_user):
+		# keeps the memo right after a payment creates the customer
+		self._authnet_user = authnet_user
+		self.__dict__.pop("_stored_payments", None)
+
+def get_identity():
+	"""Identity of the session user, memoized for the current request"""
+	identities = getattr(frappe.local, "authorizenet_identities", None)
+	if identities is None:
+		identities = frappe.local.authorizenet_identities = {}
+
 	user = session.user
-	contact = None
-	if isinstance(user, unicode):
-		user = frappe.get_doc("User", user)
+	if user not in identities:
+		identities[user] = Identity(user)
+
+	return identities[user]
+
+def find_contact(user):
+	"""Contact linked to user, or else sharing its email"""
+	if not user or user == "Guest":
+		return None
+
+	email = frappe.db.get_value("User", user, "email")
+	contact_name = frappe.db.sql("""select name from `tabContact`
+		where user=%(user)s or email_id=%(email)s
+		order by user=%(user)s desc limit 1""", {"user": user, "email": email})
+
+	if contact_name:
+		return frappe.get_doc("Contact", contact_name[0][0])
+
+def find_authorizenet_user(contact):
+	if not contact:
+		return None
+
+	name = frappe.db.get_value("AuthorizeNet Users", {"contact": contact.name})
+	if name:
+		return frappe.get_doc("AuthorizeNet Users", name)
 
+def get_authorizenet_id(contact_name):
+	"""Customer profile id of a contact, None if it has none"""
 	if not contact_name:
-		contact_names = frappe.get_all("Contact", fields=["name"], filters={
-			"user": user.name
-		})
+		return None
 
-		if not contact_names or len(contact_names) == 0:
-			contact_names = frappe.get_all("Contact", fields=["name"], filters={
-				"email_id": user.email
-			})
+	return frappe.db.get_value("AuthorizeNet Users", {"contact": contact_name}, "authorizenet_id")
 
-		if contact_names and len(contact_names) > 0:
-			contact_name = contact_names[0].get("name")
+def get_stored_payment_summaries(contact_name, start=0, page_length=STORED_PAYMENTS_PAGE_LENGTH, today=None):
+	"""A page of a contact's unexpired stored payments, most recently used
+	first, with just the fields forms display.
 
+	Returns (stored_payments, has_more).
+	"""
+	if not contact_name:
+		return [], False
+
+	# cards expire at the end of their expiry month, stored as its first day
+	this_month = (today or datetime.today()).strftime("%Y-%m-01")
+
+	stored_payments = frappe.db.sql("""select {0}
+		from `tabAuthorizeNet Stored Payment` sp
+		inner join `tabAuthorizeNet Users` u on u.name=sp.parent
+		where u.contact=%(contact)s and sp.parenttype='AuthorizeNet Users'
+			and sp.parentfield='stored_payments'
+			and (sp.expires is null or sp.expires >= %(this_month)s)
+		order by ifnull(sp.last_used, sp.creation) desc, sp.idx desc
+		limit %(start)s, %(page_length)s""".format(
+			", ".join("sp.`{0}`".format(f) for f in STORED_PAYMENT_SUMMARY_FIELDS)), {
+			"contact": contact_name,
+			"this_month": this_month,
+			"start": cint(start),
+			# one extra row tells whether there is another page
+			"page_length": cint(page_length) + 1
+		}, as_dict=1)
+
+	return stored_payments[:page_length], len(stored_payments) > page_length
+
+def mark_stored_payment_used(customer_id, payment_id):
+	"""Moves a stored payment to the top of the checkout list"""
+	frappe.db.sql("""update `tabAuthorizeNet Stored Payment` sp
+		inner join `tabAuthorizeNet Users` u on u.name=sp.parent
+		set sp.last_used=%s
+		where u.authorizenet_id=%s and sp.authorizenet_payment_id=%s""",
+		(now_datetime(), customer_id, payment_id))
+
+def get_contact(contact_name = None):
 	if contact_name:
-		contact = frappe.get_doc("Contact", contact_name)
+		return frappe.get_doc("Contact", contact_name)
 
-	return contact
+	return get_identity().contact
 
 def get_authorizenet_user():
+	return get_identity().authnet_user
 
-	authnet_user = None
-	try:
-		contact = get_contact();
-		if contact:
-			authnet_user_name = frappe.get_list("AuthorizeNet Users", fields=["name"], filters={"contact": contact.name}, as_list=1)
-			if len(authorize_user_name) > 0:
-				authnet_user_name = authnet_user_name[0][0]
+def get_card_accronym(number):
+	return CARD_INDEX.lookup(number)
 
-				#authnet_user_name = frappe.get_value("AuthorizeNet Users",
-				#    filters={"contact": contact.name},
-				#    fieldname="name")
-				authnet_user = frappe.get_doc("AuthorizeNet Users", authnet_user_name)
-	except:
-		authnet_user = None
+def get_card_accronyms(numbers):
+	"""Classifies many card numbers at once, returns brands in input order"""
+	return CARD_INDEX.lookup_many(numbers)
 
-	return authnet_user
+def luhn_valid(number):
+	total = 0
+	for idx, digit in enumerate(reversed(number)):
+		digit = int(digit)
+		if idx % 2:
+			digit *= 2
+			if digit > 9:
+				digit -= 9
+		total += digit
 
-def get_card_accronym(number):
-	card_name = ''
-	card_match_size = 0
-	for name, values in CARDS.items():
-		for digits in values:
-			digits = str(digits)
-			if number.startswith(digits):
-				if len(digits) > card_match_size:
-					card_match_size = len(digits)
-					card_name = name
-
-	return card_name
+	return total % 10 == 0
+
+def validate_card_info(card_info, today=None):
+	"""Checks card fields locally before anything is sent to the gateway.
+
+	Returns a list of {field_name: error} dicts, the same shape as the
+	AuthorizeInvalidError children, empty when the card looks valid.
+	"""
+	errors = []
+
+	for f in REQUIRED_CARD_FIELDS:
+		if not card_info.get(f):
+			errors.append({f: "Missing field: %s" % f})
+
+	if errors:
+		return errors
+
+	number = re.sub(r"[\s-]", "", "%s" % card_info.get("card_number"))
+	brand = ''
+	if not number.isdigit():
+		errors.append({"card_number": "Card number may only contain digits"})
+	else:
+		brand = get_card_accronym(number)
+		if len(number) not in CARD_LENGTHS.get(brand, DEFAULT_CARD_LENGTHS):
+			errors.append({"card_number": "Card number has an invalid length"})
+		elif not luhn_valid(number):
+			errors.append({"card_number": "Card number is invalid"})
+
+	month = cint(card_info.get("exp_month"))
+	year = cint(card_info.get("exp_year"))
+	if year and year < 100:
+		year += 2000
+
+	if not 1 <= month <= 12:
+		errors.append({"exp_month": "Expiration month is invalid"})
+	elif not year:
+		errors.append({"exp_year": "Expiration year is invalid"})
+	else:
+		today = today or datetime.today()
+		if (year, month) < (today.year, today.month):
+			errors.append({"exp_year": "Card has expired"})
+
+	card_code = "%s" % card_info.get("card_code")
+	if not card_code.isdigit() or \
+		len(card_code) not in CARD_CODE_LENGTHS.get(brand, DEFAULT_CARD_CODE_LENGTHS):
+		errors.append({"card_code": "Security code is invalid"})
+
+	return errors
 
 def authnet_address(fields):
 	address = {}
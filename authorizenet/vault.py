@@ -0,0 +1,189 @@
+"""
+Stores the card of a successful payment as a customer payment profile.
+
+Runs as a background job once the payment is committed, so the customer's
+redirect doesn't wait for the extra gateway calls:
+
+	enqueue_store_payment(request, contact.name, card_info, billing_info, unit_of_work)
+
+Jobs are keyed on the transaction id, the same transaction is only queued
+once. Jobs for the same contact lock its row until they commit, so two of
+them can't both create a customer profile. Failed gateway calls are retried: creating a customer or payment
+profile that already exists fails with E00039 and the existing id, so a
+retry picks up where the failed attempt stopped.
+"""
+
+from __future__ import unicode_literals, absolute_import
+import frappe
+import json
+import re
+import time
+from frappe.utils import now_datetime
+from frappe.utils.password import encrypt, decrypt
+
+from authorize import AuthorizeResponseError, AuthorizeConnectionError
+from authorizenet.gateway import get_gateway
+from authorizenet.metrics import span
+from authorizenet.utils import get_card_accronym, authnet_address
+
+JOB_KEY = "authorizenet:vault:{0}"
+JOB_TTL = 24 * 60 * 60
+MAX_ATTEMPTS = 4
+# seconds before the first retry, doubled for every further one
+RETRY_DELAY = 5
+
+DUPLICATE = "E00039"
+DUPLICATE_ID = re.compile(r"ID (\d+)")
+
+def enqueue_store_payment(request, contact_name, card_info, billing_info, unit_of_work):
+	"""Queues storing the card of a paid request once unit_of_work commits,
+	returns False when its transaction was queued before"""
+	cache = frappe.cache()
+	if not cache.set(cache.make_key(JOB_KEY.format(request.transaction_id)), 1, nx=True, ex=JOB_TTL):
+		return False
+
+	# card details sit in the job queue until the job runs, keep them encrypted
+	unit_of_work.enqueue("authorizenet.vault.store_payment", transaction_id=request.transaction_id,
+		request_name=request.name, contact_name=contact_name,
+		data=encrypt(json.dumps({"card_info": card_info, "billing_info": billing_info})))
+
+	return True
+
+def store_payment(transaction_id, request_name, contact_name, data):
+	"""Background job queued by enqueue_store_payment"""
+	from authorizenet.authorizenet.doctype.authorizenet_settings.authorizenet_settings import get_controller
+
+	data = json.loads(decrypt(data))
+	controller = get_controller()
+	gateway = get_gateway(controller.get_settings())
+
+	# only log rows are written to the request, don't load it
+	request = frappe.get_doc({"doctype": "AuthorizeNet Request"})
+	request.name = request_name
+	request.max_log_level(controller.log_level)
+
+	try:
+		for attempt in range(MAX_ATTEMPTS):
+			try:
+				vault_card(gateway, transaction_id, contact_name, data["card_info"],
+					data["billing_info"], request)
+				break
+			except AuthorizeConnectionError as ex:
+				request.log_action("Storing payment failed, attempt {0}: {1}".format(attempt + 1, ex), "Error")
+				if attempt == MAX_ATTEMPTS - 1:
+					raise
+
+				time.sleep(RETRY_DELAY * 2 ** attempt)
+
+		frappe.db.commit()
+	except Exception:
+		frappe.db.rollback()
+		request.log_action(frappe.get_traceback, "Error")
+		frappe.log_error(frappe.get_traceback(), "AuthorizeNet storing payment failed")
+	finally:
+		request.flush_log()
+		frappe.db.commit()
+
+def vault_card(gateway, transaction_id, contact_name, card_info, billing_info, request, unit_of_work=None):
+	"""Stores the card paid with in transaction_id on the contact's
+	customer profile, returns its customer_id and payment_id. With a
+	unit_of_work, the AuthorizeNet Users doc is written when it flushes."""
+	# locked until committed, another job for the contact waits here and
+	# then finds the AuthorizeNet Users doc this one created
+	frappe.db.get_value("Contact", contact_name, "name", for_update=True)
+	name = frappe.db.get_value("AuthorizeNet Users", {"contact": contact_name}, for_update=True)
+	if name:
+		authnet_user = frappe.get_doc("AuthorizeNet Users", name)
+	else:
+		request.log_action("Creating AUTHNET customer", "Info")
+		with span("customer_create"):
+			customer_id = create_customer(gateway, transaction_id)
+
+		authnet_user = frappe.get_doc({
+			"doctype": "AuthorizeNet Users",
+			"authorizenet_id": customer_id,
+			"contact": contact_name
+		})
+
+	card_store_info = {
+		"card_number": card_info.get("card_number"),
+		"expiration_month": card_info.get("exp_month"),
+		"expiration_year": card_info.get("exp_year"),
+		"card_code": card_info.get("card_code"),
+		"billing": billing_info
+	}
+
+	request.log_action("Storing Payment Information With AUTHNET", "Info")
+	with span("card_store"):
+		payment_id = create_payment_profile(gateway, authnet_user.authorizenet_id, card_store_info, request)
+	request.log_action("Success: %s" % payment_id, "Debug")
+
+	if not any(p.authorizenet_payment_id == payment_id for p in authnet_user.get("stored_payments")):
+		authnet_user.append("stored_payments", new_stored_payment(card_info, billing_info, payment_id))
+
+	authnet_user.flags.ignore_permissions = 1
+	if unit_of_work:
+		# written with the payment, unit tests never write it
+		unit_of_work.save(authnet_user)
+	else:
+		authnet_user.save()
+	request.log_action("Stored in DB", "Debug")
+
+	return {
+		"customer_id": authnet_user.authorizenet_id,
+		"payment_id": payment_id
+	}
+
+def create_customer(gateway, transaction_id):
+	"""Customer profile created from a transaction, or the one created
+	from it before"""
+	try:
+		return gateway.customer.from_transaction(transaction_id).customer_id
+	except AuthorizeResponseError as ex:
+		match = DUPLICATE_ID.search(ex.text or "") if ex.code == DUPLICATE else None
+		if not match:
+			raise
+
+		return match.group(1)
+
+def create_payment_profile(gateway, customer_id, card_store_info, request):
+	try:
+		return gateway.credit_card.create(customer_id, card_store_info).payment_id
+	except AuthorizeResponseError as ex:
+		# the card is on the profile already, the response carries its id
+		if ex.code != DUPLICATE or not ex.full_response.get("payment_id"):
+			raise
+
+		request.log_action("Duplicate payment profile, ignore", "Info")
+		return ex.full_response.payment_id
+
+def new_stored_payment(card_info, billing_info, payment_id):
+	billing = authnet_address(billing_info)
+	card_label = "{0}{1}".format(get_card_accronym(card_info.get("card_number")),
+		card_info.get("card_number")[-4:])
+	country_name, country_code = frappe.db.get_value("Country", billing_info.get("country"),
+		["country_name", "code"]) or (None, None)
+
+	return {
+		"doctype": "AuthorizeNet Stored Payment",
+		"short_text": "{0} {1}, {2} {3}".format(card_label, billing_info.get("city"),
+			billing_info.get("state"), billing_info.get("pincode")),
+		"long_text": "{0}\n{1}\n{2}, {3} {4}\n{5}".format(
+			card_label,
+			billing.get("address", ""),
+			billing.get("city", ""),
+			billing.get("state", ""),
+			billing.get("zip", ""),
+			country_name
+		),
+		"address_1": billing_info.get("address_1"),
+		"address_2": billing_info.get("address_2"),
+		"expires": "{0}-{1}-01".format(card_info.get("exp_year"), card_info.get("exp_month")),
+		"city": billing_info.get("city"),
+		"state": billing_info.get("state"),
+		"postal_code": billing_info.get("pincode"),
+		"country": country_code,
+		"payment_type": "Card",
+		"authorizenet_payment_id": payment_id,
+		"last_used": now_datetime()
+	}